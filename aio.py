@@ -0,0 +1,146 @@
+# coding=utf-8
+import asyncio
+from functools import partial
+import inspect
+import sys
+
+from tokenizer import *
+from asts import *
+from builtin import coerce
+
+
+"""
+Asyncio backend: `await run(ast, scope)` walks the tree like execute(), but as a coroutine, so a
+script waiting on I/O in a builtin lets every other script on the event loop carry on.
+
+Builtins in the scope may be plain functions or coroutine functions, both called as
+builtin(args, scope):
+
+- a coroutine builtin gets its arguments unevaluated, and evaluates each one it needs with
+  `await arg.execute(scope)`, just as a plain builtin calls `arg.execute(scope)`
+- a plain builtin gets its arguments already evaluated (they may have had to wait), and may still
+  return an awaitable, which is awaited
+
+User functions run on this backend too, with their arguments passed by name as usual.
+"""
+
+
+class Deferred:
+    # an argument for a coroutine builtin; execute() returns a coroutine for its value
+    __slots__ = ('ast',)
+
+    def __init__(self, ast):
+        self.ast = ast
+
+    def execute(self, scope):
+        return run(self.ast, scope)
+
+
+class Value:
+    # an argument for a plain builtin, evaluated before the call
+    __slots__ = ('val',)
+
+    def __init__(self, val):
+        self.val = val
+
+    def execute(self, scope):
+        return self.val
+
+
+def coroutine(func):
+    # coroutine functions, and objects with an `async def __call__`
+    return inspect.iscoroutinefunction(func) or inspect.iscoroutinefunction(getattr(type(func), '__call__', None))
+
+
+async def run(ast, scope):
+    kind = type(ast)
+    if kind is AtomAST:
+        if ast.type is not TokenType.ID:
+            return ast.val
+        val = scope[ast.val]
+        if type(val) is Argument:
+            return await val.value()
+        return val
+
+    if kind is ExpressionAST:
+        op = ast.op.type
+        if ast.lhs is None and op in UNARY:
+            return UNARY[op](await run(ast.rhs, scope))
+        if op in BINARY:
+            return BINARY[op](await run(ast.lhs, scope), await run(ast.rhs, scope))
+        if op in SHORT_CIRCUIT:
+            lhs = await run(ast.lhs, scope)
+            if bool(lhs) is SHORT_CIRCUIT[op]:
+                return lhs
+            return await run(ast.rhs, scope)
+        return None
+
+    if kind is AssignmentAST:
+        return store(scope, ast.dest.value, await run(ast.val, scope))
+
+    if kind is BlockAST:
+        ret = None
+        for line in ast.lines:
+            ret = await run(line, scope)
+        return ret
+
+    if kind is ConditionalAST:
+        if await run(ast.cond, scope):
+            return await run(ast.yes, scope)
+        if ast.no is None:
+            return None
+        return await run(ast.no, scope)
+
+    if kind is CallAST:
+        func = scope[ast.name.value]
+        if type(func) is Argument:
+            func = await func.value()
+        if type(func) is FunctionAST:
+            # parameters hold coroutine functions, awaited wherever the parameter is read
+            return await run(func.body, func.bind([partial(run, arg) for arg in ast.args], scope))
+        if coroutine(func):
+            return await func([Deferred(arg) for arg in ast.args], scope)
+        ret = func([Value(await run(arg, scope)) for arg in ast.args], scope)
+        if inspect.isawaitable(ret):
+            return await ret
+        return ret
+
+    raise TypeError(f'Cannot run {kind.__name__}')
+
+
+class Prompt:
+    # prompt:{message} or prompt:{message; "int"}, answered from an asyncio.StreamReader
+    def __init__(self, reader, output=sys.stdout):
+        self.reader = reader
+        self.output = output
+
+    async def __call__(self, args, scope):
+        params = [await arg.execute(scope) for arg in args[:2]]
+        self.output.write(str(params[0]) if params else '')
+        self.output.flush()
+        line = await self.reader.readline()
+        return coerce(line.decode().rstrip('\n'), *params[1:])
+
+
+async def stdin():
+    # an asyncio.StreamReader over this process's standard input
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return reader
+
+
+def execute(ast, scope):
+    # run one program to completion on a new event loop
+    return asyncio.run(run(ast, scope))
+
+
+if __name__ == '__main__':
+    from pratt import PrattLexer
+    from builtin import builtin_print
+
+    async def main():
+        scope = {'print': builtin_print, 'prompt': Prompt(await stdin())}
+        source = '{{ x :- prompt:{"Enter a number: "; "int"}. print:{x * 2}. }}'
+        await run(PrattLexer(list(Tokenizer(source).tokens())).line(), scope)
+    asyncio.run(main())
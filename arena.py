@@ -0,0 +1,273 @@
+# coding=utf-8
+from array import array
+from weakref import WeakKeyDictionary
+
+from tokenizer import *
+from asts import *
+from pratt import PrattLexer
+
+
+"""
+Compact AST format: instead of one Python object per node, a program is a handful of parallel
+typed arrays (struct of arrays), and a node is just its index into them.
+
+    kind    what the node is (LITERAL, NAME, UNARY_OP, ...)
+    op      the operator's TokenType value, for UNARY_OP and BINARY_OP
+    a b c   operands: child node indices, literal pool indices, or a start and length in `lists`
+    lists   child indices of blocks and calls, laid out one list after the other
+    pool    literal values and names, each stored once
+
+Children always come before their parents, since the parser builds them first. Nodes of
+alternatives the parser abandoned stay in the arena, unreferenced.
+"""
+
+LITERAL = 0     # a: pool index of the value
+NAME = 1        # a: pool index of the name
+UNARY_OP = 2    # op, b: operand
+BINARY_OP = 3   # op, a: lhs, b: rhs
+ASSIGN = 4      # a: pool index of the name, b: value
+BLOCK = 5       # a: start in lists, b: number of lines
+COND = 6        # a: condition, b: yes, c: no (or -1)
+CALL = 7        # a: pool index of the name, b: start in lists, c: number of arguments
+
+KINDS = ['LITERAL', 'NAME', 'UNARY_OP', 'BINARY_OP', 'ASSIGN', 'BLOCK', 'COND', 'CALL']
+
+TYPES = {t.value: t for t in TokenType}
+# operator functions by the TokenType value stored in the op column
+UNARY_FNS = {t.value: fn for t, fn in UNARY.items()}
+BINARY_FNS = {t.value: fn for t, fn in BINARY.items()}
+SHORT_FNS = {t.value: decides for t, decides in SHORT_CIRCUIT.items()}
+
+
+def postorder(root, children):
+    # every node under root, each one after its children, in the order recursing would visit them:
+    # a pre-order walk taking the last child first, reversed
+    order = list()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(children(node))
+    order.reverse()
+    return order
+
+
+class Arena:
+    def __init__(self):
+        self.kind = array('b')
+        self.op = array('b')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.lists = array('i')
+        self.pool = list()
+        # pool index of every value, keyed by type too so that 1, 1.0 and True stay apart
+        self.interned = dict()
+
+    def __len__(self):
+        return len(self.kind)
+
+    def nbytes(self):
+        # the columns plus the pool's own list (the pooled values are shared with the source text)
+        columns = (self.kind, self.op, self.a, self.b, self.c, self.lists)
+        return sum(col.itemsize * len(col) for col in columns) + 8 * len(self.pool)
+
+    def intern(self, val):
+        key = (type(val), val)
+        index = self.interned.get(key)
+        if index is None:
+            index = self.interned[key] = len(self.pool)
+            self.pool.append(val)
+        return index
+
+    def emit(self, kind, op=0, a=0, b=0, c=0):
+        self.kind.append(kind)
+        self.op.append(op)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        return len(self.kind) - 1
+
+    def children(self, nodes):
+        start = len(self.lists)
+        self.lists.extend(nodes)
+        return start
+
+    # the same constructors as pratt.Nodes, so PrattLexer(tokens, arena) parses straight into the arena
+
+    def atom(self, tok):
+        kind = NAME if tok.type is TokenType.ID else LITERAL
+        return self.emit(kind, a=self.intern(tok.value))
+
+    def expression(self, op, lhs, rhs):
+        if lhs is None:
+            return self.emit(UNARY_OP, op.type.value, b=rhs)
+        return self.emit(BINARY_OP, op.type.value, lhs, rhs)
+
+    def assignment(self, dest, val):
+        return self.emit(ASSIGN, a=self.intern(dest.value), b=val)
+
+    def block(self, lines):
+        return self.emit(BLOCK, a=self.children(lines), b=len(lines))
+
+    def conditional(self, cond, yes, no):
+        return self.emit(COND, a=cond, b=yes, c=-1 if no is None else no)
+
+    def call(self, name, args):
+        return self.emit(CALL, a=self.intern(name.value), b=self.children(args), c=len(args))
+
+    # conversion from and to the node classes, in post-order off an explicit stack rather than by
+    # recursing, so trees nested too deeply for Python's stack (see stack.py) convert too
+
+    def add(self, ast):
+        nodes = dict()
+        for node in postorder(ast, children):
+            nodes[id(node)] = self.convert(node, nodes)
+        return nodes[id(ast)]
+
+    def convert(self, ast, nodes):
+        # one node of add(), its children already in `nodes` by id
+        kind = type(ast)
+        if kind is AtomAST:
+            return self.atom(Token(ast.type, ast.val))
+        if kind is ExpressionAST:
+            lhs = None if ast.lhs is None else nodes[id(ast.lhs)]
+            return self.expression(ast.op, lhs, nodes[id(ast.rhs)])
+        if kind is AssignmentAST:
+            return self.assignment(ast.dest, nodes[id(ast.val)])
+        if kind is BlockAST:
+            return self.block([nodes[id(line)] for line in ast.lines])
+        if kind is ConditionalAST:
+            no = None if ast.no is None else nodes[id(ast.no)]
+            return self.conditional(nodes[id(ast.cond)], nodes[id(ast.yes)], no)
+        if kind is CallAST:
+            return self.call(ast.name, [nodes[id(arg)] for arg in ast.args])
+        raise TypeError(f'Cannot store {kind.__name__}')
+
+    def subnodes(self, node):
+        # the child indices of a node
+        kind = self.kind[node]
+        a, b, c = self.a[node], self.b[node], self.c[node]
+        if kind == UNARY_OP or kind == ASSIGN:
+            return [b]
+        if kind == BINARY_OP:
+            return [a, b]
+        if kind == BLOCK:
+            return self.lists[a:a + b]
+        if kind == COND:
+            return [a, b] if c < 0 else [a, b, c]
+        if kind == CALL:
+            return self.lists[b:b + c]
+        return []
+
+    def tree(self, node):
+        # children come before their parents, so every index a node refers to is below its own
+        asts = [None] * (node + 1)
+        build = self.build
+        for index in postorder(node, self.subnodes):
+            asts[index] = build(index, asts)
+        return asts[node]
+
+    def build(self, node, asts):
+        # one node of tree(), its children already in `asts` by index
+        kind = self.kind[node]
+        a, b, c = self.a[node], self.b[node], self.c[node]
+        if kind == LITERAL:
+            val = self.pool[a]
+            return AtomAST(Token(TokenType.STR if type(val) is str else TokenType.NUM, val))
+        if kind == NAME:
+            return AtomAST(Token(TokenType.ID, self.pool[a]))
+        if kind == UNARY_OP:
+            return ExpressionAST(Token(TYPES[self.op[node]]), None, asts[b])
+        if kind == BINARY_OP:
+            return ExpressionAST(Token(TYPES[self.op[node]]), asts[a], asts[b])
+        if kind == ASSIGN:
+            return AssignmentAST(Token(TokenType.ID, self.pool[a]), asts[b])
+        if kind == BLOCK:
+            return BlockAST([asts[line] for line in self.lists[a:a + b]])
+        if kind == COND:
+            return ConditionalAST(asts[a], asts[b], None if c < 0 else asts[c])
+        return CallAST(Token(TokenType.ID, self.pool[a]), [asts[arg] for arg in self.lists[b:b + c]])
+
+    def __str__(self):
+        return '\n'.join(f'{node:>6} {KINDS[self.kind[node]]:<8} {self.op[node]:>3} '
+                         f'{self.a[node]:>6} {self.b[node]:>6} {self.c[node]:>6}' for node in range(len(self)))
+
+    # evaluation, with the same semantics as execute() on the node classes
+
+    def execute(self, node, scope):
+        kind = self.kind[node]
+        if kind == LITERAL:
+            return self.pool[self.a[node]]
+        if kind == NAME:
+            return load(scope, self.pool[self.a[node]])
+        if kind == BINARY_OP:
+            op = self.op[node]
+            fn = BINARY_FNS.get(op)
+            if fn is not None:
+                return fn(self.execute(self.a[node], scope), self.execute(self.b[node], scope))
+            if op in SHORT_FNS:
+                lhs = self.execute(self.a[node], scope)
+                if bool(lhs) is SHORT_FNS[op]:
+                    return lhs
+                return self.execute(self.b[node], scope)
+            return None
+        if kind == UNARY_OP:
+            return UNARY_FNS[self.op[node]](self.execute(self.b[node], scope))
+        if kind == ASSIGN:
+            return store(scope, self.pool[self.a[node]], self.execute(self.b[node], scope))
+        if kind == BLOCK:
+            ret = None
+            start = self.a[node]
+            for line in self.lists[start:start + self.b[node]]:
+                ret = self.execute(line, scope)
+            return ret
+        if kind == COND:
+            if self.execute(self.a[node], scope):
+                return self.execute(self.b[node], scope)
+            no = self.c[node]
+            return None if no < 0 else self.execute(no, scope)
+        start = self.b[node]
+        args = [Node(self, arg) for arg in self.lists[start:start + self.c[node]]]
+        return load(scope, self.pool[self.a[node]])(args, scope)
+
+
+class Node:
+    # a node of an arena, standing in for an AST where builtins and FunctionAST expect one
+    __slots__ = ('arena', 'index')
+
+    def __init__(self, arena, index):
+        self.arena = arena
+        self.index = index
+
+    def execute(self, scope):
+        return self.arena.execute(self.index, scope)
+
+    def __str__(self):
+        return str(self.arena.tree(self.index))
+
+
+def parse(tokens, arena=None):
+    # parse one line straight into an arena; returns the arena and the root node's index
+    arena = Arena() if arena is None else arena
+    return arena, PrattLexer(tokens, arena).line()
+
+
+# arena copies of the node-class programs run so far
+arenas = WeakKeyDictionary()
+
+
+def run(ast, scope):
+    compiled = arenas.get(ast)
+    if compiled is None:
+        arena = Arena()
+        compiled = arenas[ast] = (arena, arena.add(ast))
+    arena, root = compiled
+    return arena.execute(root, scope)
+
+
+if __name__ == '__main__':
+    arena, root = parse(list(Tokenizer('{{ x :- 3. (x > 2) => print:{x * (4 + 1)} !! -x. }}').tokens()))
+    print(arena)
+    print(arena.tree(root))
+    arena.execute(root, {'print': lambda args, scope: print(*[arg.execute(scope) for arg in args])})
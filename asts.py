@@ -1,5 +1,81 @@
+import operator
+from weakref import WeakKeyDictionary
+
 from tokenizer import Token, TokenType
 
+
+def xor(lhs, rhs):
+    # strict: both sides are always evaluated, as there is no value of one that decides it alone
+    return bool(lhs) is not bool(rhs)
+
+
+# operator semantics shared by every execution backend
+BINARY = {
+    TokenType.ADD: operator.add,
+    TokenType.SUB: operator.sub,
+    TokenType.MUL: operator.mul,
+    TokenType.DIV: operator.truediv,
+    TokenType.EXP: operator.pow,
+    TokenType.GT: operator.gt,
+    TokenType.LT: operator.lt,
+    TokenType.GE: operator.ge,
+    TokenType.LE: operator.le,
+    TokenType.EQ: operator.eq,
+    TokenType.XOR: xor,
+}
+
+
+def identity(val):
+    return val
+
+
+def negate(val):
+    return -1 * val
+
+
+UNARY = {
+    TokenType.ADD: identity,
+    TokenType.SUB: negate,
+    TokenType.NOT: operator.not_,
+}
+
+# && and || evaluate their right side only when the left one does not decide the result: the
+# value is the left side's if its truth is the one given here, and the right side's otherwise,
+# as with Python's `and` and `or`
+SHORT_CIRCUIT = {
+    TokenType.AND: False,
+    TokenType.OR: True,
+}
+
+
+class Argument:
+    # a function argument, passed by name: `fn(scope)` evaluates the caller's argument AST, and runs
+    # again in the caller's scope every time the parameter is read
+    __slots__ = ('fn', 'scope')
+
+    def __init__(self, fn, scope):
+        self.fn = fn
+        self.scope = scope
+
+    def value(self):
+        return self.fn(self.scope)
+
+
+def load(scope, name):
+    # scopes hold plain values (ints, strings, functions), or an Argument for a parameter
+    val = scope[name]
+    if type(val) is Argument:
+        return val.value()
+    return val
+
+
+def store(scope, name, val):
+    if type(val) is not int and type(val) is not str:
+        print('Warning: value of type {} is not supported!'.format(type(val)))
+    scope[name] = val
+    return val
+
+
 class ExpressionAST:
     def __init__(self, op, lhs, rhs):
         self.lhs = lhs
@@ -37,6 +113,32 @@ class ExpressionAST:
             return self.lhs.execute(scope) <= self.rhs.execute(scope)
         if self.op.type is TokenType.EQ:
             return self.lhs.execute(scope) == self.rhs.execute(scope)
+        if self.op.type is TokenType.AND:
+            return self.lhs.execute(scope) and self.rhs.execute(scope)
+        if self.op.type is TokenType.OR:
+            return self.lhs.execute(scope) or self.rhs.execute(scope)
+        if self.op.type is TokenType.XOR:
+            return xor(self.lhs.execute(scope), self.rhs.execute(scope))
+
+    def compile(self):
+        if self.lhs is None and self.op.type in UNARY:
+            fn = UNARY[self.op.type]
+            rhs = self.rhs.compile()
+            if fn is identity:
+                return rhs
+            return lambda scope: fn(rhs(scope))
+        if self.op.type in BINARY:
+            fn = BINARY[self.op.type]
+            lhs = self.lhs.compile()
+            rhs = self.rhs.compile()
+            return lambda scope: fn(lhs(scope), rhs(scope))
+        if self.op.type in SHORT_CIRCUIT:
+            lhs = self.lhs.compile()
+            rhs = self.rhs.compile()
+            if self.op.type is TokenType.AND:
+                return lambda scope: lhs(scope) and rhs(scope)
+            return lambda scope: lhs(scope) or rhs(scope)
+        return lambda scope: None
 
 
 class AtomAST:
@@ -44,6 +146,9 @@ class AtomAST:
         assert atom.type in (TokenType.NUM, TokenType.STR, TokenType.ID)
         self.val = atom.value
         self.type = atom.type
+        # (line, column) in the script for the profiler, without keeping the whole token alive;
+        # None for a made-up token
+        self.position = None if atom.line is None else (atom.line, atom.column)
 
     def __str__(self):
         if self.type == TokenType.ID:
@@ -52,9 +157,24 @@ class AtomAST:
 
     def execute(self, scope):
         if self.type == TokenType.ID:
-            return scope[self.val].execute(scope)
+            val = scope[self.val]
+            if type(val) is Argument:
+                return val.value()
+            return val
         return self.val
 
+    def compile(self):
+        val = self.val
+        if self.type != TokenType.ID:
+            return lambda scope: val
+
+        def read(scope):
+            ret = scope[val]
+            if type(ret) is Argument:
+                return ret.value()
+            return ret
+        return read
+
 
 class AssignmentAST:
     def __init__(self, dest, val):
@@ -65,19 +185,13 @@ class AssignmentAST:
         return f'[{self.dest} <- {self.val}]'
 
     def execute(self, scope):
-        # scope[self.dest.value] = self.val.execute(scope)
-        val = self.val.execute(scope)
-        if type(val) is AtomAST:
-            scope[self.dest.value] = self.val
-        elif type(val) is int:
-            scope[self.dest.value] = AtomAST(Token(TokenType.NUM, val))
-        elif type(val) is str:
-            scope[self.dest.value] = AtomAST(Token(TokenType.STR, val))
-        else:
-            scope[self.dest.value] = AtomAST(Token(TokenType.STR, val))
-            print('Warning: value of type {} is not supported!'.format(type(val)))
+        # an assignment evaluates to the value it stored
+        return store(scope, self.dest.value, self.val.execute(scope))
 
-        return self.val
+    def compile(self):
+        name = self.dest.value
+        val = self.val.compile()
+        return lambda scope: store(scope, name, val(scope))
 
 
 class BlockAST:
@@ -93,6 +207,20 @@ class BlockAST:
             ret = line.execute(scope)
         return ret
 
+    def compile(self):
+        lines = [line.compile() for line in self.lines]
+        if not lines:
+            return lambda scope: None
+        if len(lines) == 1:
+            return lines[0]
+
+        def block(scope):
+            ret = None
+            for line in lines:
+                ret = line(scope)
+            return ret
+        return block
+
 
 class ConditionalAST:
     def __init__(self, cond, yes, no):
@@ -106,8 +234,18 @@ class ConditionalAST:
     def execute(self, scope):
         if self.cond.execute(scope):
             return self.yes.execute(scope)
+        if self.no is None:
+            return None
         return self.no.execute(scope)
 
+    def compile(self):
+        cond = self.cond.compile()
+        yes = self.yes.compile()
+        if self.no is None:
+            return lambda scope: yes(scope) if cond(scope) else None
+        no = self.no.compile()
+        return lambda scope: yes(scope) if cond(scope) else no(scope)
+
 
 class CallAST:
     def __init__(self, name, args):
@@ -118,25 +256,92 @@ class CallAST:
         return f'({self.name.value} {" ".join(map(str, self.args))})'
 
     def execute(self, scope):
-        return scope[self.name.value](self.args, scope)
+        return load(scope, self.name.value)(self.args, scope)
+
+    def compile(self):
+        name = self.name.value
+        args = self.args
+        fns = [arg.compile() for arg in args]
+
+        def call(scope):
+            func = load(scope, name)
+            if type(func) is FunctionAST:
+                return evaluate(func.body, func.bind(fns, scope))
+            return func(args, scope)
+        return call
+
+
+class Frame(dict):
+    # a call's own variables; names it does not define are looked up in the caller's scope
+    __slots__ = ('parent',)
+
+    def __init__(self, parent, bindings=()):
+        super().__init__(bindings)
+        self.parent = parent
+
+    def __missing__(self, key):
+        # walk up the frames in a loop, not by recursing, so deep recursion in a script can still
+        # see its globals
+        scope = self.parent
+        while type(scope) is Frame:
+            if key in scope:
+                return dict.__getitem__(scope, key)
+            scope = scope.parent
+        return scope[key]
 
 
 class FunctionAST:
     def __init__(self, args, body):
-        self.scope = dict()
         self.argNames = args
         self.body = body
 
     def __str__(self):
         return f'(func [{" ".join(self.argNames)}] {self.body}'
 
-    def __call__(self, args, scope):
-        # copy global scope
-        for k, v in scope.items():
-            self.scope[k] = v
-        # assign parameter values
-        for arg, val in zip(self.argNames, args):
-            self.scope[arg] = val
+    def bind(self, fns, scope):
+        # a fresh frame holding just the parameters, so a call costs O(parameters) however large
+        # the caller's scope is, and assignments stay local to the call; `fns` are the arguments
+        # compiled by the calling backend into functions of the caller's scope
+        return Frame(scope, zip(self.argNames, [Argument(fn, scope) for fn in fns]))
 
+    def __call__(self, args, scope):
         # call the function with modified local scope
-        return self.body.execute(self.scope)
+        return self.body.execute(self.bind([arg.execute for arg in args], scope))
+
+
+# closures compiled so far, so a program (or function body) is only compiled once
+closures = WeakKeyDictionary()
+
+
+def evaluate(ast, scope):
+    # run an AST through its compiled closures instead of execute()
+    fn = closures.get(ast)
+    if fn is None:
+        fn = closures[ast] = ast.compile()
+    return fn(scope)
+
+
+def children(ast):
+    # the direct sub-ASTs of ast, in source order
+    kind = type(ast)
+    if kind is ExpressionAST:
+        return [ast.rhs] if ast.lhs is None else [ast.lhs, ast.rhs]
+    if kind is AssignmentAST:
+        return [ast.val]
+    if kind is BlockAST:
+        return ast.lines
+    if kind is ConditionalAST:
+        return [ast.cond, ast.yes] + ([] if ast.no is None else [ast.no])
+    if kind is CallAST:
+        return ast.args
+    return []
+
+
+def nodes(ast, kind):
+    # every node of type `kind` in ast
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if type(node) is kind:
+            yield node
+        stack.extend(children(node))
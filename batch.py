@@ -0,0 +1,112 @@
+# coding=utf-8
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import io
+import os
+
+from tokenizer import *
+from arena import Arena
+from pratt import PrattLexer
+
+
+"""
+Batch runner: many independent runs of Sapphire programs spread over a pool of worker processes.
+
+Every distinct script is parsed once, in the calling process, and sent to each worker once, in
+arena form, when the worker starts; a job is then only a program number and its bindings. Jobs
+go to the workers in chunks, each job runs in its own scope with its own captured output, and
+results come back in the order the jobs were given.
+"""
+
+
+class Result:
+    __slots__ = ('value', 'output', 'error')
+
+    def __init__(self, value, output, error=None):
+        self.value = value
+        self.output = output
+        # the exception's type name and message, or None if the run succeeded
+        self.error = error
+
+    def __repr__(self):
+        return f'Result({self.value!r}, {self.output!r}, {self.error!r})'
+
+
+# per worker process: the programs of the current batch and the backend to run them on
+programs = list()
+runner = None
+
+
+def start(arenas, backend):
+    global programs, runner
+    import sapphire
+    # a script that did not parse is left as its error message
+    programs = [root if store is None else store.tree(root) for store, root in arenas]
+    runner = (sapphire.BACKENDS[backend], sapphire.scope)
+
+
+def run(job):
+    index, bindings = job
+    run_backend, builtins = runner
+    scope = dict(builtins)
+    if bindings:
+        scope.update(bindings)
+    program = programs[index]
+    if type(program) is str:
+        return Result(None, '', program)
+    out = io.StringIO()
+    try:
+        with redirect_stdout(out):
+            value = run_backend(program, scope)
+    except Exception as e:
+        return Result(None, out.getvalue(), f'{type(e).__name__}: {e}')
+    return Result(value, out.getvalue())
+
+
+def run_chunk(jobs):
+    return [run(job) for job in jobs]
+
+
+def compile_programs(sources):
+    # (arena, root) per source, or (None, error message) for one that does not parse, so its
+    # jobs fail on their own like those that fail at run time
+    arenas = list()
+    for source in sources:
+        store = Arena()
+        try:
+            arenas.append((store, PrattLexer(list(Tokenizer(source).tokens()), store).line()))
+        except TokenError as e:
+            arenas.append((None, f'{type(e).__name__}: {e}'))
+    return arenas
+
+
+def run_jobs(sources, jobs, workers=None, chunksize=None, backend='closure'):
+    # jobs are (index into sources, bindings) pairs; workers=0 runs them all in this process
+    arenas = compile_programs(sources)
+    if workers == 0:
+        start(arenas, backend)
+        return run_chunk(jobs)
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        # a few chunks per worker, so a slow chunk does not leave the other workers idle
+        chunksize = max(1, len(jobs) // (workers * 4))
+    chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+    with ProcessPoolExecutor(workers, initializer=start, initargs=(arenas, backend)) as pool:
+        return [result for chunk in pool.map(run_chunk, chunks) for result in chunk]
+
+
+def run_scripts(sources, bindings=None, **options):
+    # every script once, each with the same bindings; repeated scripts are parsed only once
+    unique = dict()
+    jobs = [(unique.setdefault(source, len(unique)), bindings) for source in sources]
+    return run_jobs(list(unique), jobs, **options)
+
+
+def run_bindings(source, bindings, **options):
+    # one script, once per binding set
+    return run_jobs([source], [(0, values) for values in bindings], **options)
+
+
+if __name__ == '__main__':
+    for result in run_bindings('{{ print:{x * 2}. x > 2 => "big" !! "small". }}', [{'x': i} for i in range(5)], workers=2):
+        print(result)
@@ -0,0 +1,523 @@
+# coding=utf-8
+from contextlib import redirect_stdout
+from functools import partial
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+import tracemalloc
+
+from tokenizer import Tokenizer
+from lexer import Lexer
+from pratt import PrattLexer
+from optimize import Optimizer
+from asts import AtomAST, FunctionAST, evaluate
+from builtin import Output, Capture
+from tokenizer import Token, TokenType
+import sapphire
+import arena
+import cache
+import vectorize
+import profiler
+import stack
+import incremental
+import batch
+import aio
+import asyncio
+from workloads import (SNIPPET, ARITHMETIC, LOCALS, CALLS, CONSTANTS, ARENA_LINE, SHARED, FIB, FORMULAS,
+                       program, bindings, label, deep, rows, scalar_loop)
+
+
+"""
+Benchmarks: timings of the parsers, backends and optional stages on the shared workloads in
+workloads.py. Run `python benchmark.py [name ...]`; test_sapphire.py checks the results.
+"""
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def tokenize(source):
+    for _ in Tokenizer(source).tokens():
+        pass
+
+
+def bench_tokenizer(sizes=(1 << 10, 1 << 14, 1 << 17, 1 << 20, 10 << 20)):
+    print(f'{"size":>10} {"seconds":>10} {"MB/s":>8} {"ns/byte":>8}')
+    for size in sizes:
+        source = (SNIPPET * (size // len(SNIPPET) + 1))[:size]
+        # cut back to the last complete line so the input stays well-formed
+        source = source[:source.rfind('\n') + 1] or SNIPPET
+        elapsed = timed(tokenize, source)
+        print(f'{len(source):>10} {elapsed:>10.4f} {len(source) / elapsed / 1e6:>8.2f} '
+              f'{elapsed / len(source) * 1e9:>8.1f}')
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_streaming(size=1 << 20):
+    # peak memory of tokenizing a script held in a str vs streamed from the file in chunks
+    with tempfile.TemporaryFile('w+') as f:
+        f.write(SNIPPET * (size // len(SNIPPET)))
+        f.seek(0)
+        whole = peak_memory(lambda: tokenize(f.read()))
+        f.seek(0)
+        streamed = peak_memory(tokenize, f)
+    print(f'{"whole file":>12} {whole / 1e6:>8.2f} MB peak')
+    print(f'{"streamed":>12} {streamed / 1e6:>8.2f} MB peak')
+
+
+def nested(depth):
+    # a conditional whose condition is buried in `depth` redundant parentheses
+    return '(' * depth + 'x + 1' + ')' * depth + ' > 2 => print:{x} !! print:{-x}'
+
+
+def bench_packrat(depths=(5, 10, 20, 40, 80)):
+    print(f'{"depth":>6} {"tokens":>7} {"plain":>9} {"packrat":>9} {"hits":>6} {"misses":>7}')
+    for depth in depths:
+        toks = list(Tokenizer(nested(depth)).tokens())
+        plain = timed(Lexer(toks).line)
+        lex = Lexer(toks, packrat=True)
+        packrat = timed(lex.line)
+        print(f'{depth:>6} {len(toks):>7} {plain:>9.4f} {packrat:>9.4f} {lex.hits:>6} {lex.misses:>7}')
+
+
+def bench_parsers(repeat=200):
+    block = ['{{'] + [SNIPPET.strip() + '.'] * repeat + ['}}']
+    toks = list(Tokenizer(' '.join(block)).tokens())
+    print(f'{"engine":>8} {"seconds":>9} {"tokens/s":>10}')
+    for name, engine in (('lexer', Lexer), ('packrat', partial(Lexer, packrat=True)), ('pratt', PrattLexer),
+                         ('stack', stack.StackLexer)):
+        elapsed = timed(engine(toks).line)
+        print(f'{name:>8} {elapsed:>9.4f} {len(toks) / elapsed:>10.0f}')
+
+
+def bench_backends(repeat=100, backends=sapphire.BACKENDS):
+    print(f'{"program":>10} {"backend":>8} {"seconds":>9} {"speedup":>8}')
+    for name, source in (('arithmetic', ARITHMETIC), ('locals', LOCALS), ('calls', CALLS)):
+        ast = program(source)
+        baseline = None
+        for backend, run in backends.items():
+            scope = bindings()
+            elapsed = timed(lambda: [run(ast, scope) for _ in range(repeat)])
+            baseline = baseline or elapsed
+            print(f'{name:>10} {backend:>8} {elapsed:>9.4f} {baseline / elapsed:>7.2f}x')
+
+
+def bench_optimizer(repeat=100, backends=sapphire.BACKENDS):
+    optimizer = Optimizer()
+    ast = program(CONSTANTS)
+    optimized = optimizer.optimize(ast)
+    print(optimizer.summary())
+    print(f'{"backend":>8} {"original":>9} {"optimized":>10} {"speedup":>8}')
+    for name, run in backends.items():
+        scope = bindings()
+        before = timed(lambda: [run(ast, scope) for _ in range(repeat)])
+        after = timed(lambda: [run(optimized, scope) for _ in range(repeat)])
+        print(f'{name:>8} {before:>9.4f} {after:>10.4f} {before / after:>7.2f}x')
+
+
+def bench_calls(sizes=(10, 1000, 100000), repeat=20000, backends=sapphire.BACKENDS):
+    # cost of one call must not depend on how many globals the caller has
+    ast = program('sq:{3}')
+    print(f'{"globals":>8} ' + ' '.join(f'{name:>9}' for name in backends) + '   (us per call)')
+    for size in sizes:
+        scope = bindings()
+        for i in range(size):
+            scope[f'g{i}'] = i
+        times = [timed(lambda: [run(ast, scope) for _ in range(repeat)]) for run in backends.values()]
+        print(f'{size:>8} ' + ' '.join(f'{t / repeat * 1e6:>9.2f}' for t in times))
+
+
+# one small program per node type, dominated by that node
+NODES = {
+    'AtomAST': '7',
+    'AtomAST($)': 'x',
+    'ExpressionAST': 'x * 3 + y - 2 ^ 2',
+    'AssignmentAST': 'r :- 5',
+    'BlockAST': '{{ 1. 2. 3. 4. }}',
+    'ConditionalAST': 'x > 1 => 2 !! 3',
+    'CallAST': 'h:{}',
+}
+
+
+def bench_closures(repeat=20000):
+    print(f'{"node":>15} {"execute":>9} {"closure":>9} {"speedup":>8}')
+    for name, source in NODES.items():
+        ast = program(source)
+        scope = bindings()
+        tree = timed(lambda: [ast.execute(scope) for _ in range(repeat)])
+        fn = ast.compile()
+        closure = timed(lambda: [fn(scope) for _ in range(repeat)])
+        print(f'{name:>15} {tree:>9.4f} {closure:>9.4f} {tree / closure:>7.2f}x')
+
+
+def bench_values(count=20000):
+    # an assignment-heavy program that keeps every value alive, so memory per variable shows
+    ast = program('{{ ' + ' '.join(f'{label(i)} :- {i} * 2 + 1.' for i in range(count)) + ' }}')
+    print(f'{"backend":>8} {"peak MB":>8} {"bytes/var":>10}')
+    for name, run in sapphire.BACKENDS.items():
+        run(ast, bindings())
+        peak = peak_memory(run, ast, bindings())
+        print(f'{name:>8} {peak / 1e6:>8.2f} {peak / count:>10.1f}')
+    # what the same values cost wrapped the way variables used to be stored
+    values = [i * 2 + 1 for i in range(count)]
+    raw = peak_memory(lambda: list(values))
+    wrapped = peak_memory(lambda: [AtomAST(Token(TokenType.NUM, val)) for val in values])
+    tokens = peak_memory(lambda: [Token(TokenType.NUM, val) for val in values])
+    print(f'{"raw value":>16} {raw / count:>6.1f} bytes')
+    print(f'{"AtomAST + Token":>16} {wrapped / count:>6.1f} bytes')
+    print(f'{"Token":>16} {tokens / count:>6.1f} bytes')
+
+
+def retained(fn, *args):
+    # memory still held by fn's result once it returns
+    tracemalloc.start()
+    try:
+        result = fn(*args)
+        return tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+
+def bench_arena(sizes=(100, 1000, 10000), repeat=5):
+    print(f'{"lines":>6} {"source MB":>10} {"nodes MB":>9} {"arena MB":>9} {"ratio":>6} '
+          f'{"parse":>8} {"parse arena":>12} {"execute":>8} {"arena":>8}')
+    for size in sizes:
+        source = '{{ ' + ARENA_LINE * size + '}}'
+        toks = list(Tokenizer(source).tokens())
+        nodes, ast = retained(lambda: PrattLexer(toks).line())
+        compact, (store, root) = retained(arena.parse, toks)
+        parse_nodes = timed(lambda: PrattLexer(toks).line())
+        parse_arena = timed(arena.parse, toks)
+        scope = bindings()
+        tree = timed(lambda: [ast.execute(scope) for _ in range(repeat)])
+        columns = timed(lambda: [store.execute(root, scope) for _ in range(repeat)])
+        print(f'{size:>6} {len(source) / 1e6:>10.3f} {nodes / 1e6:>9.3f} {compact / 1e6:>9.3f} '
+              f'{nodes / compact:>5.1f}x {parse_nodes:>8.4f} {parse_arena:>12.4f} {tree:>8.4f} {columns:>8.4f}')
+
+
+def bench_cache(sizes=(1000, 10000), repeat=3):
+    # wall time of a whole `sapphire.py script` run with no cache file, then with an up-to-date one
+    interpreter = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sapphire.py')
+    print(f'{"lines":>6} {"source MB":>10} {"cache MB":>9} {"cold":>8} {"warm":>8} {"speedup":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            script = os.path.join(directory, f'{size}.sap')
+            with open(script, 'w') as f:
+                f.write('{{ x :- 5. ' + ARENA_LINE.replace('sq:', 'print:').replace('f:{x; ', 'print:{') * size + '}}')
+            run = partial(subprocess.run, [sys.executable, interpreter, script], check=True,
+                          stdout=subprocess.DEVNULL)
+            cold = warm = float('inf')
+            for _ in range(repeat):
+                if os.path.exists(cache.location(script)):
+                    os.unlink(cache.location(script))
+                cold = min(cold, timed(run))
+                warm = min(warm, timed(run))
+            print(f'{size:>6} {os.path.getsize(script) / 1e6:>10.3f} '
+                  f'{os.path.getsize(cache.location(script)) / 1e6:>9.3f} '
+                  f'{cold:>8.3f} {warm:>8.3f} {cold / warm:>7.2f}x')
+
+
+def bench_interpreter(snippets=300, repeat=20, sizes=(0, 100, 300)):
+    # a service evaluating the same few hundred snippets over and over, with caches of several sizes
+    sources = [f'{{{{ r :- x * {i} + (y - {i % 7}) ^ 2. r > {i} => r - {i} !! sq:{{r}}. }}}}' for i in range(snippets)]
+    workload = sources * repeat
+    print(f'{"cache":>6} {"seconds":>9} {"runs/s":>9} {"hits":>7} {"misses":>7} {"evictions":>10}')
+    for size in sizes:
+        interpreter = sapphire.Interpreter(cache_size=size)
+        values = {'x': 3, 'y': 4, 'sq': bindings()['sq']}
+        elapsed = timed(lambda: [interpreter.execute(source, values) for source in workload])
+        stats = interpreter.stats()
+        print(f'{size:>6} {elapsed:>9.4f} {len(workload) / elapsed:>9.0f} {stats["hits"]:>7} '
+              f'{stats["misses"]:>7} {stats["evictions"]:>10}')
+
+
+def bench_vectorize(size=10 ** 6):
+    if vectorize.np is None:
+        print('numpy is not installed')
+        return
+    table = rows(size)
+    columns = {name: vectorize.np.array(col) for name, col in table.items()}
+    scope = bindings()
+    print(f'{"formula":>40} {"scalar":>8} {"vector":>8} {"speedup":>8} {"fallback rows":>14}')
+    for source in FORMULAS:
+        ast = program(source)
+        scalar = timed(scalar_loop, ast, table, scope)
+        vectorizer = vectorize.Vectorizer(columns, scope)
+        vector = timed(vectorizer.evaluate, ast)
+        fallback = sum(count for _, count in vectorizer.fallbacks)
+        print(f'{source[:40]:>40} {scalar:>8.3f} {vector:>8.3f} {scalar / vector:>7.1f}x {fallback:>14}')
+
+
+def bench_batch(jobs=2000, workers=(0, 1, 2, 4)):
+    # one script run with many binding sets, in this process (0) and on pools of several sizes
+    source = '{{ ' + 's :- x * 2. t :- s - y. print:{s; t}. ' * 20 + 'x > y => "up" !! "down". }}'
+    values = [{'x': i, 'y': i % 7} for i in range(jobs)]
+    print(f'{"workers":>8} {"seconds":>9} {"jobs/s":>9} {"speedup":>8}')
+    baseline = None
+    for count in workers:
+        elapsed = timed(lambda: batch.run_bindings(source, values, workers=count))
+        baseline = baseline or elapsed
+        print(f'{count:>8} {elapsed:>9.4f} {jobs / elapsed:>9.0f} {baseline / elapsed:>7.2f}x')
+    print(f'{os.cpu_count()} CPUs')
+
+
+def bench_threads(threads=16, runs=300, backends=sapphire.BACKENDS):
+    # one program shared by many threads, each run with its own bindings
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        print(f'{"backend":>8} {"runs":>7} {"seconds":>9}')
+        for name in backends:
+            functions = {k: v for k, v in bindings().items() if type(v) is FunctionAST}
+            jobs = [dict(functions, x=t, y=i) for t in range(threads) for i in range(runs)]
+            # a fresh interpreter, so the threads also race to parse and compile the program
+            interpreter = sapphire.Interpreter(backend=name)
+
+            def worker(t):
+                for i in range(t * runs, (t + 1) * runs):
+                    interpreter.execute(SHARED, jobs[i])
+            pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+            start = time.perf_counter()
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            print(f'{name:>8} {len(jobs):>7} {elapsed:>9.4f}')
+    finally:
+        sys.setswitchinterval(interval)
+
+
+async def fetch(args, scope):
+    # stands in for a builtin doing network I/O
+    val = await args[0].execute(scope)
+    await asyncio.sleep(0.05)
+    return val * 2
+
+
+def bench_asyncio(scripts=10000):
+    # many scripts interleaved on one event loop, each waiting on I/O twice and reading a prompt
+    ast = program('{{ a :- fetch:{x}. b :- prompt:{"? "; "int"}. fetch:{a + b}. }}')
+
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(''.join(f'{i}\n' for i in range(scripts)).encode())
+        reader.feed_eof()
+        prompt = aio.Prompt(reader, io.StringIO())
+        tasks = [aio.run(ast, {'fetch': fetch, 'prompt': prompt, 'x': i}) for i in range(scripts)]
+        return await asyncio.gather(*tasks)
+    start = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    print(f'{scripts} scripts, 0.1s of I/O each: {elapsed:.3f}s on one loop '
+          f'({scripts * 0.1 / elapsed:.0f}x faster than one at a time)')
+
+
+def bench_output(lines=10 ** 6):
+    # a script printing `lines` lines (1000 calls of a function printing 1000), through each sink
+    per_call = 1000
+    body = program('{{ ' + 'print:{n; "line of output"}. ' * per_call + '}}')
+    ast = program('{{ ' + ''.join(f'k:{{{i}}}. ' for i in range(lines // per_call)) + '}}')
+    counted = [0]
+
+    def count(text):
+        counted[0] += text.count('\n')
+    # stdout is line buffered on a terminal, so print() makes one write call per line there
+    with open(os.devnull, 'w', buffering=1) as terminal:
+        sinks = {
+            'print()': None,
+            'buffered': Output(terminal.write),
+            'line-flushed': Output(terminal.write, lines=1),
+            'capture': Capture(),
+            'callback': Output(count),
+        }
+        print(f'{"sink":>13} {"seconds":>9} {"lines/s":>10}')
+        for name, output in sinks.items():
+            interpreter = sapphire.Interpreter(output=output)
+            values = {'k': FunctionAST(['n'], body)}
+            with redirect_stdout(terminal):
+                elapsed = timed(interpreter.run, ast, values)
+            print(f'{name:>13} {elapsed:>9.3f} {lines / elapsed:>10.0f}')
+
+
+def bench_profile(repeat=20):
+    # what profiling costs over the plain tree walker, and what it reports
+    print(f'{"program":>10} {"tree":>9} {"profiled":>9} {"overhead":>9}')
+    for name, source in (('arithmetic', ARITHMETIC), ('calls', CALLS)):
+        ast = program(source)
+        scope = bindings()
+        plain = timed(lambda: [evaluate(ast, scope) for _ in range(repeat)])
+        prof = profiler.Profiler()
+        profiled = timed(lambda: [prof.run(ast, scope) for _ in range(repeat)])
+        print(f'{name:>10} {plain:>9.4f} {profiled:>9.4f} {profiled / plain:>8.1f}x')
+    print(prof.report(5))
+
+
+def bench_scaling(sizes=(100, 1000), repeat=1):
+    # a quick pass of the scaling suite; run scaling.py itself for JSON results and baselines
+    import scaling
+    scaling.run(sizes=sizes, repeat=repeat)
+
+
+def bench_stack(depths=(100, 1000, 10 ** 4, 10 ** 5), calls=(100, 1000, 2000)):
+    # nesting the recursive parser and tree walker cannot handle, and the cost of not recursing
+    print(f'{"program":>8} {"depth":>7} {"pratt+tree":>11} {"stack":>9}')
+    for kind in ('parens', 'unary', 'blocks', 'ifs'):
+        for depth in depths:
+            source = deep(kind, depth)
+            toks = list(Tokenizer(source).tokens())
+            times = list()
+            for parser, backend in ((PrattLexer, sapphire.BACKENDS['tree']), (stack.StackLexer, stack.run)):
+                try:
+                    start = time.perf_counter()
+                    backend(parser(toks).line(), {'x': 1})
+                    times.append(f'{time.perf_counter() - start:.4f}')
+                except RecursionError:
+                    times.append('recursion')
+            print(f'{kind:>8} {depth:>7} {times[0]:>11} {times[1]:>9}')
+
+    # a recursive Sapphire function: count:{n} calls itself in tail position until n is 0. Arguments
+    # are passed by name, so reading n at depth k re-evaluates k - 1 subtractions: time is quadratic
+    count = FunctionAST(['n'], program('n > 0 => count:{n - 1} !! "done"'))
+    print(f'{"calls":>8} {"tree":>9} {"closure":>9} {"stack":>9}')
+    for depth in calls:
+        times = list()
+        for name in ('tree', 'closure', 'stack'):
+            try:
+                times.append(f'{timed(sapphire.BACKENDS[name], program(f"count:{{{depth}}}"), {"count": count}):.4f}')
+            except RecursionError:
+                times.append('recursion')
+        print(f'{depth:>8} ' + ' '.join(f'{t:>9}' for t in times))
+
+
+def bench_memo(sizes=(10, 15, 20), runs=10):
+    fib = FunctionAST(['n'], program(FIB))
+    print(f'{"fib":>6} {"plain":>9} {"memoized":>9} {"speedup":>8} {"hit rate":>9}')
+    for n in sizes:
+        plain = sapphire.Interpreter()
+        interpreter = sapphire.Interpreter(memoize=True)
+        source = f'fib:{{{n}}}'
+        baseline = timed(plain.execute, source, {'fib': fib})
+        elapsed = timed(interpreter.execute, source, {'fib': fib})
+        rate = interpreter.stats()['memo']['hit_rate']
+        print(f'{n:>6} {baseline:>9.4f} {elapsed:>9.4f} {baseline / elapsed:>7.1f}x {rate:>9.2%}')
+
+    # a lookup-style helper called with a few distinct arguments, over and over and across runs
+    source = '{{ ' + ''.join(f'r :- fib:{{{i % 12}}}. ' for i in range(100)) + '}}'
+    print(f'{"runs":>6} {"plain":>9} {"memoized":>9} {"speedup":>8} {"hit rate":>9}')
+    plain = sapphire.Interpreter()
+    interpreter = sapphire.Interpreter(memoize=True)
+    baseline = timed(lambda: [plain.execute(source, {'fib': fib}) for _ in range(runs)])
+    elapsed = timed(lambda: [interpreter.execute(source, {'fib': fib}) for _ in range(runs)])
+    rate = interpreter.stats()['memo']['hit_rate']
+    print(f'{runs:>6} {baseline:>9.4f} {elapsed:>9.4f} {baseline / elapsed:>7.1f}x {rate:>9.2%}')
+
+
+def bench_boolean(rules=2000, backends=sapphire.BACKENDS):
+    # guard-heavy rules: check:{guard; value} reads `value`, an expensive call passed by name, only
+    # when the guard holds. With && the call is skipped for every rule whose guard fails; $ has to
+    # evaluate both sides, which is what && cost when its right side was not skipped
+    calls = [0]
+
+    def expensive(args, scope):
+        calls[0] += 1
+        sum(range(2000))
+        return args[0].execute(scope)
+    source = '{{ ' + ''.join(f'r :- check:{{x - {i % 10}; expensive:{{{i}}} }}. ' for i in range(rules)) + '}}'
+    ast = program(source)
+    # x is 8, so a = x - i % 10 is 8 for one rule in ten: only those read b
+    bodies = {'&&': 'a > 7 && b > 3 => 1 !! 0', '||': 'a < 8 || b > 3 => 1 !! 0', '$': 'a > 7 $ b > 3 => 1 !! 0'}
+    print(f'{"backend":>8} ' + ' '.join(f'{op:>9} {"calls":>6}' for op in bodies))
+    for name, run in backends.items():
+        row = list()
+        # compile the program once up front, so the first column does not pay for it
+        scope = bindings()
+        scope.update({'check': FunctionAST(['a', 'b'], program(bodies['&&'])), 'expensive': expensive})
+        run(ast, scope)
+        for op, body in bodies.items():
+            scope = bindings()
+            scope.update({'check': FunctionAST(['a', 'b'], program(body)), 'expensive': expensive})
+            calls[0] = 0
+            elapsed = timed(run, ast, scope)
+            row.append(f'{elapsed:>9.4f} {calls[0]:>6}')
+        print(f'{name:>8} ' + ' '.join(row))
+
+
+def bench_incremental(lines=100000, edits=300, seed=1):
+    # typing into a long script: single characters inserted and deleted at random places, each
+    # reparsed incrementally, against tokenizing and parsing all of it again
+    import random
+    generator = random.Random(seed)
+    source = '{{ ' + ''.join(f'{label(i % 50 + 1)} :- {label(i % 7 + 1)} * {i % 10} + 1.\n' if i % 10 else
+                             f'x > {i} => {{{{ y :- {i}. z :- y + 1. }}}} !! {{{{ y :- 0. }}}}.\n'
+                             for i in range(lines)) + '}}'
+    start = time.perf_counter()
+    document = incremental.Document(source)
+    parse = time.perf_counter() - start
+    digits = [m.start() for m in re.finditer(r'\d', source)]
+    latencies = {'insert': [], 'delete': [], 'newline': []}
+    for _ in range(edits):
+        offset = generator.choice(digits)
+        # a digit typed after another, then deleted again; a line break typed after a `.`
+        for kind, edit in (('insert', (offset + 1, 0, '5')), ('delete', (offset + 1, 1, '')),
+                           ('newline', (source.index('.', offset) + 1, 0, '\n'))):
+            start = time.perf_counter()
+            document.edit(*edit)
+            latencies[kind].append(time.perf_counter() - start)
+            if kind == 'newline':
+                document.edit(edit[0], 1, '')
+    print(f'{lines} lines, {len(source) / 1e6:.1f} MB: full parse {parse:.3f}s')
+    print(f'{"edit":>8} {"median ms":>10} {"max ms":>8} {"speedup":>8}')
+    for kind, times in latencies.items():
+        times.sort()
+        median = times[len(times) // 2]
+        print(f'{kind:>8} {median * 1e3:>10.3f} {times[-1] * 1e3:>8.3f} {parse / median:>7.0f}x')
+
+
+BENCHMARKS = {
+    'tokenizer': bench_tokenizer,
+    'streaming': bench_streaming,
+    'packrat': bench_packrat,
+    'parsers': bench_parsers,
+    'backends': bench_backends,
+    'closures': bench_closures,
+    'calls': bench_calls,
+    'optimizer': bench_optimizer,
+    'values': bench_values,
+    'arena': bench_arena,
+    'cache': bench_cache,
+    'interpreter': bench_interpreter,
+    'vectorize': bench_vectorize,
+    'batch': bench_batch,
+    'threads': bench_threads,
+    'asyncio': bench_asyncio,
+    'output': bench_output,
+    'profile': bench_profile,
+    'scaling': bench_scaling,
+    'stack': bench_stack,
+    'memo': bench_memo,
+    'boolean': bench_boolean,
+    'incremental': bench_incremental,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f'[{name}]')
+        BENCHMARKS[name]()
@@ -0,0 +1,86 @@
+# coding=utf-8
+import sys
+import threading
+
+
+# define builtin functions
+def builtin_print(args, inj_scope):
+    params = [arg.execute(inj_scope) for arg in args]
+    print(*params)
+
+
+def coerce(inp, kind='str'):
+    if type(eval(kind)) is not type:
+        print('{} is not a valid coercion type; returning as string'.format(kind))
+        kind = 'str'
+    return eval(kind)(inp)
+
+
+def prompt(message, kind='str'):
+    return coerce(input(message), kind)
+
+
+def builtin_prompt(args, inj_scope):
+    # prompt:{message} or prompt:{message; "int"} to coerce the answer
+    return prompt(*[arg.execute(inj_scope) for arg in args[:2]])
+
+
+class Output:
+    # where print:{} output goes: lines are collected and handed to `write` (sys.stdout's, by
+    # default) in one piece once `size` characters or `lines` lines are pending, whichever
+    # comes first, and whenever flush() is called; call it once the program has finished
+    def __init__(self, write=None, size=1 << 16, lines=None):
+        self.target = write
+        self.size = size
+        self.lines = lines
+        self.pending = list()
+        self.pending_size = 0
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        # all under the lock, so a line written while another thread flushes is never lost
+        with self.lock:
+            self.pending.append(text)
+            self.pending_size += len(text)
+            if self.pending_size >= self.size or (self.lines is not None and len(self.pending) >= self.lines):
+                self.emit()
+
+    def flush(self):
+        with self.lock:
+            self.emit()
+
+    def emit(self):
+        # hand over everything pending; called with the lock held, which also keeps the chunks
+        # of different threads in order
+        pending, self.pending = self.pending, list()
+        self.pending_size = 0
+        if pending:
+            (self.target or sys.stdout.write)(''.join(pending))
+
+    def print(self, args, inj_scope):
+        # builtin_print, writing to this output
+        self.write(' '.join([str(arg.execute(inj_scope)) for arg in args]) + '\n')
+
+    def prompt(self, args, inj_scope):
+        # builtin_prompt, showing everything printed so far before asking
+        self.flush()
+        if self.target is None:
+            sys.stdout.flush()
+        return builtin_prompt(args, inj_scope)
+
+    def builtins(self):
+        return {'print': self.print, 'prompt': self.prompt}
+
+
+class Capture(Output):
+    # keeps everything printed in memory, for embedding
+    def __init__(self, size=1 << 16, lines=None):
+        super().__init__(self.collect, size, lines)
+        self.chunks = list()
+
+    def collect(self, text):
+        self.chunks.append(text)
+
+    def getvalue(self):
+        self.flush()
+        return ''.join(self.chunks)
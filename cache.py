@@ -0,0 +1,127 @@
+# coding=utf-8
+from functools import partial
+import hashlib
+import marshal
+import os
+import struct
+import sys
+import tempfile
+
+from arena import Arena
+from tokenizer import CHUNK_SIZE
+
+
+"""
+On-disk cache of parsed programs, in the spirit of __pycache__: the first run of a script stores
+its AST, in arena form, in __sapcache__/<script>.sapc (.opt.sapc when optimized) next to it, and later runs load that instead
+of tokenizing and parsing the script again.
+
+A cache file is a fixed header followed by the marshalled arena columns:
+
+    magic       b'SAPC'
+    format      FORMAT, as a little-endian uint32
+    key         sha256 of the interpreter version and options, then the script's bytes
+
+A file whose magic, format or key does not match (the script was edited, or a different version
+or option wrote it) is simply a miss, and is overwritten. Files are written to a temporary name
+and renamed into place, so concurrent runs never see half a file.
+"""
+
+MAGIC = b'SAPC'
+# layout of the cache file; bump it whenever dump() changes
+FORMAT = 1
+# bump when parsing or optimizing changes, so cached trees from older versions are not reused
+VERSION = 2
+HEADER = struct.Struct('<4sI32s')
+DIRECTORY = '__sapcache__'
+
+
+def key(stream, optimized=False):
+    # arena columns are native arrays, so the byte order is part of the key too; the script is
+    # read from the binary stream a chunk at a time, so it is never in memory as a whole
+    digest = hashlib.sha256(f'sapphire {VERSION} {sys.implementation.cache_tag} {sys.byteorder} '
+                            f'optimize={optimized}\0'.encode())
+    for chunk in iter(partial(stream.read, CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.digest()
+
+
+def location(script, optimized=False):
+    head, tail = os.path.split(os.path.abspath(script))
+    return os.path.join(head, DIRECTORY, tail + ('.opt.sapc' if optimized else '.sapc'))
+
+
+def dump(store, root, digest):
+    columns = (store.kind, store.op, store.a, store.b, store.c, store.lists)
+    body = marshal.dumps((root, [col.tobytes() for col in columns], store.pool))
+    return HEADER.pack(MAGIC, FORMAT, digest) + body
+
+
+def load(data, digest):
+    # the (arena, root) stored in data, or None if it is stale or not a cache file at all
+    if len(data) < HEADER.size or HEADER.unpack_from(data) != (MAGIC, FORMAT, digest):
+        return None
+    try:
+        root, columns, pool = marshal.loads(data[HEADER.size:])
+        store = Arena()
+        for col, raw in zip((store.kind, store.op, store.a, store.b, store.c, store.lists), columns):
+            col.frombytes(raw)
+    except (EOFError, ValueError, TypeError):
+        return None
+    store.pool = pool
+    return store, root
+
+
+def umask():
+    # the process umask, which can only be read by setting it
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+
+def write(path, data, mode=0o666):
+    # write to a temporary file in the same directory, then rename it over the old one. mkstemp
+    # creates it readable by its owner only, so it gets `mode` less the umask first, as a file
+    # created with open() would, or other users of the script would never find a cache they can read
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp, mode & ~umask())
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def compile_file(script, parse, optimize=None):
+    # the AST of a script: from its cache file if it is up to date, otherwise from
+    # parse(stream) (then optimize(ast), if given), which is then cached for next time;
+    # returns the AST and whether it came from the cache. `stream` is the script opened in
+    # binary mode, for a Tokenizer to read chunk by chunk
+    path = location(script, optimize is not None)
+    with open(script, 'rb') as source:
+        digest = key(source, optimize is not None)
+        try:
+            with open(path, 'rb') as f:
+                cached = load(f.read(), digest)
+        except OSError:
+            cached = None
+        if cached is not None:
+            store, root = cached
+            return store.tree(root), True
+        # as importlib does for .pyc files: whoever can read the script can read its cache
+        mode = (os.fstat(source.fileno()).st_mode | 0o200) & 0o666
+        source.seek(0)
+        ast = parse(source)
+    if optimize is not None:
+        ast = optimize(ast)
+    store = Arena()
+    try:
+        write(path, dump(store, store.add(ast), digest), mode)
+    except OSError:
+        # a read-only directory only costs us the cache, as with __pycache__
+        pass
+    return ast, False
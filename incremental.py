@@ -0,0 +1,439 @@
+# coding=utf-8
+import re
+from bisect import bisect_right
+from inspect import isgenerator
+from itertools import accumulate, chain
+
+from tokenizer import *
+from tokenizer import MASTER
+from asts import *
+from asts import children
+from pratt import PrattLexer
+from stack import drive
+
+
+"""
+Incremental reparsing, for editors and long-lived sessions that change a script a little at a time.
+
+A Document holds a script's text, tokens and AST. Document.edit(offset, deleted, inserted) applies
+a change to the text and brings the tokens and AST up to date without going over the whole script
+again: it finds the innermost `{{ ... }}` block the change lies inside, re-lexes just the lines of
+that block around the change and parses them, and builds a new BlockAST for the block that shares
+every other line's subtree with the old one. The nodes from that block up to the root are copied
+rather than modified, since compiled closures and other caches are keyed by node; everything else
+is reused as it is.
+
+If the changed lines do not lex, or no longer form whole statements each ending in `.` (say a `.`,
+a quote, or a `{{` or `}}` was typed), the same is tried with the line of the enclosing block
+that holds this one, and so on out; an edit outside every block parses the whole text again, as
+does the first edit after one that left the script broken. Either way the result is exactly what
+parsing the new text from scratch gives, TokenError included.
+
+Where each line and block starts is kept as the width of every line in its block, not as token
+offsets, so an edit only changes the widths of the blocks it is in. The line and column of the
+tokens and atoms after the re-lexed lines are moved by the edit, as the profiler and anything else
+showing positions needs them to be: all of them when it adds or removes line breaks, otherwise
+just those on the line it ends on.
+"""
+
+NEWLINE = re.compile('\n')
+# what a line's tokens are followed by when it is parsed on its own
+END = Token(TokenType.EOF)
+
+
+class Block:
+    # a `{{ ... }}`: its lines, and how wide each is in characters, so where something is can be
+    # found by adding up widths rather than keeping the offset of every token up to date
+    __slots__ = ('ast', 'open', 'close', 'lines', 'widths', 'tail', 'width')
+
+    def __init__(self, open):
+        self.ast = None
+        self.open = open
+        self.close = None
+        self.lines = list()
+        # each line runs from the end of the one before (or of `{{`) to the end of its `.`
+        self.widths = list()
+        # from the end of the last line to the end of `}}`, and from `{{` to the end of `}}`
+        self.tail = 0
+        self.width = 0
+
+
+class Line:
+    # a statement of a block and its `.`, or the whole script at the root
+    __slots__ = ('ast', 'parts', 'blocks', 'width')
+
+    def __init__(self):
+        self.ast = None
+        # its tokens, a Block standing in for all the tokens of each block in it
+        self.parts = list()
+        # [offset from the start of the line, Block] of the blocks directly in it
+        self.blocks = list()
+        self.width = 0
+
+
+def lex(text, start, stop):
+    # the tokens of text[start:stop], with their line and column in all of text, and the offset
+    # in text where each of them starts
+    tokenizer = Tokenizer(text[start:stop])
+    tokenizer.base = start
+    tokenizer.line = first = text.count('\n', 0, start) + 1
+    tokenizer.line_start = text.rfind('\n', 0, start) + 1
+    # where each line the tokens can be on starts
+    lines = [tokenizer.line_start] + [m.end() for m in NEWLINE.finditer(text, start, stop)]
+    tokens = list(tokenizer.scan(tokenizer.stream, True))
+    return tokens, [lines[tok.line - first] + tok.column - 1 for tok in tokens]
+
+
+def eof(text):
+    # the EOF token Tokenizer ends text with
+    return Token(TokenType.EOF, None, text.count('\n') + 1, len(text) - text.rfind('\n'))
+
+
+def segment(tokens, starts, start):
+    # split tokens (the first line starting at offset `start`) into lines at the `.`s outside any
+    # block, building the blocks inside each line. Returns the lines, the token range of each,
+    # a line of the tokens after the last `.` and where it starts; None if the blocks do not match
+    lines = list()
+    spans = list()
+    line = Line()
+    begin = start
+    index = 0
+    block = None
+    opened = None
+    outer = list()
+    for i, (tok, pos) in enumerate(zip(tokens, starts)):
+        t = tok.type
+        if t is TokenType.LBLK:
+            inner = Block(tok)
+            line.parts.append(inner)
+            line.blocks.append([pos - begin, inner])
+            outer.append((line, begin, block, opened))
+            line, begin, block, opened = Line(), pos + 2, inner, pos
+        elif t is TokenType.RBLK:
+            # a block's last statement without its `.` would not parse either
+            if block is None or line.parts:
+                return None
+            block.close = tok
+            block.tail = pos + 2 - begin
+            block.width = pos + 2 - opened
+            line, begin, block, opened = outer.pop()
+        elif t is TokenType.TERM:
+            line.parts.append(tok)
+            line.width = pos + 1 - begin
+            if block is None:
+                lines.append(line)
+                spans.append((index, i + 1))
+                index = i + 1
+            else:
+                block.lines.append(line)
+                block.widths.append(line.width)
+            line, begin = Line(), pos + 1
+        else:
+            line.parts.append(tok)
+    if block is not None:
+        return None
+    return lines, spans, line, begin
+
+
+def inner(ast):
+    # the blocks in ast not inside another block, in the order they appear in the script
+    found = list()
+    todo = [ast]
+    while todo:
+        node = todo.pop()
+        if type(node) is BlockAST:
+            found.append(node)
+        else:
+            todo.extend(reversed(children(node)))
+    return found
+
+
+def attach(line, ast):
+    # hand the nodes of ast to the line and the blocks in it; False if they do not match up
+    todo = [(line, ast)]
+    while todo:
+        line, ast = todo.pop()
+        line.ast = ast
+        found = inner(ast)
+        if len(found) != len(line.blocks):
+            return False
+        for (_, block), node in zip(line.blocks, found):
+            if len(node.lines) != len(block.lines):
+                return False
+            block.ast = node
+            todo.extend(zip(block.lines, node.lines))
+    return True
+
+
+def flatten(line):
+    # every token of a line, those of the blocks in it included
+    tokens = list()
+    todo = [iter(line.parts)]
+    while todo:
+        for part in todo[-1]:
+            if type(part) is Block:
+                tokens.append(part.open)
+                todo.append(chain(chain.from_iterable(child.parts for child in part.lines), [part.close]))
+                break
+            tokens.append(part)
+        else:
+            todo.pop()
+    return tokens
+
+
+def rebuild(node, old, new):
+    # a copy of node with its child `old` replaced by `new`
+    swap = lambda child: new if child is old else child
+    kind = type(node)
+    if kind is ExpressionAST:
+        return ExpressionAST(node.op, swap(node.lhs), swap(node.rhs))
+    if kind is AssignmentAST:
+        return AssignmentAST(node.dest, swap(node.val))
+    if kind is ConditionalAST:
+        return ConditionalAST(swap(node.cond), swap(node.yes), swap(node.no))
+    if kind is CallAST:
+        return CallAST(node.name, [swap(arg) for arg in node.args])
+    return BlockAST([swap(line) for line in node.lines])
+
+
+def replace(ast, old, new):
+    # ast with the block `old` in it replaced by `new`, copying only the nodes above it
+    parents = dict()
+    todo = [ast]
+    while todo:
+        node = todo.pop()
+        if node is old:
+            break
+        if type(node) is not BlockAST:
+            for child in children(node):
+                parents[id(child)] = node
+                todo.append(child)
+    else:
+        raise ValueError('block not found')
+    while old is not ast:
+        parent = parents[id(old)]
+        old, new = parent, rebuild(parent, old, new)
+    return new
+
+
+class Document:
+    def __init__(self, text='', parser=PrattLexer):
+        # parser is PrattLexer or stack.StackLexer, which can parse a statement on its own
+        self.parser = parser
+        self.text = text
+        self.root = None
+        self.ast = None
+        # edits made, and how many of them (or the first parse) went over the whole text
+        self.edits = 0
+        self.full = 0
+        # characters re-lexed by the last edit
+        self.relexed = 0
+        self.parse()
+
+    @property
+    def tokens(self):
+        # the tokens of the text, EOF included, or None while it does not parse
+        if self.root is None:
+            return None
+        return flatten(self.root) + [eof(self.text)]
+
+    def parse(self):
+        # tokenize and parse the whole text
+        text = self.text
+        self.root = self.ast = None
+        self.full += 1
+        self.relexed = len(text)
+        tokens, starts = lex(text, 0, len(text))
+        lexer = self.parser(tokens + [eof(text)])
+        ast = lexer.line()
+        # the root line holds the statement that was parsed, and what comes after it as it is
+        found = segment(tokens[:lexer.ptr], starts[:lexer.ptr], 0)
+        if found is not None and not found[0]:
+            root = found[2]
+            root.parts += tokens[lexer.ptr:]
+        if found is None or found[0] or not attach(root, ast):
+            # no blocks to reparse on their own: every edit parses the whole text
+            root = Line()
+            root.parts = tokens
+            root.ast = ast
+        root.width = len(text)
+        self.root = root
+        self.ast = ast
+        return ast
+
+    def edit(self, offset, deleted, inserted):
+        # delete `deleted` characters at `offset` and insert `inserted` there; returns the new AST,
+        # or raises TokenError if the new text does not parse
+        text = self.text
+        end = offset + deleted
+        if not 0 <= offset <= end <= len(text):
+            raise ValueError(f'edit of {offset}:{end} outside a text of {len(text)} characters')
+        self.text = text[:offset] + inserted + text[end:]
+        self.edits += 1
+        if self.root is None:
+            return self.parse()
+        # what the edit does to positions after it: (the line it ends on before the edit, lines
+        # added, columns added to the rest of that line)
+        after = offset + len(inserted)
+        moved = (text.count('\n', 0, end) + 1, inserted.count('\n') - text.count('\n', offset, end),
+                 (after - self.text.rfind('\n', 0, after)) - (end - text.rfind('\n', 0, end)))
+        path = self.locate(offset, end)
+        while path:
+            if self.reparse(path, len(inserted) - deleted, moved):
+                return self.ast
+            # the block as a whole is a line of the one around it: try that one's lines
+            path.pop()
+        return self.parse()
+
+    def locate(self, start, end):
+        # the blocks the change of text[start:end] lies inside, outermost first, as [block,
+        # where it starts, first and last line touched (len(lines) for the tail), line ends]
+        path = list()
+        line, base = self.root, 0
+        while True:
+            for offset, block in line.blocks:
+                opened = base + offset
+                if opened + 2 <= start and end <= opened + block.width - 2:
+                    break
+            else:
+                return path
+            ends = list(accumulate(block.widths, initial=opened + 2))
+            first = bisect_right(ends, start) - 1
+            last = bisect_right(ends, max(start, end - 1)) - 1
+            path.append([block, opened, first, last, ends])
+            if first != last or first == len(block.lines):
+                return path
+            line, base = block.lines[first], ends[first]
+
+    def reparse(self, path, delta, moved):
+        # re-lex and parse the lines touched in the innermost block on path, along with the line
+        # before and after (a `.` added or removed changes where they end) and splice them in.
+        # False, with nothing changed, if they do not make whole statements
+        block, opened, first, last, ends = path[-1]
+        count = len(block.lines)
+        lo = max(first - 1, 0)
+        hi = min(last + 2, count)
+        start = ends[lo]
+        # up to the `}}` if the last line is in it, since lines can be typed after it too
+        stop = (opened + block.width - 2 if hi == count else ends[hi]) + delta
+        text = self.text
+        try:
+            tokens, starts = lex(text, start, stop)
+        except TokenError:
+            return False
+        # a token at the very end could run on into what follows, as `}` does into `}}`
+        if tokens and MASTER.match(text, starts[-1]).end() != MASTER.match(text, starts[-1], stop).end():
+            return False
+        found = segment(tokens, starts, start)
+        if found is None:
+            return False
+        lines, spans, rest, begin = found
+        if rest.parts or (hi < count and begin != stop):
+            return False
+        for line, (i, j) in zip(lines, spans):
+            lexer = self.parser(tokens[i:j] + [END])
+            ast = lexer.statement()
+            if isgenerator(ast):
+                ast = drive(ast)
+            if ast is None or lexer.ptr != j - i - 1 or not attach(line, ast):
+                return False
+        self.relexed = stop - start
+        self.move(path, hi, moved)
+
+        old = block.ast
+        block.lines[lo:hi] = lines
+        block.widths[lo:hi] = [line.width for line in lines]
+        if hi == count:
+            block.tail = stop + 2 - begin
+        block.width += delta
+        nodes = list(old.lines)
+        nodes[lo:hi] = [line.ast for line in lines]
+        new = block.ast = BlockAST(nodes)
+        # the blocks around it get wider, and copies of the nodes leading down to it
+        for outer, _, index, _, _ in reversed(path[:-1]):
+            line = outer.lines[index]
+            self.widen(line, block, delta)
+            line.ast = replace(line.ast, old, new)
+            outer.widths[index] += delta
+            outer.width += delta
+            lines = list(outer.ast.lines)
+            lines[index] = line.ast
+            old, new = outer.ast, BlockAST(lines)
+            outer.ast, block = new, outer
+        self.widen(self.root, block, delta)
+        self.root.ast = self.ast = replace(self.root.ast, old, new)
+        return True
+
+    def move(self, path, hi, moved):
+        # give the tokens and atoms after the lines up to `hi` of the innermost block on path the
+        # positions `moved` (see edit()) puts them at, before those lines are replaced
+        end, lines, columns = moved
+
+        def position(line, column):
+            return line + lines, column + columns if line == end else column
+
+        def tokens(line):
+            # False once past the last token that moves
+            for tok in flatten(line):
+                if not lines and tok.line > end:
+                    return False
+                tok.line, tok.column = position(tok.line, tok.column)
+            return True
+
+        def atoms(ast, skip=None, opened=None):
+            # those of ast, less the ones in skip or before `opened`
+            todo = [ast]
+            while todo:
+                node = todo.pop()
+                if node is skip:
+                    continue
+                if type(node) is AtomAST:
+                    if node.position is not None and (opened is None or node.position > opened):
+                        node.position = position(*node.position)
+                else:
+                    todo.extend(children(node))
+
+        block = path[-1][0]
+        rest = Line()
+        rest.parts = [block.close]
+        for line in block.lines[hi:] + [rest]:
+            atoms(line.ast)
+            if not tokens(line):
+                return
+        for outer, _, index, _, _ in reversed(path[:-1]):
+            inner, block = block, outer
+            # what follows the inner block in the line that holds it, then the lines after that
+            line = outer.lines[index]
+            atoms(line.ast, inner.ast, (inner.open.line, inner.open.column))
+            rest.parts = line.parts[line.parts.index(inner) + 1:]
+            if not tokens(rest):
+                return
+            rest.parts = [block.close]
+            for line in block.lines[index + 1:] + [rest]:
+                atoms(line.ast)
+                if not tokens(line):
+                    return
+        atoms(self.root.ast, block.ast, (block.open.line, block.open.column))
+        rest.parts = self.root.parts[self.root.parts.index(block) + 1:]
+        tokens(rest)
+
+    @staticmethod
+    def widen(line, block, delta):
+        # block, in line, changed width: the line does too, and the blocks after it in it move
+        line.width += delta
+        seen = False
+        for entry in line.blocks:
+            if seen:
+                entry[0] += delta
+            seen = seen or entry[1] is block
+
+
+if __name__ == '__main__':
+    source = '{{ x :- 3.\n  y :- x * (4 + 1).\n  y > 10 => {{ print:{y}. }} !! {{ print:{x}. }}.\n}}'
+    document = Document(source)
+    print(document.ast)
+    # make it `x * (4 + 12)`, then print y twice
+    document.edit(source.index('1)'), 1, '12')
+    print(document.ast, f'({document.relexed} characters re-lexed)')
+    document.edit(document.text.index('print:{y}.') + len('print:{y}.'), 0, ' print:{y}.')
+    print(document.ast, f'({document.relexed} characters re-lexed)')
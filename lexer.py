@@ -1,4 +1,6 @@
 # coding=utf-8
+from functools import wraps
+
 from tokenizer import *
 from asts import *
 
@@ -36,13 +38,60 @@ expr = atom | (expr) | expr op expr
 #             raise Exception("Expected ')'!")
 #
 
+def memoized(rule):
+    # packrat memoization: remember what `rule` produced at each token position (the AST and where
+    # it stopped, or the error it failed with) so backtracking never re-parses the same tokens
+    @wraps(rule)
+    def parse(self):
+        memo = self.memo
+        if memo is None:
+            return rule(self)
+        key = (rule, self.ptr)
+        entry = memo.get(key)
+        if entry is not None:
+            self.hits += 1
+            ast, end = entry
+            if end is None:
+                raise TokenError(ast)
+            self.ptr = end
+            return ast
+        self.misses += 1
+        try:
+            ast = rule(self)
+        except TokenError as e:
+            self.remember(key, (str(e), None))
+            raise
+        self.remember(key, (ast, self.ptr))
+        return ast
+    return parse
+
+
 class Lexer:
-    def __init__(self, tokens):
+    def __init__(self, tokens, packrat=False, memo_limit=1 << 20):
         self.tokens = tokens
         self.ptr = 0
         self.saved = list()
         self.parsed = None
 
+        # packrat mode is opt-in; memo_limit bounds the number of remembered (rule, position) results
+        self.memo = dict() if packrat else None
+        self.memo_limit = memo_limit
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def remember(self, key, entry):
+        memo = self.memo
+        if len(memo) >= self.memo_limit:
+            # results are looked up close to where they were produced, so drop the oldest first
+            del memo[next(iter(memo))]
+            self.evictions += 1
+        memo[key] = entry
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.memo) if self.memo is not None else 0}
+
     def save(self):
         self.saved.append(self.ptr)
 
@@ -58,6 +107,7 @@ class Lexer:
     def expect(self, tok):
         raise TokenError(f'Expected {tok}, received {self.tokens[self.ptr].type}')
 
+    @memoized
     def atom(self):
         try:
             self.save()
@@ -77,12 +127,15 @@ class Lexer:
 
         try:
             self.save()
-            return AtomAST(self.eat(TokenType.ID))
+            tok = self.eat(TokenType.ID)
+            self.saved.pop()
+            return AtomAST(tok)
         except TokenError:
             self.reset()
 
         self.expect('atom')
 
+    @memoized
     def expression(self):
         def thing():
             try:
@@ -144,12 +197,14 @@ class Lexer:
 
         self.expect('expression')
 
+    @memoized
     def assignment(self):
         dest = self.eat(TokenType.ID)
         self.eat(TokenType.ASSIGN)
         val = self.line()
         return AssignmentAST(dest, val)
 
+    @memoized
     def boolean(self):
         def singleBool():
             try:
@@ -219,6 +274,7 @@ class Lexer:
 
         self.expect('boolean')
 
+    @memoized
     def conditional(self):
         try:
             self.save()
@@ -250,6 +306,7 @@ class Lexer:
 
         self.expect('conditional')
 
+    @memoized
     def callFunc(self):
         name = self.eat(TokenType.ID)
         self.eat(TokenType.LARG)
@@ -264,6 +321,7 @@ class Lexer:
 
         return CallAST(name, args)
 
+    @memoized
     def line(self):
         try:
             self.save()
@@ -273,37 +331,48 @@ class Lexer:
                 lines.append(self.line())
                 self.eat(TokenType.TERM)
             self.eat(TokenType.RBLK)
+            self.saved.pop()
             return BlockAST(lines)
         except TokenError:
             self.reset()
 
         try:
             self.save()
-            return self.callFunc()
+            ast = self.callFunc()
+            self.saved.pop()
+            return ast
         except TokenError:
             self.reset()
 
         try:
             self.save()
-            return self.conditional()
+            ast = self.conditional()
+            self.saved.pop()
+            return ast
         except TokenError:
             self.reset()
 
         try:
             self.save()
-            return self.assignment()
+            ast = self.assignment()
+            self.saved.pop()
+            return ast
         except TokenError:
             self.reset()
 
         try:
             self.save()
-            return self.boolean()
+            ast = self.boolean()
+            self.saved.pop()
+            return ast
         except TokenError:
             self.reset()
 
         try:
             self.save()
-            return self.expression()
+            ast = self.expression()
+            self.saved.pop()
+            return ast
         except TokenError:
             self.reset()
 
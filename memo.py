@@ -0,0 +1,254 @@
+# coding=utf-8
+import threading
+from weakref import WeakKeyDictionary
+
+from tokenizer import *
+from asts import *
+from asts import children, nodes
+
+
+"""
+Memoization of pure user functions, for Interpreter(memoize=True).
+
+Before a run, the program and the user functions in its scope are analysed. A function is pure
+when its body only reads its parameters and the names it has already assigned itself, and only
+calls functions that are pure in turn (so no print, prompt or other builtin, and no reads or
+writes of anyone else's variables). Each pure function is then replaced, for that run, by a
+Memoized wrapper that evaluates the arguments and looks their values up in a cache shared by every
+run of the interpreter, running the body only on a miss.
+
+Arguments are normally passed by name and evaluated every time the parameter is read; a memoized
+call evaluates each of them exactly once, up front. That is only the same when evaluating an
+argument has no effects of its own, so a pure function is memoized only if no call to it anywhere
+in the program or in a user function passes an argument that assigns, calls anything impure or
+reads a parameter of a function that is not memoized itself. An argument that fails to evaluate, or whose value
+cannot be a cache key, sends the call down the normal path, so errors stay exactly where they were.
+
+Cached results are keyed on the function together with the functions it calls (as bound in the
+run's scope), so a later run that binds a name differently never sees results computed with the
+old binding.
+"""
+
+
+class Analysis:
+    # purity of the user functions bound in one scope
+    def __init__(self, scope):
+        self.functions = {name: val for name, val in scope.items() if type(val) is FunctionAST}
+        # name -> names of the functions its body calls, or None if it is impure on its own
+        self.callees = {name: self.local(func) for name, func in self.functions.items()}
+        self.pure = self.close()
+
+    def local(self, func):
+        # the names func calls if its body passes every check not involving other functions
+        callees = set()
+        if self.reads(func.body, frozenset(func.argNames), callees) is not None:
+            return callees
+        return None
+
+    def reads(self, ast, defined, callees):
+        # whether ast only reads `defined` names (and what its lines assign as it goes), collecting
+        # the names it calls; returns the names defined afterwards, or None
+        kind = type(ast)
+        if kind is AtomAST:
+            if ast.type is TokenType.ID and ast.val not in defined:
+                return None
+            return defined
+        if kind is ExpressionAST:
+            for child in children(ast):
+                if self.reads(child, defined, callees) is None:
+                    return None
+            return defined
+        if kind is AssignmentAST:
+            if self.reads(ast.val, defined, callees) is None:
+                return None
+            return defined | {ast.dest.value}
+        if kind is BlockAST:
+            for line in ast.lines:
+                defined = self.reads(line, defined, callees)
+                if defined is None:
+                    return None
+            return defined
+        if kind is ConditionalAST:
+            if self.reads(ast.cond, defined, callees) is None:
+                return None
+            yes = self.reads(ast.yes, defined, callees)
+            no = defined if ast.no is None else self.reads(ast.no, defined, callees)
+            if yes is None or no is None:
+                return None
+            return yes & no
+        if kind is CallAST:
+            name = ast.name.value
+            # a parameter or local holding a function could be anything
+            if name in defined or name not in self.functions:
+                return None
+            callees.add(name)
+            for arg in ast.args:
+                # arguments run whenever the callee reads them, so may not assign even locally
+                if any(nodes(arg, AssignmentAST)) or self.reads(arg, defined, callees) is None:
+                    return None
+            return defined
+        return None
+
+    def close(self):
+        # the pure functions: impure on their own, or calling an impure one, makes a function impure
+        pure = {name for name, callees in self.callees.items() if callees is not None}
+        changed = True
+        while changed:
+            changed = False
+            for name in list(pure):
+                if not self.callees[name] <= pure:
+                    pure.discard(name)
+                    changed = True
+        return pure
+
+    def reachable(self, name):
+        # name and every function it can end up calling
+        seen = {name}
+        stack = [name]
+        while stack:
+            for callee in self.callees[stack.pop()] or ():
+                if callee not in seen:
+                    seen.add(callee)
+                    stack.append(callee)
+        return seen
+
+    def shadowed(self, program):
+        # names that may be bound to something else than the function of that name while a call
+        # is running: calls are looked up through the caller's frames, and a memoized body's
+        # calls only in the global scope, so these would resolve differently
+        names = {node.dest.value for node in nodes(program, AssignmentAST)}
+        for func in self.functions.values():
+            names.update(func.argNames)
+            names.update(node.dest.value for node in nodes(func.body, AssignmentAST))
+        return names
+
+    def effects(self, arg, params):
+        # whether evaluating an argument could do more than compute a value; `params` are the
+        # parameters of the unmemoized function it is passed from, whose arguments could do anything
+        if any(nodes(arg, AssignmentAST)):
+            return True
+        for call in nodes(arg, CallAST):
+            if call.name.value not in self.pure:
+                return True
+        return any(node.type is TokenType.ID and node.val in params for node in nodes(arg, AtomAST))
+
+    def memoizable(self, program):
+        # the pure functions whose every call passes arguments without effects; a function that is
+        # not memoized takes its arguments by name, so reading its parameters counts as an effect
+        memoized = {name for name in self.pure if not self.reachable(name) & self.shadowed(program)}
+        while True:
+            unsafe = set()
+            bodies = [(program, frozenset())]
+            bodies += [(func.body, frozenset() if name in memoized else frozenset(func.argNames))
+                       for name, func in self.functions.items()]
+            for body, params in bodies:
+                for call in nodes(body, CallAST):
+                    name = call.name.value
+                    if name in memoized and any(self.effects(arg, params) for arg in call.args):
+                        unsafe.add(name)
+            if not unsafe:
+                return memoized
+            memoized = memoized - unsafe
+
+
+class Memoized:
+    # stands in for a pure FunctionAST for one run; called like a builtin, as builtin(args, scope)
+    __slots__ = ('func', 'key', 'memo', 'scope')
+
+    def __init__(self, func, key, memo, scope):
+        self.func = func
+        # the function and the functions it calls, which is what its results depend on
+        self.key = key
+        self.memo = memo
+        # the run's global scope, where the functions it calls are bound
+        self.scope = scope
+
+    def __call__(self, args, scope):
+        func = self.func
+        names = func.argNames
+        if len(args) < len(names):
+            # a missing parameter is looked up in the caller's scope: not pure after all
+            return func(args, scope)
+        try:
+            values = tuple([arg.execute(scope) for arg in args[:len(names)]])
+            # with their types, since 1, 1.0 and True are equal keys but not the same result
+            key = (self.key, tuple([(type(value), value) for value in values]))
+            hash(key)
+        except Exception:
+            return func(args, scope)
+        found, result = self.memo.get(key)
+        if found:
+            return result
+        result = evaluate(func.body, Frame(self.scope, zip(names, values)))
+        self.memo.put(key, result)
+        return result
+
+
+class Memo:
+    # results of pure function calls, shared by every run of an interpreter, least recently used
+    # evicted first once there are more than `size`; plans are kept for at most `plans` sets of
+    # bindings per program, evicted the same way
+    def __init__(self, size=4096, plans=256):
+        self.size = size
+        self.plan_size = plans
+        self.results = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # per program: per set of function bindings, which functions to memoize and their keys
+        self.plans = WeakKeyDictionary()
+
+    def get(self, key):
+        results = self.results
+        with self.lock:
+            if key in results:
+                self.hits += 1
+                # move it to the end, which is where the most recently used entries are
+                result = results[key] = results.pop(key)
+                return True, result
+            self.misses += 1
+            return False, None
+
+    def put(self, key, result):
+        results = self.results
+        with self.lock:
+            results[key] = result
+            while len(results) > self.size:
+                del results[next(iter(results))]
+                self.evictions += 1
+
+    def plan(self, program, scope):
+        # name -> cache key of every function to memoize when running program in scope
+        bound = frozenset((name, val) for name, val in scope.items() if type(val) is FunctionAST)
+        with self.lock:
+            plans = self.plans.get(program)
+            if plans is None:
+                plans = self.plans[program] = dict()
+            plan = plans.pop(bound, None)
+            if plan is not None:
+                plans[bound] = plan
+                return plan
+        analysis = Analysis(scope)
+        plan = {
+            name: frozenset((callee, analysis.functions[callee]) for callee in analysis.reachable(name))
+            for name in analysis.memoizable(program)
+        }
+        with self.lock:
+            plans[bound] = plan
+            while len(plans) > self.plan_size:
+                # each plan holds on to its functions, so bindings made fresh for every run must
+                # not pile up
+                del plans[next(iter(plans))]
+        return plan
+
+    def install(self, program, scope):
+        # replace the memoizable functions in scope by their Memoized wrappers
+        for name, key in self.plan(program, scope).items():
+            scope[name] = Memoized(scope[name], key, self, scope)
+
+    def stats(self):
+        with self.lock:
+            calls = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.results), 'hit_rate': self.hits / calls if calls else 0.0}
@@ -0,0 +1,218 @@
+# coding=utf-8
+from collections import Counter
+
+from tokenizer import *
+from asts import *
+from stack import drive
+
+
+"""
+AST optimizer, run between parsing and execution. It only produces ordinary AST nodes, so the
+result runs on every backend:
+
+- constant folding: operators applied to literals are computed once, unless the result would be
+  large (a program may well never reach an expression like 9 ^ (9 ^ 9), and folding it would
+  take the optimizer longer than the whole run)
+- dead branches: conditionals on a literal condition are replaced by the branch that runs, and
+  && or || with a literal left side by whichever side gives the result
+- nested blocks are flattened into their parent, and single-line blocks replaced by their line
+
+Every rule is a generator run by stack.drive, as StackLexer's are, so programs nested too deeply
+for Python's stack optimize too.
+- identities: unary + becomes its operand. Binary ones such as x + 0 or x * 1 are left alone:
+  x may be a string (where + 0 raises) or a comparison's bool (where * 1 gives an int), and an
+  operand that is provably a number is made of literals, so it has been folded already
+"""
+
+
+# the limits of CPython's own constant folder (Python/ast_opt.c): folded ints have at most this many
+# bits and folded strings at most this many characters
+MAX_INT_SIZE = 128
+MAX_STR_SIZE = 4096
+
+
+def small(val):
+    if type(val) is str:
+        return len(val) <= MAX_STR_SIZE
+    if isinstance(val, int):
+        return val.bit_length() <= MAX_INT_SIZE
+    return True
+
+
+def foldable(op, lhs, rhs):
+    # whether computing op on two literals is cheap; checked before computing it, since ^ and *
+    # can take arbitrarily long to build their result
+    if op is TokenType.EXP and isinstance(lhs, int) and isinstance(rhs, int) and lhs and rhs > 0:
+        return lhs.bit_length() * rhs <= MAX_INT_SIZE
+    if op is TokenType.MUL:
+        if isinstance(lhs, int) and isinstance(rhs, int) and lhs and rhs:
+            return lhs.bit_length() + rhs.bit_length() <= MAX_INT_SIZE
+        if type(lhs) is str and isinstance(rhs, int):
+            return len(lhs) * rhs <= MAX_STR_SIZE
+        if isinstance(lhs, int) and type(rhs) is str:
+            return lhs * len(rhs) <= MAX_STR_SIZE
+    return small(lhs) and small(rhs)
+
+
+def literal(ast):
+    return type(ast) is AtomAST and ast.type is not TokenType.ID
+
+
+def atom(val):
+    if type(val) is str:
+        return AtomAST(Token(TokenType.STR, val))
+    if type(val) in (int, float, bool):
+        return AtomAST(Token(TokenType.NUM, val))
+    return None
+
+
+def pieces(ast):
+    # str(ast) a piece at a time, off an explicit stack so any depth of tree renders
+    stack = [ast]
+    while stack:
+        item = stack.pop()
+        kind = type(item)
+        if kind is ExpressionAST:
+            parts = ['(', str(item.op), ' ', item.lhs, ' ', item.rhs, ')']
+        elif kind is AssignmentAST:
+            parts = ['[', str(item.dest), ' <- ', item.val, ']']
+        elif kind is BlockAST:
+            parts = ['['] + [part for line in item.lines for part in (line, ' ')][:-1] + [']']
+        elif kind is ConditionalAST:
+            parts = ['(IF ', item.cond, ' ', item.yes, ' ', item.no, ')']
+        elif kind is CallAST:
+            parts = [f'({item.name.value} '] + [part for arg in item.args for part in (arg, ' ')][:-1] + [')']
+        else:
+            yield str(item)
+            continue
+        stack.extend(reversed(parts))
+
+
+def brief(ast, limit=120):
+    # str(ast), cut short after `limit` characters
+    text = list()
+    size = 0
+    for piece in pieces(ast):
+        text.append(piece)
+        size += len(piece)
+        if size > limit:
+            return ''.join(text)[:limit] + '...'
+    return ''.join(text)
+
+
+class Optimizer:
+    def __init__(self):
+        self.changes = list()
+
+    def note(self, kind, before, after):
+        # the nodes themselves, only turned into text if a report is asked for
+        self.changes.append((kind, before, after))
+        return after
+
+    def summary(self):
+        counts = Counter(kind for kind, _, _ in self.changes)
+        return '\n'.join(f'{count:>6} {kind}' for kind, count in counts.most_common())
+
+    def report(self):
+        details = [f'{kind}: {brief(before)} => {brief(after)}' for kind, before, after in self.changes]
+        return '\n'.join([self.summary()] + details)
+
+    def optimize(self, ast):
+        return drive(self.visit(ast))
+
+    def visit(self, ast):
+        kind = type(ast)
+        if kind is ExpressionAST:
+            return (yield self.expression(ast))
+        if kind is AssignmentAST:
+            val = yield self.visit(ast.val)
+            return ast if val is ast.val else AssignmentAST(ast.dest, val)
+        if kind is BlockAST:
+            return (yield self.block(ast))
+        if kind is ConditionalAST:
+            return (yield self.conditional(ast))
+        if kind is CallAST:
+            args = list()
+            for arg in ast.args:
+                args.append((yield self.visit(arg)))
+            if all(new is old for new, old in zip(args, ast.args)):
+                return ast
+            return CallAST(ast.name, args)
+        return ast
+
+    def expression(self, ast):
+        op = ast.op.type
+        lhs = None if ast.lhs is None else (yield self.visit(ast.lhs))
+        rhs = yield self.visit(ast.rhs)
+
+        if lhs is None and op in UNARY:
+            if op is TokenType.ADD:
+                return self.note('identity', ast, rhs)
+            if literal(rhs):
+                folded = atom(UNARY[op](rhs.val))
+                if folded is not None:
+                    return self.note('fold', ast, folded)
+        elif op in BINARY:
+            if literal(lhs) and literal(rhs) and foldable(op, lhs.val, rhs.val):
+                try:
+                    val = BINARY[op](lhs.val, rhs.val)
+                    folded = atom(val) if small(val) else None
+                except (ArithmeticError, TypeError, ValueError):
+                    # leave it to fail at run time, as it would have
+                    folded = None
+                if folded is not None:
+                    return self.note('fold', ast, folded)
+        elif op in SHORT_CIRCUIT and literal(lhs):
+            # a literal left side decides on its own, or leaves the result to the right side
+            if bool(lhs.val) is SHORT_CIRCUIT[op]:
+                return self.note('short circuit', ast, lhs)
+            return self.note('short circuit', ast, rhs)
+
+        if lhs is ast.lhs and rhs is ast.rhs:
+            return ast
+        return ExpressionAST(ast.op, lhs, rhs)
+
+    def block(self, ast):
+        lines = list()
+        changed = False
+        for i, line in enumerate(ast.lines):
+            new = yield self.visit(line)
+            last = i == len(ast.lines) - 1
+            if type(new) is BlockAST and (new.lines or not last):
+                # a nested block's lines run in the same scope, and only the last value is kept
+                lines.extend(new.lines)
+                self.note('flatten', new, f'{len(new.lines)} lines')
+                changed = True
+                continue
+            changed = changed or new is not line
+            lines.append(new)
+        if len(lines) == 1:
+            return self.note('flatten', ast, lines[0])
+        return BlockAST(lines) if changed else ast
+
+    def conditional(self, ast):
+        cond = yield self.visit(ast.cond)
+        if literal(cond):
+            if cond.val:
+                return self.note('dead branch', ast, (yield self.visit(ast.yes)))
+            if ast.no is None:
+                # a false condition with no else branch evaluates to None, as does an empty block
+                return self.note('dead branch', ast, BlockAST([]))
+            return self.note('dead branch', ast, (yield self.visit(ast.no)))
+        yes = yield self.visit(ast.yes)
+        no = None if ast.no is None else (yield self.visit(ast.no))
+        if cond is ast.cond and yes is ast.yes and no is ast.no:
+            return ast
+        return ConditionalAST(cond, yes, no)
+
+
+def optimize(ast):
+    return Optimizer().optimize(ast)
+
+
+if __name__ == '__main__':
+    from pratt import PrattLexer
+    optimizer = Optimizer()
+    source = '{{ y :- (3 * 4) + x * 1. {{ z :- 2 > 1 => y + 0 !! 0. }}. 1 = 2 => print:{"never"}. }}'
+    print(optimizer.optimize(PrattLexer(list(Tokenizer(source).tokens())).line()))
+    print(optimizer.report())
@@ -0,0 +1,234 @@
+# coding=utf-8
+from tokenizer import *
+from asts import *
+
+
+"""
+Precedence-climbing parser for the same grammar as lexer.Lexer, producing the same ASTs.
+
+Alternatives are chosen by looking at the next token (or, for `name :{` and `name :-`, the one
+after it) instead of trying each rule and catching TokenError. Rules return None on failure and
+leave the pointer wherever they stopped; only the caller that has somewhere else to go resets it.
+"""
+
+# binding power of the infix operators; every level is left-associative
+ARITHMETIC = {
+    TokenType.ADD: 1, TokenType.SUB: 1,
+    TokenType.MUL: 2, TokenType.DIV: 2,
+    TokenType.EXP: 3,
+}
+LOGICAL = {
+    TokenType.OR: 1,
+    TokenType.XOR: 2,
+    TokenType.AND: 3,
+}
+COMPARISON = {TokenType.LT, TokenType.GT, TokenType.LE, TokenType.GE, TokenType.EQ}
+ATOMS = {TokenType.STR, TokenType.NUM, TokenType.ID}
+
+
+class Nodes:
+    # what the parser builds each kind of node with; arena.Arena has the same methods, returning
+    # node indices instead of objects
+    atom = AtomAST
+    expression = ExpressionAST
+    assignment = AssignmentAST
+    block = BlockAST
+    conditional = ConditionalAST
+    call = CallAST
+
+
+class PrattLexer:
+    def __init__(self, tokens, nodes=Nodes):
+        self.tokens = tokens
+        self.ptr = 0
+        self.nodes = nodes
+
+    def peek(self, offset=0):
+        return self.tokens[self.ptr + offset].type
+
+    def advance(self):
+        self.ptr += 1
+        return self.tokens[self.ptr - 1]
+
+    def expect(self, tok):
+        raise TokenError(f'Expected {tok}, received {self.tokens[self.ptr].type}')
+
+    def line(self):
+        # same entry point as Lexer.line(): raises TokenError only when nothing parses
+        ast = self.statement()
+        if ast is None:
+            self.expect('assignment or expression')
+        return ast
+
+    def statement(self):
+        start = self.ptr
+        t = self.peek()
+        if t is TokenType.LBLK:
+            return self.block()
+        if t is TokenType.ID:
+            after = self.peek(1)
+            if after is TokenType.LARG:
+                ast = self.callFunc()
+                if ast is not None:
+                    return ast
+                self.ptr = start
+            elif after is TokenType.ASSIGN:
+                ast = self.assignment()
+                if ast is not None:
+                    return ast
+                self.ptr = start
+
+        cond, _ = self.test()
+        if cond is None or self.peek() is not TokenType.THEN:
+            return cond
+        then = self.ptr
+        self.advance()
+        yes = self.statement()
+        if yes is not None:
+            if self.peek() is not TokenType.ELSE:
+                return self.nodes.conditional(cond, yes, None)
+            self.advance()
+            no = self.statement()
+            if no is not None:
+                return self.nodes.conditional(cond, yes, no)
+        # a conditional with a broken branch leaves just its condition parsed, as in Lexer
+        self.ptr = then
+        return cond
+
+    def block(self):
+        self.advance()
+        lines = list()
+        while self.peek() is not TokenType.RBLK:
+            line = self.statement()
+            if line is None or self.peek() is not TokenType.TERM:
+                return None
+            self.advance()
+            lines.append(line)
+        self.advance()
+        return self.nodes.block(lines)
+
+    def callFunc(self):
+        name = self.advance()
+        self.advance()
+        args = list()
+        while self.peek() is not TokenType.RARG:
+            arg = self.statement()
+            if arg is None:
+                return None
+            args.append(arg)
+            if self.peek() is TokenType.SEPARG:
+                self.advance()
+            else:
+                break
+        if self.peek() is not TokenType.RARG:
+            return None
+        self.advance()
+        return self.nodes.call(name, args)
+
+    def assignment(self):
+        dest = self.advance()
+        self.advance()
+        val = self.statement()
+        if val is None:
+            return None
+        return self.nodes.assignment(dest, val)
+
+    def test(self, chain=True):
+        # a boolean if one parses here, otherwise the plain expression it would have started with;
+        # returns (ast, is_boolean) with ast None when neither parses
+        t = self.peek()
+        if t is TokenType.NOT:
+            op = self.advance()
+            rhs, boolean = self.test()
+            if not boolean:
+                return None, False
+            ast = self.logical(self.nodes.expression(op, None, rhs), chain)
+            return ast, ast is not None
+
+        if t is TokenType.LPAR:
+            self.advance()
+            inner, boolean = self.test()
+            if inner is None or self.peek() is not TokenType.RPAR:
+                return None, False
+            self.advance()
+            if boolean:
+                ast = self.logical(inner, chain)
+                return ast, ast is not None
+            lhs = self.arithmetic(inner, 1)
+        else:
+            lhs = self.expression()
+        if lhs is None:
+            return None, False
+
+        fallback = self.ptr
+        if self.peek() not in COMPARISON:
+            return lhs, False
+        op = self.advance()
+        rhs = self.expression()
+        if rhs is None:
+            self.ptr = fallback
+            return lhs, False
+        ast = self.logical(self.nodes.expression(op, lhs, rhs), chain)
+        if ast is None:
+            self.ptr = fallback
+            return lhs, False
+        return ast, True
+
+    def logical(self, lhs, chain, minimum=1):
+        if not chain:
+            return lhs
+        while self.peek() in LOGICAL and LOGICAL[self.peek()] >= minimum:
+            op = self.advance()
+            power = LOGICAL[op.type]
+            rhs, boolean = self.test(chain=False)
+            if not boolean:
+                return None
+            while self.peek() in LOGICAL and LOGICAL[self.peek()] > power:
+                rhs = self.logical(rhs, chain, LOGICAL[self.peek()])
+                if rhs is None:
+                    return None
+            lhs = self.nodes.expression(op, lhs, rhs)
+        return lhs
+
+    def expression(self):
+        lhs = self.primary()
+        if lhs is None:
+            return None
+        return self.arithmetic(lhs, 1)
+
+    def arithmetic(self, lhs, minimum):
+        while self.peek() in ARITHMETIC and ARITHMETIC[self.peek()] >= minimum:
+            op = self.advance()
+            power = ARITHMETIC[op.type]
+            rhs = self.primary()
+            if rhs is None:
+                return None
+            while self.peek() in ARITHMETIC and ARITHMETIC[self.peek()] > power:
+                rhs = self.arithmetic(rhs, ARITHMETIC[self.peek()])
+                if rhs is None:
+                    return None
+            lhs = self.nodes.expression(op, lhs, rhs)
+        return lhs
+
+    def primary(self):
+        t = self.peek()
+        if t in ATOMS:
+            return self.nodes.atom(self.advance())
+        if t is TokenType.ADD or t is TokenType.SUB:
+            # unary +/- applies to the whole expression that follows
+            op = self.advance()
+            rhs = self.expression()
+            return None if rhs is None else self.nodes.expression(op, None, rhs)
+        if t is TokenType.LPAR:
+            self.advance()
+            ast = self.expression()
+            if ast is None or self.peek() is not TokenType.RPAR:
+                return None
+            self.advance()
+            return ast
+        return None
+
+
+if __name__ == '__main__':
+    tok = Tokenizer('(x>3) => {{ number :- 4. }} !! {{ number :- 7. }}')
+    print(PrattLexer(list(tok.tokens())).line())
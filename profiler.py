@@ -0,0 +1,181 @@
+# coding=utf-8
+from collections import defaultdict
+from functools import partial
+import time
+
+from tokenizer import *
+from asts import *
+from stack import drive
+
+
+"""
+Per-node profiler. Profiler.run(ast, scope) executes a program like execute() does, but through
+its own instrumented walker, counting how often each node runs and how long it takes. Nothing
+changes for programs run any other way, so there is no cost at all when not profiling.
+
+- nodes are identified by kind and the line and column of their token
+- time is wall time, both inclusive (the node and everything it ran) and self (minus the nodes
+  it ran directly, including called function bodies)
+- calls are also counted per function, for FunctionAST and builtins alike
+- report() renders the hottest nodes and functions; folded() renders the time spent per stack
+  of nodes in the folded format flamegraph.pl and speedscope read
+- the walker's rules are generators run by stack.drive, so programs nested too deeply for
+  Python's stack profile too; only builtins and parameters, which evaluate their argument
+  themselves, start a nested drive
+"""
+
+
+def position(ast):
+    # (line, column) of a node's own token (an expression's operator, since `a * b + c` and
+    # `a * b` start at the same place), or (None, None) for a made-up node
+    kind = type(ast)
+    while kind is BlockAST or kind is ConditionalAST:
+        if kind is BlockAST:
+            if not ast.lines:
+                return None, None
+            ast = ast.lines[0]
+        else:
+            ast = ast.cond
+        kind = type(ast)
+    if kind is AtomAST:
+        return ast.position or (None, None)
+    tok = {ExpressionAST: 'op', AssignmentAST: 'dest', CallAST: 'name'}.get(kind)
+    tok = getattr(ast, tok, None) if tok else None
+    return (tok.line, tok.column) if tok is not None else (None, None)
+
+
+def label(ast):
+    line, column = position(ast)
+    where = '?' if line is None else f'{line}:{column}'
+    if type(ast) is CallAST:
+        return f'{ast.name.value}:{{}} @{where}'
+    if type(ast) is ExpressionAST:
+        return f'ExpressionAST({ast.op.type.name}) @{where}'
+    return f'{type(ast).__name__} @{where}'
+
+
+class Probe:
+    # a builtin's argument: evaluating it goes through the profiler too
+    __slots__ = ('profiler', 'ast')
+
+    def __init__(self, profiler, ast):
+        self.profiler = profiler
+        self.ast = ast
+
+    def execute(self, scope):
+        return self.profiler.evaluate(self.ast, scope)
+
+
+class Profiler:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        # per node label: [runs, inclusive seconds, self seconds]
+        self.nodes = defaultdict(lambda: [0, 0.0, 0.0])
+        # per function name: [calls, inclusive seconds, 'builtin' or 'function']
+        self.functions = dict()
+        # self seconds per stack of node labels
+        self.stacks = defaultdict(float)
+        self.stack = list()
+        # time spent in the nodes run directly by each node on the stack
+        self.children = [0.0]
+        # labels by node, since they take a while to compute
+        self.labels = dict()
+
+    def run(self, ast, scope):
+        return drive(self.visit(ast, scope))
+
+    def evaluate(self, ast, scope):
+        # a node run from outside the walker: a builtin's argument or a parameter
+        return drive(self.visit(ast, scope))
+
+    def visit(self, ast, scope):
+        name = self.labels.get(id(ast))
+        if name is None:
+            name = self.labels[id(ast)] = label(ast)
+        self.stack.append(name)
+        self.children.append(0.0)
+        start = self.clock()
+        try:
+            return (yield self.node(ast, scope))
+        finally:
+            elapsed = self.clock() - start
+            own = elapsed - self.children.pop()
+            self.children[-1] += elapsed
+            stats = self.nodes[name]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += own
+            self.stacks[';'.join(self.stack)] += own
+            self.stack.pop()
+
+    def node(self, ast, scope):
+        # execute() for one node, with every child run through visit()
+        kind = type(ast)
+        if kind is AtomAST:
+            return ast.execute(scope)
+        if kind is ExpressionAST:
+            op = ast.op.type
+            if ast.lhs is None and op in UNARY:
+                return UNARY[op]((yield self.visit(ast.rhs, scope)))
+            if op in BINARY:
+                lhs = yield self.visit(ast.lhs, scope)
+                return BINARY[op](lhs, (yield self.visit(ast.rhs, scope)))
+            if op in SHORT_CIRCUIT:
+                lhs = yield self.visit(ast.lhs, scope)
+                if bool(lhs) is SHORT_CIRCUIT[op]:
+                    return lhs
+                return (yield self.visit(ast.rhs, scope))
+            return None
+        if kind is AssignmentAST:
+            return store(scope, ast.dest.value, (yield self.visit(ast.val, scope)))
+        if kind is BlockAST:
+            ret = None
+            for line in ast.lines:
+                ret = yield self.visit(line, scope)
+            return ret
+        if kind is ConditionalAST:
+            if (yield self.visit(ast.cond, scope)):
+                return (yield self.visit(ast.yes, scope))
+            return None if ast.no is None else (yield self.visit(ast.no, scope))
+        if kind is CallAST:
+            return (yield self.call(ast, scope))
+        raise TypeError(f'Cannot profile {kind.__name__}')
+
+    def call(self, ast, scope):
+        name = ast.name.value
+        func = load(scope, name)
+        user = type(func) is FunctionAST
+        start = self.clock()
+        try:
+            if user:
+                return (yield self.visit(func.body, func.bind([partial(self.evaluate, arg) for arg in ast.args], scope)))
+            return func([Probe(self, arg) for arg in ast.args], scope)
+        finally:
+            stats = self.functions.setdefault(name, [0, 0.0, 'function' if user else 'builtin'])
+            stats[0] += 1
+            stats[1] += self.clock() - start
+
+    def report(self, limit=20):
+        rows = sorted(self.nodes.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+        lines = [f'{"self s":>10} {"total s":>10} {"runs":>9}  node']
+        lines += [f'{own:>10.6f} {total:>10.6f} {runs:>9}  {name}' for name, (runs, total, own) in rows]
+        lines.append('')
+        lines.append(f'{"total s":>10} {"calls":>9}  function')
+        calls = sorted(self.functions.items(), key=lambda item: item[1][1], reverse=True)
+        lines += [f'{total:>10.6f} {count:>9}  {name} ({kind})' for name, (count, total, kind) in calls]
+        return '\n'.join(lines)
+
+    def folded(self):
+        # one `frame;frame;frame microseconds` line per stack
+        return '\n'.join(f'{stack} {round(own * 1e6)}' for stack, own in self.stacks.items() if own > 0) + '\n'
+
+
+if __name__ == '__main__':
+    import sys
+    from pratt import PrattLexer
+    from builtin import builtin_print
+    source = '{{ x :- 3.\n  y :- x * (4 + 1).\n  y > 10 => print:{y} !! print:{x}.\n}}'
+    profiler = Profiler()
+    profiler.run(PrattLexer(list(Tokenizer(source).tokens())).line(), {'print': builtin_print})
+    print(profiler.report(), file=sys.stderr)
+    print(profiler.folded())
@@ -2,27 +2,25 @@
 
 from tokenizer import *
 from lexer import Lexer
+from asts import evaluate
+from builtin import builtin_print, builtin_prompt, Output
+from pratt import PrattLexer
+from optimize import Optimizer
+import transpile
+import slots
+import arena
+import cache
+import aio
+import vm
+import stack
+import memo
+import profiler
+from functools import partial
+import argparse
 import sys
+import threading
 
 
-# define builtin functions
-def builtin_print(args, inj_scope):
-    params = [arg.execute(inj_scope) for arg in args]
-    print(*params)
-
-
-def builtin_prompt(args, inj_scope):
-    # return AtomAST(Token(TokenType.STR, input(args[0].execute(inj_scope))))
-    inp = input(args[0].execute(inj_scope))
-    if len(args) == 1:
-        args.append('str')
-    else:
-        args[1] = args[1].execute(inj_scope)
-    if type(eval(args[1])) is not type:
-        print('{} is not a valid coercion type; returning as string')
-        args[1] = 'str'
-    return eval(args[1])(inp)
-
 """
 {{
     x :- prompt:{"Enter a number: ";}.
@@ -35,32 +33,174 @@ scope = {
     'print': builtin_print,
     'prompt': builtin_prompt
 }
+
+# interchangeable parser engines; all of them build the same ASTs
+PARSERS = {
+    'lexer': Lexer,
+    'packrat': partial(Lexer, packrat=True),
+    'pratt': PrattLexer,
+    # same as pratt, but without recursing in Python, for deeply nested programs
+    'stack': stack.StackLexer,
+}
+
+# interchangeable execution engines: backend(ast, scope) runs a parsed program
+BACKENDS = {
+    'tree': lambda ast, scope: ast.execute(scope),
+    'vm': vm.execute,
+    'closure': evaluate,
+    'python': transpile.run,
+    'slots': slots.run,
+    'arena': arena.run,
+    'asyncio': aio.execute,
+    'stack': stack.run,
+}
+
+
+class Interpreter:
+    # for embedding: owns the builtins, and keeps the programs it compiled most recently, keyed
+    # by their source text, so running the same snippet again skips tokenizing and parsing.
+    # One interpreter, and the programs it compiles, can be shared by any number of threads:
+    # everything a run changes lives in that run's own scope, and nodes are never modified
+    # while they execute
+    def __init__(self, parser='pratt', backend='closure', optimize=False, cache_size=256, output=None,
+                 memoize=False, memo_size=4096):
+        self.scope = dict(scope)
+        # an Output (or Capture) that print:{} writes to, flushed when each run ends
+        self.output = output
+        if output is not None:
+            self.scope.update(output.builtins())
+        self.parser = PARSERS[parser]
+        self.backend = BACKENDS[backend]
+        self.optimize = optimize
+        self.cache_size = cache_size
+        self.programs = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # guards the cache and its counters; parsing itself happens outside it
+        self.lock = threading.Lock()
+        # results of pure user function calls, reused across runs; off unless asked for
+        self.memo = memo.Memo(memo_size, cache_size) if memoize else None
+
+    def compile(self, source):
+        programs = self.programs
+        with self.lock:
+            ast = programs.pop(source, None)
+            if ast is not None:
+                self.hits += 1
+                programs[source] = ast
+                return ast
+            self.misses += 1
+        # threads missing on the same source at once each parse it; the last one is kept
+        ast = self.parser(list(Tokenizer(source).tokens())).line()
+        if self.optimize:
+            ast = Optimizer().optimize(ast)
+        with self.lock:
+            programs[source] = ast
+            while len(programs) > self.cache_size:
+                # the dict keeps insertion order and hits are moved to the end, so the first
+                # entry is the least recently used
+                del programs[next(iter(programs))]
+                self.evictions += 1
+        return ast
+
+    def run(self, program, bindings=None):
+        # every run gets its own scope, the builtins plus `bindings` (name -> value), which is the
+        # only state it changes
+        scope = dict(self.scope)
+        if bindings:
+            scope.update(bindings)
+        if self.memo is not None:
+            self.memo.install(program, scope)
+        try:
+            return self.backend(program, scope)
+        finally:
+            if self.output is not None:
+                self.output.flush()
+
+    def execute(self, source, bindings=None):
+        return self.run(self.compile(source), bindings)
+
+    def stats(self):
+        with self.lock:
+            stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                     'entries': len(self.programs)}
+        if self.memo is not None:
+            stats['memo'] = self.memo.stats()
+        return stats
+
+
 if __name__ == '__main__':
-    sys.argv.append('elseif.sfr')
+    argparser = argparse.ArgumentParser(description='Sapphire interpreter')
+    argparser.add_argument('script', nargs='?', help='script to run (default: read stdin)')
+    argparser.add_argument('--parser', choices=PARSERS, default='lexer')
+    argparser.add_argument('--backend', choices=BACKENDS, default='tree')
+    argparser.add_argument('--dump-python', action='store_true', help='print the Python the program lowers to')
+    argparser.add_argument('--optimize', action='store_true', help='fold constants and prune dead code first')
+    argparser.add_argument('--no-cache', action='store_true', help='always parse the script, without __sapcache__')
+    argparser.add_argument('--profile', action='store_true', help='report the hottest nodes and functions on stderr')
+    argparser.add_argument('--profile-out', metavar='FILE',
+                           help='profile, and also write folded stacks for a flamegraph to FILE')
+    options = argparser.parse_args()
+    options.profile = options.profile or options.profile_out is not None
+    # printed lines are written to stdout in large chunks rather than one at a time
+    output = Output()
+    scope.update(output.builtins())
+
     while True:
 
         print('[Sapphire]')
-        if len(sys.argv) > 1:
-            read = open(sys.argv[1]).readlines()
+        # cached trees carry no source positions, so profiled scripts are always parsed
+        if options.script and not options.no_cache and not options.profile:
+            # the script's parsed (and optimized) tree is cached next to it, so reruns skip parsing
+            optimizer = Optimizer() if options.optimize else None
+            ast, _ = cache.compile_file(options.script,
+                                        lambda stream: PARSERS[options.parser](TokenStream(Tokenizer(stream).tokens())).line(),
+                                        optimizer and optimizer.optimize)
+            if optimizer is not None and optimizer.changes:
+                print(optimizer.report(), file=sys.stderr)
         else:
-            read = sys.stdin.readlines()
-
-        # expression = ' '.join(map(str.strip, read))
-        expression = ''.join(read)
-        # print(expression)
-        # expression = input('$ ')
-        # expression = '3 + 4'
-        if expression == 'quit':
-            break
-        # for tok in Tokenizer(expression).tokens(True):
-        #     print(tok)
-        toks = list(Tokenizer(expression).tokens())
-        # print(toks)
-        lex = Lexer(toks)
-        ast = lex.line()
-        # print(ast)
+            if options.script:
+                source = open(options.script)
+            else:
+                source = sys.stdin
+
+            # tokens are pulled from the file in fixed-size chunks as the parser asks for them,
+            # so the script is never held in memory as a whole
+            toks = TokenStream(Tokenizer(source).tokens())
+            if toks[0].type is TokenType.ID and toks[0].value == 'quit' and toks[1].type is TokenType.EOF:
+                break
+            # stdin has run out
+            if not options.script and toks[0].type is TokenType.EOF:
+                break
+            # print(toks)
+            lex = PARSERS[options.parser](toks)
+            ast = lex.line()
+            # print(ast)
+            if options.script:
+                source.close()
+            if options.optimize:
+                optimizer = Optimizer()
+                ast = optimizer.optimize(ast)
+                print(optimizer.report(), file=sys.stderr)
+        if options.dump_python:
+            print(transpile.source(ast))
         # print(f'=> {execute(ast)}')
-        print(f'=> {ast.execute(scope)}')
+        try:
+            if not options.profile:
+                result = BACKENDS[options.backend](ast, scope)
+            else:
+                # the profiler runs the program on its own instrumented tree walker, whatever the backend
+                prof = profiler.Profiler()
+                result = prof.run(ast, scope)
+        finally:
+            output.flush()
+        if options.profile:
+            print(prof.report(), file=sys.stderr)
+            if options.profile_out:
+                with open(options.profile_out, 'w') as f:
+                    f.write(prof.folded())
+        print(f'=> {result}')
         # print(scope)
-        if len(sys.argv) > 1:
+        if options.script:
             break
@@ -0,0 +1,195 @@
+# coding=utf-8
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from tokenizer import Tokenizer
+from lexer import Lexer
+from stack import StackLexer, run as run_stack
+from asts import FunctionAST
+from builtin import builtin_print
+from workloads import label
+
+
+"""
+Scaling benchmarks: synthetic programs of growing size, each timed through the three stages of a
+run separately (Tokenizer.tokens, Lexer.line and execute, or StackLexer and stack.run for the
+programs in DEEP), with the throughput and peak memory of every stage at every size.
+
+    python scaling.py                              print the table
+    python scaling.py --output results.json        also save the results
+    python scaling.py --baseline results.json      compare against saved results; exits with 1 if
+                                                   any stage got slower or bigger than --tolerance
+
+Programs are generated, not read from files, so every run measures exactly the same inputs.
+Baselines only mean something on the machine that wrote them.
+"""
+
+# length of each literal in the `strings` program
+STRING = 1000
+
+
+def nesting(lines):
+    # one expression nested as many parentheses deep as the program has lines, each line closing one
+    ops = '+*-' * (lines // 3 + 1)
+    return ('{{ x :- 1. r :- ' + '(' * lines + 'x'
+            + ''.join(f' {ops[i]} {i % 7 + 1})\n' for i in range(lines)) + '. }}')
+
+
+def block(lines):
+    # one long block of short statements, all on the same few variables
+    return '{{ x :- 0. y :- 1. ' + ''.join(f'x :- x + y * {i % 10}. y :- x > 100 => 1 !! y + 1.\n'
+                                           for i in range(lines // 2)) + '}}'
+
+
+def assignments(lines):
+    # a new variable on every line, each computed from an earlier one
+    return '{{ a :- 1. ' + ''.join(f'{label(i)} :- {label(i // 2)} + {i}.\n' for i in range(1, lines)) + '}}'
+
+
+def calls(lines):
+    # nested calls of user functions (a space keeps `} }` from reading as the end of a block)
+    return '{{ r :- 0. ' + ''.join(f'r :- add:{{r; sq:{{{i % 10}}} }}.\n' for i in range(lines)) + '}}'
+
+
+def strings(lines):
+    # large string literals, assigned and compared
+    text = 'abcdefghij' * (STRING // 10)
+    return '{{ ' + ''.join(f'{label(i % 100)} :- "{text}". z :- {label(i % 100)} = "{text}" => 1 !! 0.\n'
+                           for i in range(lines // 2)) + '}}'
+
+
+GENERATORS = {
+    'nesting': nesting,
+    'block': block,
+    'assignments': assignments,
+    'calls': calls,
+    'strings': strings,
+}
+SIZES = (100, 1000, 4000)
+# (parser, executor) for programs too deep for the recursive ones: Lexer backtracks at every
+# parenthesis, and both it and execute() recurse once per level of nesting
+DEEP = {
+    'nesting': (StackLexer, run_stack),
+}
+
+
+def bindings():
+    return {
+        'print': builtin_print,
+        'add': FunctionAST(['p', 'q'], Lexer(list(Tokenizer('p + q').tokens())).line()),
+        'sq': FunctionAST(['n'], Lexer(list(Tokenizer('n * n').tokens())).line()),
+    }
+
+
+def stages(source, name=None):
+    # (stage, function of the previous stage's result) for one run of source
+    parser, execute = DEEP.get(name, (Lexer, None))
+    return [
+        ('tokenize', lambda _: list(Tokenizer(source).tokens())),
+        ('parse', lambda toks: parser(toks).line()),
+        ('execute', lambda ast: ast.execute(bindings()) if execute is None else execute(ast, bindings())),
+    ]
+
+
+def measure(source, repeat=3, name=None):
+    # best time and peak memory of each stage, every stage fed the output of the one before
+    results = dict()
+    value = None
+    for stage, fn in stages(source, name):
+        best = None
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            out = fn(value)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        # memory is measured in a run of its own, since tracing slows everything down
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn(value)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results[stage] = {'seconds': best, 'peak': peak}
+        value = out
+    return results, value
+
+
+def run(generators=GENERATORS, sizes=SIZES, repeat=3, log=sys.stdout):
+    print(f'{"program":>12} {"lines":>6} {"MB":>7} {"stage":>9} {"seconds":>9} {"MB/s":>8} {"peak MB":>8}', file=log)
+    records = list()
+    for name, generate in generators.items():
+        for size in sizes:
+            source = generate(size)
+            sizes_mb = len(source.encode()) / 1e6
+            results, _ = measure(source, repeat, name)
+            for stage, stats in results.items():
+                record = {
+                    'program': name,
+                    'lines': size,
+                    'bytes': len(source.encode()),
+                    'stage': stage,
+                    'seconds': stats['seconds'],
+                    # bytes of source per second, so the stages of one program are comparable
+                    'throughput': len(source.encode()) / stats['seconds'],
+                    'peak': stats['peak'],
+                }
+                records.append(record)
+                print(f'{name:>12} {size:>6} {sizes_mb:>7.3f} {stage:>9} {stats["seconds"]:>9.4f} '
+                      f'{record["throughput"] / 1e6:>8.2f} {stats["peak"] / 1e6:>8.2f}', file=log)
+    return {
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': records,
+    }
+
+
+def regressions(results, baseline, tolerance=0.2):
+    # every stage that is more than `tolerance` slower, or uses that much more memory, than in baseline
+    before = {(r['program'], r['lines'], r['stage']): r for r in baseline['results']}
+    found = list()
+    for record in results['results']:
+        old = before.get((record['program'], record['lines'], record['stage']))
+        if old is None:
+            continue
+        what = f'{record["program"]} {record["lines"]} lines, {record["stage"]}'
+        if record['throughput'] < old['throughput'] * (1 - tolerance):
+            found.append(f'{what}: {record["throughput"] / 1e6:.2f} MB/s, was {old["throughput"] / 1e6:.2f}')
+        if record['peak'] > old['peak'] * (1 + tolerance):
+            found.append(f'{what}: {record["peak"] / 1e6:.2f} MB peak, was {old["peak"] / 1e6:.2f}')
+    return found
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Sapphire scaling benchmarks')
+    argparser.add_argument('programs', nargs='*', help='programs to run (default: all)')
+    argparser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='program sizes, in lines')
+    argparser.add_argument('--repeat', type=int, default=3, help='runs per stage; the fastest counts')
+    argparser.add_argument('--output', help='save the results to this JSON file')
+    argparser.add_argument('--baseline', help='JSON results to check for regressions against')
+    argparser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown or growth, as a fraction')
+    options = argparser.parse_args()
+    unknown = [name for name in options.programs if name not in GENERATORS]
+    if unknown:
+        argparser.error(f'unknown program {", ".join(unknown)} (choose from {", ".join(GENERATORS)})')
+
+    generators = {name: GENERATORS[name] for name in options.programs} if options.programs else GENERATORS
+    results = run(generators, options.sizes, options.repeat)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            found = regressions(results, json.load(f), options.tolerance)
+        for line in found:
+            print(f'regression: {line}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+        print(f'no regressions beyond {options.tolerance:.0%}')
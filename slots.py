@@ -0,0 +1,253 @@
+# coding=utf-8
+from weakref import WeakKeyDictionary
+
+from tokenizer import *
+from asts import *
+
+
+"""
+Slot-resolved backend. Before a program (or function body) runs, every name it uses is resolved
+to an index into a fixed-size list that serves as its frame, and the program is compiled into
+closures taking (frame, scope) that read and write variables by index. Names a frame does not
+own, or owns but has not bound yet, are looked up through the calling frames and then the global
+scope dict, which is also where builtins like print and prompt live.
+
+- The program's frame owns every name it mentions. It is loaded from the scope before the run,
+  and assignments are written through to the scope so builtins, functions and embedders see them.
+- A function's frame owns its parameters and the names it assigns. Anything else, like a
+  parameter the caller left out, is read from whichever frame called it, then that frame's
+  caller and so on, as asts.Frame does for execute(). The last slot of every frame links to the
+  caller's frame and layout, or is None for a call made from the program.
+- Arguments are still passed by name: a parameter holds a Thunk that re-evaluates the argument
+  in the caller's frame every time it is read, as execute() re-evaluates the argument AST.
+
+"""
+
+
+class Unbound:
+    # placeholder for a slot not assigned yet; reading it falls back to the calling frames and the
+    # scope, like a dict miss
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Thunk:
+    # an argument expression together with the frame it has to be evaluated in
+    __slots__ = ('fn', 'frame', 'scope')
+
+    def __init__(self, fn, frame, scope):
+        self.fn = fn
+        self.frame = frame
+        self.scope = scope
+
+    def value(self):
+        return self.fn(self.frame, self.scope)
+
+    def execute(self, scope):
+        # builtins evaluate their arguments through execute(), as they do ASTs
+        return self.fn(self.frame, self.scope)
+
+
+def lookup(frame, name, scope):
+    # a name frame does not hold: the first calling frame that does, else the scope
+    link = frame[-1]
+    while link is not None:
+        frame, layout = link
+        slot = layout.slots.get(name)
+        if slot is not None:
+            val = frame[slot]
+            kind = type(val)
+            if kind is Thunk:
+                return val.value()
+            if kind is not Unbound:
+                return val
+        link = frame[-1]
+    return load(scope, name)
+
+
+def resolve(val, frame, scope):
+    # the value a slot of frame stands for
+    kind = type(val)
+    if kind is Thunk:
+        return val.value()
+    if kind is Unbound:
+        return lookup(frame, val.name, scope)
+    return val
+
+
+class Layout:
+    # the slot index of every name a frame owns
+    def __init__(self, names=()):
+        self.slots = dict()
+        for name in names:
+            self.add(name)
+        # Unbound placeholders hold no state, so every new frame can share them
+        self.empty = None
+
+    def add(self, name):
+        if name not in self.slots:
+            self.slots[name] = len(self.slots)
+        return self.slots[name]
+
+    def frame(self, scope=None):
+        # a fresh frame, its caller link still None; the program's frame starts out with the
+        # scope's current bindings
+        if scope is None:
+            if self.empty is None or len(self.empty) != len(self.slots) + 1:
+                self.empty = [Unbound(name) for name in self.slots] + [None]
+            return self.empty[:]
+        return [scope[name] if name in scope else Unbound(name) for name in self.slots] + [None]
+
+
+def names(ast, assigned_only):
+    # every name an AST mentions (or only the ones it assigns), in order of appearance
+    kind = type(ast)
+    if kind is AtomAST:
+        if ast.type is TokenType.ID and not assigned_only:
+            yield ast.val
+    elif kind is ExpressionAST:
+        if ast.lhs is not None:
+            yield from names(ast.lhs, assigned_only)
+        yield from names(ast.rhs, assigned_only)
+    elif kind is AssignmentAST:
+        yield ast.dest.value
+        yield from names(ast.val, assigned_only)
+    elif kind is BlockAST:
+        for line in ast.lines:
+            yield from names(line, assigned_only)
+    elif kind is ConditionalAST:
+        for part in (ast.cond, ast.yes, ast.no):
+            if part is not None:
+                yield from names(part, assigned_only)
+    elif kind is CallAST:
+        if not assigned_only:
+            yield ast.name.value
+        for arg in ast.args:
+            yield from names(arg, assigned_only)
+
+
+class Compiler:
+    def __init__(self, layout, program):
+        self.layout = layout
+        # assignments in the program's frame are written through to the scope
+        self.program = program
+
+    def compile(self, ast):
+        kind = type(ast)
+        if kind is AtomAST:
+            val = ast.val
+            if ast.type is not TokenType.ID:
+                return lambda frame, scope: val
+            slot = self.layout.slots.get(val)
+            if slot is None:
+                return lambda frame, scope: lookup(frame, val, scope)
+
+            def read(frame, scope):
+                ret = frame[slot]
+                kind = type(ret)
+                if kind is Thunk or kind is Unbound:
+                    return resolve(ret, frame, scope)
+                return ret
+            return read
+
+        if kind is ExpressionAST:
+            if ast.lhs is None and ast.op.type in UNARY:
+                fn = UNARY[ast.op.type]
+                rhs = self.compile(ast.rhs)
+                return lambda frame, scope: fn(rhs(frame, scope))
+            if ast.op.type in BINARY:
+                fn = BINARY[ast.op.type]
+                lhs = self.compile(ast.lhs)
+                rhs = self.compile(ast.rhs)
+                return lambda frame, scope: fn(lhs(frame, scope), rhs(frame, scope))
+            if ast.op.type in SHORT_CIRCUIT:
+                lhs = self.compile(ast.lhs)
+                rhs = self.compile(ast.rhs)
+                if ast.op.type is TokenType.AND:
+                    return lambda frame, scope: lhs(frame, scope) and rhs(frame, scope)
+                return lambda frame, scope: lhs(frame, scope) or rhs(frame, scope)
+            return lambda frame, scope: None
+
+        if kind is AssignmentAST:
+            name = ast.dest.value
+            val = self.compile(ast.val)
+            slot = self.layout.slots[name]
+            if self.program:
+                def assign(frame, scope):
+                    ret = frame[slot] = store(scope, name, val(frame, scope))
+                    return ret
+                return assign
+            return lambda frame, scope: store(frame, slot, val(frame, scope))
+
+        if kind is BlockAST:
+            lines = [self.compile(line) for line in ast.lines]
+
+            def block(frame, scope):
+                ret = None
+                for line in lines:
+                    ret = line(frame, scope)
+                return ret
+            return block
+
+        if kind is ConditionalAST:
+            cond = self.compile(ast.cond)
+            yes = self.compile(ast.yes)
+            no = (lambda frame, scope: None) if ast.no is None else self.compile(ast.no)
+            return lambda frame, scope: yes(frame, scope) if cond(frame, scope) else no(frame, scope)
+
+        if kind is CallAST:
+            name = ast.name.value
+            slot = self.layout.slots.get(name)
+            args = [self.compile(arg) for arg in ast.args]
+            # calls from the program link to None, since its frame is written through to the scope
+            caller = None if self.program else self.layout
+
+            def call(frame, scope):
+                func = lookup(frame, name, scope) if slot is None else resolve(frame[slot], frame, scope)
+                thunks = [Thunk(arg, frame, scope) for arg in args]
+                if type(func) is FunctionAST:
+                    layout, body = function(func)
+                    callee = layout.frame()
+                    # arguments beyond the parameters are dropped, not put in the callee's locals
+                    n = min(len(thunks), len(func.argNames))
+                    callee[:n] = thunks[:n]
+                    if caller is not None:
+                        callee[-1] = (frame, caller)
+                    return body(callee, scope)
+                return func(thunks, scope)
+            return call
+
+        raise TypeError(f'Cannot compile {kind.__name__}')
+
+
+# resolved and compiled programs and function bodies, so each is only compiled once
+programs = WeakKeyDictionary()
+functions = WeakKeyDictionary()
+
+
+def function(func):
+    compiled = functions.get(func)
+    if compiled is None:
+        # parameters take the first slots, in order
+        layout = Layout(func.argNames)
+        for name in names(func.body, assigned_only=True):
+            layout.add(name)
+        compiled = functions[func] = (layout, Compiler(layout, False).compile(func.body))
+    return compiled
+
+
+def run(ast, scope):
+    compiled = programs.get(ast)
+    if compiled is None:
+        layout = Layout(names(ast, assigned_only=False))
+        compiled = programs[ast] = (layout, Compiler(layout, True).compile(ast))
+    layout, body = compiled
+    return body(layout.frame(scope), scope)
+
+
+if __name__ == '__main__':
+    from pratt import PrattLexer
+    ast = PrattLexer(list(Tokenizer('{{ x :- 3. y :- x * 2. (y > x) => y - x !! 0. }}').tokens())).line()
+    print(run(ast, {}))
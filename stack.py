@@ -0,0 +1,376 @@
+# coding=utf-8
+from weakref import WeakKeyDictionary
+
+from tokenizer import *
+from asts import *
+from pratt import PrattLexer, ARITHMETIC, LOGICAL, COMPARISON, ATOMS
+
+
+"""
+Non-recursive parsing and execution, for programs nested too deeply for Python's stack.
+
+StackLexer parses exactly like PrattLexer, but each rule is a generator that yields the rules it
+would have called and is sent back their results; drive() runs them off an explicit list instead
+of Python's call stack. run(ast, scope) executes a tree the same way, with a work list of nodes
+to evaluate and continuations to apply, and a value list for their results.
+
+A call to a user function replaces the call's own work item with the function body, so a call in
+tail position (the last line of a block, a branch of a conditional, a function body) leaves
+nothing behind: recursive Sapphire functions run in constant Python stack, and tail-recursive
+ones in a constant-size work list too. Only builtins, which evaluate their arguments themselves,
+start a nested run.
+"""
+
+
+def drive(rule):
+    # run a generator rule to completion; it yields the generator of every rule it calls and
+    # gets that rule's result back, or has the exception that rule raised thrown into it, so its
+    # own try blocks see it as they would a call's
+    stack = [rule]
+    value = None
+    error = None
+    while True:
+        try:
+            call = stack[-1].send(value) if error is None else stack[-1].throw(error)
+        except StopIteration as done:
+            stack.pop()
+            if not stack:
+                return done.value
+            value = done.value
+            error = None
+            continue
+        except BaseException as e:
+            stack.pop()
+            if not stack:
+                raise
+            value = None
+            error = e
+            continue
+        stack.append(call)
+        value = None
+        error = None
+
+
+class StackLexer(PrattLexer):
+    # PrattLexer with every recursive rule turned into a generator; see PrattLexer for the grammar
+
+    def line(self):
+        ast = drive(self.statement())
+        if ast is None:
+            self.expect('assignment or expression')
+        return ast
+
+    def statement(self):
+        start = self.ptr
+        t = self.peek()
+        if t is TokenType.LBLK:
+            return (yield self.block())
+        if t is TokenType.ID:
+            after = self.peek(1)
+            if after is TokenType.LARG:
+                ast = yield self.callFunc()
+                if ast is not None:
+                    return ast
+                self.ptr = start
+            elif after is TokenType.ASSIGN:
+                ast = yield self.assignment()
+                if ast is not None:
+                    return ast
+                self.ptr = start
+
+        cond, _ = yield self.test()
+        if cond is None or self.peek() is not TokenType.THEN:
+            return cond
+        then = self.ptr
+        self.advance()
+        yes = yield self.statement()
+        if yes is not None:
+            if self.peek() is not TokenType.ELSE:
+                return self.nodes.conditional(cond, yes, None)
+            self.advance()
+            no = yield self.statement()
+            if no is not None:
+                return self.nodes.conditional(cond, yes, no)
+        self.ptr = then
+        return cond
+
+    def block(self):
+        self.advance()
+        lines = list()
+        while self.peek() is not TokenType.RBLK:
+            line = yield self.statement()
+            if line is None or self.peek() is not TokenType.TERM:
+                return None
+            self.advance()
+            lines.append(line)
+        self.advance()
+        return self.nodes.block(lines)
+
+    def callFunc(self):
+        name = self.advance()
+        self.advance()
+        args = list()
+        while self.peek() is not TokenType.RARG:
+            arg = yield self.statement()
+            if arg is None:
+                return None
+            args.append(arg)
+            if self.peek() is TokenType.SEPARG:
+                self.advance()
+            else:
+                break
+        if self.peek() is not TokenType.RARG:
+            return None
+        self.advance()
+        return self.nodes.call(name, args)
+
+    def assignment(self):
+        dest = self.advance()
+        self.advance()
+        val = yield self.statement()
+        if val is None:
+            return None
+        return self.nodes.assignment(dest, val)
+
+    def test(self, chain=True):
+        t = self.peek()
+        if t is TokenType.NOT:
+            op = self.advance()
+            rhs, boolean = yield self.test()
+            if not boolean:
+                return None, False
+            ast = yield self.logical(self.nodes.expression(op, None, rhs), chain)
+            return ast, ast is not None
+
+        if t is TokenType.LPAR:
+            self.advance()
+            inner, boolean = yield self.test()
+            if inner is None or self.peek() is not TokenType.RPAR:
+                return None, False
+            self.advance()
+            if boolean:
+                ast = yield self.logical(inner, chain)
+                return ast, ast is not None
+            lhs = yield self.arithmetic(inner, 1)
+        else:
+            lhs = yield self.expression()
+        if lhs is None:
+            return None, False
+
+        fallback = self.ptr
+        if self.peek() not in COMPARISON:
+            return lhs, False
+        op = self.advance()
+        rhs = yield self.expression()
+        if rhs is None:
+            self.ptr = fallback
+            return lhs, False
+        ast = yield self.logical(self.nodes.expression(op, lhs, rhs), chain)
+        if ast is None:
+            self.ptr = fallback
+            return lhs, False
+        return ast, True
+
+    def logical(self, lhs, chain, minimum=1):
+        if not chain:
+            return lhs
+        while self.peek() in LOGICAL and LOGICAL[self.peek()] >= minimum:
+            op = self.advance()
+            power = LOGICAL[op.type]
+            rhs, boolean = yield self.test(chain=False)
+            if not boolean:
+                return None
+            while self.peek() in LOGICAL and LOGICAL[self.peek()] > power:
+                rhs = yield self.logical(rhs, chain, LOGICAL[self.peek()])
+                if rhs is None:
+                    return None
+            lhs = self.nodes.expression(op, lhs, rhs)
+        return lhs
+
+    def expression(self):
+        if self.peek() in ATOMS:
+            # the common case, without a generator for primary()
+            lhs = self.nodes.atom(self.advance())
+        else:
+            lhs = yield self.primary()
+            if lhs is None:
+                return None
+        if self.peek() not in ARITHMETIC:
+            return lhs
+        return (yield self.arithmetic(lhs, 1))
+
+    def arithmetic(self, lhs, minimum):
+        while self.peek() in ARITHMETIC and ARITHMETIC[self.peek()] >= minimum:
+            op = self.advance()
+            power = ARITHMETIC[op.type]
+            if self.peek() in ATOMS:
+                rhs = self.nodes.atom(self.advance())
+            else:
+                rhs = yield self.primary()
+                if rhs is None:
+                    return None
+            while self.peek() in ARITHMETIC and ARITHMETIC[self.peek()] > power:
+                rhs = yield self.arithmetic(rhs, ARITHMETIC[self.peek()])
+                if rhs is None:
+                    return None
+            lhs = self.nodes.expression(op, lhs, rhs)
+        return lhs
+
+    def primary(self):
+        t = self.peek()
+        if t in ATOMS:
+            return self.nodes.atom(self.advance())
+        if t is TokenType.ADD or t is TokenType.SUB:
+            op = self.advance()
+            rhs = yield self.expression()
+            return None if rhs is None else self.nodes.expression(op, None, rhs)
+        if t is TokenType.LPAR:
+            self.advance()
+            ast = yield self.expression()
+            if ast is None or self.peek() is not TokenType.RPAR:
+                return None
+            self.advance()
+            return ast
+        return None
+
+
+class Pending:
+    # an argument AST of a call made by run(): a user function's parameter holds it as its
+    # Argument.fn, which run() evaluates on its own work list; builtins and other backends just
+    # call or execute it, which starts a nested run
+    __slots__ = ('ast',)
+
+    def __init__(self, ast):
+        self.ast = ast
+
+    def __call__(self, scope):
+        return run(self.ast, scope)
+
+    execute = __call__
+
+
+# work items: (EVAL, node, scope) evaluates a node and pushes its value; the others are what is
+# left to do once the values they need are on the value list
+EVAL = 0
+UNARY_OP = 1    # (UNARY_OP, fn): replace the top value with fn(top)
+BINARY_OP = 2   # (BINARY_OP, fn): pop rhs, replace lhs with fn(lhs, rhs)
+STORE = 3       # (STORE, name, scope): assign the top value, leaving it there
+LINES = 4       # (LINES, lines, i, scope): drop the previous line's value, run lines[i] onwards
+BRANCH = 5      # (BRANCH, node, scope): pop the condition, run the branch it picks
+CALL = 6        # (CALL, node, scope): pop the function, call it with node's arguments
+SHORT = 7       # (SHORT, node, scope): keep the left side of && or || if it decides, else pop it
+                # and run the right side
+
+# Pending arguments of each call node, built once since they only hold the AST
+pending = WeakKeyDictionary()
+
+
+def run(ast, scope):
+    todo = [(EVAL, ast, scope)]
+    vals = list()
+    push = todo.append
+    give = vals.append
+    take = vals.pop
+    while todo:
+        item = todo.pop()
+        op = item[0]
+        if op == EVAL:
+            node = item[1]
+            scope = item[2]
+            kind = type(node)
+            if kind is AtomAST:
+                if node.type is not TokenType.ID:
+                    give(node.val)
+                    continue
+                val = scope[node.val]
+                if type(val) is Argument:
+                    if type(val.fn) is Pending:
+                        # evaluated in the caller's scope, on this work list
+                        push((EVAL, val.fn.ast, val.scope))
+                        continue
+                    val = val.value()
+                give(val)
+            elif kind is ExpressionAST:
+                t = node.op.type
+                if node.lhs is None and t in UNARY:
+                    push((UNARY_OP, UNARY[t]))
+                    push((EVAL, node.rhs, scope))
+                elif t in BINARY:
+                    push((BINARY_OP, BINARY[t]))
+                    push((EVAL, node.rhs, scope))
+                    push((EVAL, node.lhs, scope))
+                elif t in SHORT_CIRCUIT:
+                    push((SHORT, node, scope))
+                    push((EVAL, node.lhs, scope))
+                else:
+                    give(None)
+            elif kind is AssignmentAST:
+                push((STORE, node.dest.value, scope))
+                push((EVAL, node.val, scope))
+            elif kind is BlockAST:
+                lines = node.lines
+                if not lines:
+                    give(None)
+                    continue
+                if len(lines) > 1:
+                    push((LINES, lines, 1, scope))
+                push((EVAL, lines[0], scope))
+            elif kind is ConditionalAST:
+                push((BRANCH, node, scope))
+                push((EVAL, node.cond, scope))
+            elif kind is CallAST:
+                push((CALL, node, scope))
+                val = scope[node.name.value]
+                if type(val) is Argument:
+                    if type(val.fn) is Pending:
+                        push((EVAL, val.fn.ast, val.scope))
+                        continue
+                    val = val.value()
+                give(val)
+            else:
+                raise TypeError(f'Cannot run {kind.__name__}')
+        elif op == BINARY_OP:
+            rhs = take()
+            vals[-1] = item[1](vals[-1], rhs)
+        elif op == UNARY_OP:
+            vals[-1] = item[1](vals[-1])
+        elif op == STORE:
+            vals[-1] = store(item[2], item[1], vals[-1])
+        elif op == LINES:
+            lines, i = item[1], item[2]
+            take()
+            if i + 1 < len(lines):
+                push((LINES, lines, i + 1, item[3]))
+            # the last line is pushed with nothing after it: its calls are tail calls
+            push((EVAL, lines[i], item[3]))
+        elif op == SHORT:
+            node = item[1]
+            if bool(vals[-1]) is not SHORT_CIRCUIT[node.op.type]:
+                take()
+                push((EVAL, node.rhs, item[2]))
+        elif op == BRANCH:
+            node = item[1]
+            if take():
+                push((EVAL, node.yes, item[2]))
+            elif node.no is None:
+                give(None)
+            else:
+                push((EVAL, node.no, item[2]))
+        elif op == CALL:
+            node = item[1]
+            func = take()
+            args = pending.get(node)
+            if args is None:
+                args = pending[node] = [Pending(arg) for arg in node.args]
+            if type(func) is FunctionAST:
+                # the body takes the call's place on the work list rather than running under it
+                push((EVAL, func.body, func.bind(args, item[2])))
+            else:
+                give(func(args, item[2]))
+    return vals[-1]
+
+
+if __name__ == '__main__':
+    depth = 100000
+    source = '(' * depth + 'x' + ' + 1)' * depth
+    print(run(StackLexer(list(Tokenizer(source).tokens())).line(), {'x': 1}))
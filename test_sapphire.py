@@ -0,0 +1,433 @@
+# coding=utf-8
+from contextlib import redirect_stdout
+from functools import partial
+import asyncio
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from tokenizer import Tokenizer, TokenError
+from lexer import Lexer
+from pratt import PrattLexer
+from optimize import Optimizer
+from asts import AtomAST, FunctionAST, evaluate, nodes
+from builtin import Capture
+import sapphire
+import arena
+import cache
+import vectorize
+import profiler
+import stack
+import memo
+import incremental
+import batch
+import aio
+from workloads import (SNIPPET, CORPUS, ARITHMETIC, LOCALS, CALLS, CONSTANTS, SHARED, FIB, FORMULAS,
+                       program, bindings, deep, rows, scalar_loop)
+
+
+"""
+Differential tests: every parser, backend and optional stage (optimizer, arena, memo, vectorizer,
+incremental reparsing) must give what the reference Lexer and tree walker give on the shared
+workloads. Run with `python -m pytest -q`; benchmark.py times the same workloads.
+"""
+
+INTERPRETER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sapphire.py')
+
+
+def parse(engine, source):
+    # the tree (as text) and the position the parser stopped at, or the failure
+    lex = engine(list(Tokenizer(source).tokens()))
+    try:
+        return str(lex.line()), lex.ptr
+    except TokenError:
+        return 'TokenError', None
+
+
+def execute(backend, ast):
+    # the result, everything printed and the final variables, as text so backends can be compared
+    scope = bindings()
+    out = io.StringIO()
+    with redirect_stdout(out):
+        try:
+            result = backend(ast, scope)
+            result = str(result)
+        except Exception as e:
+            result = type(e).__name__
+    variables = {k: v for k, v in scope.items() if not callable(v)}
+    return result, out.getvalue(), variables
+
+
+def compare(backends, corpus=CORPUS):
+    # every backend must agree with the tree walker on every script that parses
+    for source in corpus:
+        try:
+            ast = program(source)
+        except TokenError:
+            continue
+        expected = execute(backends['tree'], ast)
+        for name, backend in backends.items():
+            actual = execute(backend, ast)
+            assert actual == expected, f'{name} ran {source!r} as {actual}, expected {expected}'
+
+
+def test_parsers():
+    for source in CORPUS:
+        expected = parse(Lexer, source)
+        for engine in (partial(Lexer, packrat=True), PrattLexer, stack.StackLexer):
+            actual = parse(engine, source)
+            assert actual == expected, f'{engine} parsed {source!r} as {actual}, expected {expected}'
+
+
+def test_backends():
+    compare(sapphire.BACKENDS)
+
+
+def test_optimizer():
+    # optimized programs must behave like the originals on every backend
+    for source in CORPUS + [ARITHMETIC, LOCALS, CONSTANTS]:
+        try:
+            ast = program(source)
+        except TokenError:
+            continue
+        expected = execute(sapphire.BACKENDS['tree'], ast)
+        optimizer = Optimizer()
+        optimized = optimizer.optimize(ast)
+        # --optimize prints the report, so it has to hold for every program too
+        optimizer.report()
+        for name, backend in sapphire.BACKENDS.items():
+            actual = execute(backend, optimized)
+            assert actual == expected, f'{name} ran optimized {source!r} as {actual}, expected {expected}'
+
+
+def test_arena():
+    # parsing into an arena and converting either way must give back the same trees
+    for source in CORPUS:
+        toks = list(Tokenizer(source).tokens())
+        try:
+            expected = str(PrattLexer(toks).line())
+        except TokenError:
+            continue
+        store, root = arena.parse(toks)
+        assert str(store.tree(root)) == expected, f'arena parsed {source!r} as {store.tree(root)}'
+        copy = arena.Arena()
+        assert str(copy.tree(copy.add(store.tree(root)))) == expected
+
+
+@pytest.mark.skipif(vectorize.np is None, reason='numpy is not installed')
+def test_vectorize(size=2000):
+    table = rows(size)
+    columns = {name: vectorize.np.array(col) for name, col in table.items()}
+    scope = bindings()
+    for source in FORMULAS:
+        ast = program(source)
+        expected = scalar_loop(ast, table, scope)
+        actual = vectorize.vectorize(ast, columns, scope).tolist()
+        for want, got in zip(expected, actual):
+            same = want == got or (type(want) is float and abs(want - got) <= 1e-9 * abs(want))
+            assert same and type(want) is type(got), f'{source!r} gave {got!r}, expected {want!r}'
+
+
+def test_output():
+    # print:{} goes to the interpreter's output on every backend, never straight to stdout
+    source = '{{ print:{"a"; 1}. k:{2}. x > 3 => print:{x}. }}'
+    values = {'k': FunctionAST(['n'], program('print:{n * 2}')), 'x': 8}
+    for name in sapphire.BACKENDS:
+        output = Capture()
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            sapphire.Interpreter(backend=name, output=output).execute(source, values)
+        assert output.getvalue() == 'a 1\n4\n8\n', (name, output.getvalue())
+        assert stdout.getvalue() == '', (name, stdout.getvalue())
+
+
+def test_output_threads():
+    # threads printing through one small-buffered output while it keeps flushing lose no lines
+    output = Capture(size=64)
+    interpreter = sapphire.Interpreter(output=output)
+    workers = [threading.Thread(target=interpreter.execute, args=('{{ ' + 'print:{x}. ' * 2000 + '}}', {'x': i}))
+               for i in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sorted(output.getvalue().split()) == sorted(str(i) for i in range(8) for _ in range(2000))
+
+
+def test_memo():
+    # memoizing must not change what any script does, and must leave impure functions alone
+    store = memo.Memo()
+
+    def memoized(ast, scope):
+        store.install(ast, scope)
+        return evaluate(ast, scope)
+    compare({'tree': sapphire.BACKENDS['tree'], 'memoized': memoized},
+            CORPUS + [CALLS, '{{ t :- loud:{sq:{3} }. u :- sq:{loud:{2} }. sq:{print:{5} }. }}'])
+    scope = bindings()
+    scope.update({'fib': FunctionAST(['n'], program(FIB)), 'loud': FunctionAST(['n'], program('{{ print:{n}. n. }}'))})
+    analysis = memo.Analysis(scope)
+    assert analysis.pure == {'f', 'g', 'h', 'sq', 'fib'}, analysis.pure
+    # sq's argument prints, so sq is passed its arguments by name as usual
+    assert analysis.memoizable(program('{{ fib:{3}. sq:{print:{1} }. }}')) == {'f', 'g', 'h', 'fib'}
+
+
+def test_memo_interpreter():
+    fib = {'fib': FunctionAST(['n'], program(FIB))}
+    assert sapphire.Interpreter(memoize=True).execute('fib:{15}', fib) == sapphire.Interpreter().execute('fib:{15}', fib)
+    # 1 and 1.0 are equal, but the results computed from them are not
+    interpreter = sapphire.Interpreter(memoize=True)
+    triple = {'t': FunctionAST(['n'], program('n * 3'))}
+    assert interpreter.execute('t:{1}', triple) == 3
+    assert repr(interpreter.execute('t:{2 / 2}', triple)) == '3.0'
+    # functions bound afresh for every run leave only a bounded number of plans behind
+    interpreter = sapphire.Interpreter(memoize=True, cache_size=8)
+    for i in range(100):
+        interpreter.execute('t:{1}', {'t': FunctionAST(['n'], program(f'n * {i}'))})
+    assert len(interpreter.memo.plans[interpreter.compile('t:{1}')]) == 8
+
+
+def test_profiler():
+    # the profiler must not change results, and must count what ran where
+    compare({'tree': sapphire.BACKENDS['tree'], 'profile': lambda ast, scope: profiler.Profiler().run(ast, scope)})
+    prof = profiler.Profiler()
+    prof.run(program(CALLS), bindings())
+    # CALLS calls sq twice, f and g once, 50 times over
+    assert {name: stats[:1] + stats[2:] for name, stats in prof.functions.items()} == {
+        'sq': [100, 'function'], 'f': [50, 'function'], 'g': [50, 'function']}
+
+
+def test_positions():
+    toks = list(Tokenizer(SNIPPET * 3).tokens())
+    assert [(tok.line, tok.column) for tok in toks[:3]] == [(1, 1), (1, 4), (1, 11)]
+    assert (toks[-1].line, toks[-1].column) == (4, 1)
+    assert [tok.line for tok in toks if tok.value == 'number'] == [1, 2, 3]
+
+
+def test_short_circuit():
+    # && and || skip their right side when the left decides, on every backend; $ never does
+    calls = [0]
+
+    def counted(args, scope):
+        calls[0] += 1
+        return args[0].execute(scope)
+    ast = program('{{ ' + ''.join(f'r :- check:{{x - {i % 10}; counted:{{{i}}} }}. ' for i in range(100)) + '}}')
+    bodies = {'&&': 'a > 7 && b > 3 => 1 !! 0', '||': 'a < 8 || b > 3 => 1 !! 0', '$': 'a > 7 $ b > 3 => 1 !! 0'}
+    for name, run in sapphire.BACKENDS.items():
+        for op, body in bodies.items():
+            scope = bindings()
+            scope.update({'check': FunctionAST(['a', 'b'], program(body)), 'counted': counted})
+            calls[0] = 0
+            run(ast, scope)
+            # x is 8, so a = x - i % 10 is 8 for one rule in ten: only those read b
+            assert calls[0] == (100 if op == '$' else 10), (name, op, calls[0])
+
+
+def test_stack():
+    # nesting the recursive parser and tree walker cannot handle
+    for kind in ('parens', 'unary', 'blocks', 'ifs'):
+        depth = 5000
+        result = stack.run(stack.StackLexer(list(Tokenizer(deep(kind, depth)).tokens())).line(), {'x': 1})
+        expected = {'parens': 1 + depth, 'unary': (-1) ** depth, 'blocks': 1, 'ifs': 1}[kind]
+        assert result == expected, f'{kind} at depth {depth} ran as {result}, expected {expected}'
+    count = FunctionAST(['n'], program('n > 0 => count:{n - 1} !! "done"'))
+    assert stack.run(program('count:{2000}'), {'count': count}) == 'done'
+
+
+def test_stack_command_line(depth=3000):
+    # deep programs run from the command line with the stack parser and backend, as a cache miss,
+    # a cache hit, optimized and profiled, since each of those converts the tree in its own way
+    command = [sys.executable, INTERPRETER, '--parser', 'stack', '--backend', 'stack']
+    with tempfile.TemporaryDirectory() as directory:
+        for kind in ('parens', 'unary', 'blocks', 'ifs'):
+            script = os.path.join(directory, f'{kind}.sap')
+            with open(script, 'w') as f:
+                f.write('{{ x :- 1. ' + deep(kind, depth) + '. }}')
+            expected = {'parens': 1 + depth, 'unary': (-1) ** depth, 'blocks': 1, 'ifs': 1}[kind]
+            for options in ([], [], ['--optimize'], ['--profile']):
+                run = subprocess.run(command + options + [script], capture_output=True, text=True)
+                assert run.returncode == 0, f'{kind} {options} failed:\n{run.stderr[-2000:]}'
+                assert f'=> {expected}' in run.stdout.splitlines(), f'{kind} {options} printed {run.stdout!r}'
+
+
+def test_stdin():
+    # a program piped in runs once, and the interpreter stops at the end of its input
+    run = subprocess.run([sys.executable, INTERPRETER], input='3 + 4', capture_output=True, text=True)
+    assert run.returncode == 0 and run.stdout.splitlines() == ['[Sapphire]', '=> 7', '[Sapphire]'], run
+
+
+def test_cache():
+    # a cache file is as readable as its script (less the umask), and is used on the next run
+    parse = lambda stream: PrattLexer(list(Tokenizer(stream).tokens())).line()
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, 'script.sap')
+        with open(script, 'w') as f:
+            f.write(SNIPPET)
+        os.chmod(script, 0o644)
+        mask = os.umask(0o022)
+        try:
+            ast, hit = cache.compile_file(script, parse)
+        finally:
+            os.umask(mask)
+        assert not hit and os.stat(cache.location(script)).st_mode & 0o777 == 0o644
+        again, hit = cache.compile_file(script, parse)
+        assert hit and str(again) == str(ast)
+
+
+def test_batch():
+    # one script run with many binding sets gives the same results in this process and on pools
+    source = '{{ ' + 's :- x * 2. t :- s - y. print:{s; t}. ' * 20 + 'x > y => "up" !! "down". }}'
+    values = [{'x': i, 'y': i % 7} for i in range(200)]
+    expected = [(r.value, r.output, r.error) for r in batch.run_bindings(source, values, workers=0)]
+    for count in (1, 2):
+        results = batch.run_bindings(source, values, workers=count)
+        assert [(r.value, r.output, r.error) for r in results] == expected, f'{count} workers gave different results'
+    # a script that does not parse fails its own jobs, not the batch
+    for count in (0, 2):
+        results = batch.run_scripts(['1 / 0', '{{ x :- 1 }}', 'x * 2'], {'x': 4}, workers=count)
+        assert [r.value for r in results] == [None, None, 8]
+        assert results[0].error.startswith('ZeroDivisionError') and results[1].error.startswith('TokenError')
+
+
+def test_threads(threads=8, runs=50):
+    # one program shared by many threads, each run with its own bindings, must give every thread
+    # the same results as running serially
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for name in sapphire.BACKENDS:
+            interpreter = sapphire.Interpreter(backend=name)
+            functions = {k: v for k, v in bindings().items() if type(v) is FunctionAST}
+            jobs = [dict(functions, x=t, y=i) for t in range(threads) for i in range(runs)]
+            expected = [interpreter.execute(SHARED, values) for values in jobs]
+            # a fresh interpreter, so the threads also race to parse and compile the program
+            interpreter = sapphire.Interpreter(backend=name)
+            results = [None] * len(jobs)
+            errors = list()
+
+            def worker(t):
+                try:
+                    for i in range(t * runs, (t + 1) * runs):
+                        results[i] = interpreter.execute(SHARED, jobs[i])
+                except Exception as e:
+                    errors.append(e)
+            pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            assert not errors, f'{name}: {errors[0]!r}'
+            assert results == expected, f'{name} gave different results when run from {threads} threads'
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def test_asyncio(scripts=100):
+    # scripts interleaved on one event loop, each waiting on I/O twice and reading a prompt
+    async def fetch(args, scope):
+        val = await args[0].execute(scope)
+        await asyncio.sleep(0.01)
+        return val * 2
+    ast = program('{{ a :- fetch:{x}. b :- prompt:{"? "; "int"}. fetch:{a + b}. }}')
+
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(''.join(f'{i}\n' for i in range(scripts)).encode())
+        reader.feed_eof()
+        prompt = aio.Prompt(reader, io.StringIO())
+        return await asyncio.gather(*[aio.run(ast, {'fetch': fetch, 'prompt': prompt, 'x': i}) for i in range(scripts)])
+    results = asyncio.run(main())
+    # each script reads one line, in whatever order the scripts get to their prompt
+    assert sorted(r - 4 * x for x, r in enumerate(results)) == [2 * i for i in range(scripts)]
+
+
+# what the fuzzer types: mostly what typing into a statement looks like, then bits of every
+# construct and the characters that change the structure
+TYPED = ['x', 'ab', '7', '0', ' ', '\n', ' + 1', ' * y', 'z :- 3. ']
+PIECES = ['.', ':-', ' => ', ' !! ', '(', ')', '"', '{{', '}}', '{{ y :- 2. }}', 'print:{x}', ':{', '}', ';', ' && ', '~']
+EDITED = [
+    SNIPPET.strip(),
+    '{{ r :- (3 * 4) + x * 1. s :- 2 > 1 => r + 0 !! 0. {{ t :- (1 = 2) => r !! s - (2 ^ 3). }}. }}',
+    '{{ ' + (SNIPPET.strip() + '.\n') * 3 + '}}',
+    '{{ a :- 1. {{ b :- 2. {{ c :- a + b. }}. }}. }}',
+    '(x > 1) => {{ y :- 2. z :- y * 3. }} !! {{ y :- 0. }}',
+    '{{ }}',
+]
+
+
+def snapshot(ast, tokens):
+    # a tree as text, its atoms' positions, and its tokens with theirs, for comparing documents
+    atoms = [atom.position for atom in nodes(ast, AtomAST)]
+    return str(ast), atoms, [(tok.type, tok.value, tok.line, tok.column) for tok in tokens]
+
+
+def reparsed(source):
+    # snapshot() of a full parse, or None if it fails
+    try:
+        tokens = list(Tokenizer(source).tokens())
+        return snapshot(PrattLexer(tokens).line(), tokens)
+    except TokenError:
+        return None
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+@pytest.mark.parametrize('engine', [PrattLexer, stack.StackLexer])
+def test_incremental(engine, seed, edits=300):
+    # differential fuzzer: after every random edit, a Document must hold what parsing its text
+    # from scratch gives, including whether that fails
+    generator = random.Random(seed)
+    for source in EDITED:
+        document = incremental.Document(source, engine)
+        # edits since the text last parsed, to undo them by
+        undo = list()
+        for _ in range(edits):
+            text = document.text
+            # mostly between the outermost braces: what is typed outside them goes through a
+            # full parse, and could end the statement before them
+            lo, hi = text.find('{{') + 2, text.rfind('}}')
+            if lo < 2 or hi < lo or generator.random() < 0.03:
+                lo, hi = 0, len(text)
+            offset = generator.randint(lo, hi)
+            deleted = min(generator.choice((0, 0, 1, 2)), len(text) - offset)
+            inserted = generator.choice(TYPED if generator.random() < 0.7 else PIECES)
+            try:
+                document.edit(offset, deleted, inserted)
+                actual = snapshot(document.ast, document.tokens)
+            except TokenError:
+                actual = None
+            expected = reparsed(document.text)
+            assert actual == expected, f'{text!r} edited at {offset} into {document.text!r}: {actual}, expected {expected}'
+            if actual is not None:
+                undo.clear()
+                continue
+            undo.append((offset, len(inserted), text[offset:offset + deleted]))
+            if generator.random() < 0.5:
+                # undo what broke it, so most edits are made to a script that parses
+                while undo:
+                    try:
+                        document.edit(*undo.pop())
+                    except TokenError:
+                        pass
+                assert snapshot(document.ast, document.tokens) == reparsed(document.text)
+
+
+def test_incremental_in_place():
+    # edits inside a statement of a long script reparse only that statement
+    source = '{{ ' + ''.join(f'r :- x * {i} + 1.\n' for i in range(1000)) + '}}'
+    document = incremental.Document(source)
+    for line in range(500, 600, 7):
+        # a digit typed after the one the line multiplies by, then deleted again; a line break
+        # typed after its `.`
+        offset = source.index(f'x * {line} ') + 4
+        document.edit(offset + 1, 0, '5')
+        document.edit(offset + 1, 1, '')
+        end = source.index('.', offset) + 1
+        document.edit(end, 0, '\n')
+        document.edit(end, 1, '')
+    assert document.full == 1, 'an edit parsed the whole script again'
+    assert snapshot(document.ast, document.tokens) == reparsed(document.text)
@@ -1,5 +1,6 @@
 # coding=utf-8
 from enum import Enum, auto
+import codecs
 import re
 
 
@@ -40,80 +41,184 @@ class TokenType(Enum):
 
 
 class Token:
-    def __init__(self, tok: TokenType, val=None):
+    __slots__ = ('type', 'value', 'line', 'column')
+
+    def __init__(self, tok: TokenType, val=None, line=None, column=None):
         self.type = tok
         self.value = val
-        self.tokenList = []
+        # where the token starts in the script, both counted from 1 (None for made-up tokens)
+        self.line = line
+        self.column = column
 
     def __str__(self):
         return f'{self.type.name}{("(" + str(self.value) + ")") if self.value is not None else ""}'
     __repr__ = __str__
 
 
+# operator spellings, longest first so the master regex always prefers `:-` over `:` etc.
+OPERATORS = {
+    ':-': TokenType.ASSIGN,
+    '{{': TokenType.LBLK,
+    '}}': TokenType.RBLK,
+    '=>': TokenType.THEN,
+    '!!': TokenType.ELSE,
+    '||': TokenType.OR,
+    '&&': TokenType.AND,
+    '>=': TokenType.GE,
+    '<=': TokenType.GE,
+    ':{': TokenType.LARG,
+    '~': TokenType.NOT,
+    '$': TokenType.XOR,
+    '+': TokenType.ADD,
+    '-': TokenType.SUB,
+    '*': TokenType.MUL,
+    '/': TokenType.DIV,
+    '(': TokenType.LPAR,
+    ')': TokenType.RPAR,
+    '^': TokenType.EXP,
+    '.': TokenType.TERM,
+    '>': TokenType.GT,
+    '<': TokenType.LT,
+    '=': TokenType.EQ,
+    '}': TokenType.RARG,
+    ';': TokenType.SEPARG,
+}
+
+WHITESPACE = re.compile(r'\s*')
+MASTER = re.compile('|'.join([
+    r'(?P<NUM>\d+)',
+    r'"(?P<DSTR>[^"\n]*)"',
+    r"'(?P<SSTR>[^'\n]*)'",
+    r'(?P<ID>[a-z]+)',
+    '(?P<OP>' + '|'.join(map(re.escape, sorted(OPERATORS, key=len, reverse=True))) + ')',
+]))
+
+
+# longest spelling that may still be growing at the end of a chunk (`:` before `-`, `{` before `{`)
+LONGEST_OPERATOR = max(map(len, OPERATORS))
+CHUNK_SIZE = 1 << 16
+
+
 class Tokenizer:
-    def __init__(self, stream: str, patterns: dict=None):
+    # `stream` is either the whole program as a str, or anything with a `read(size)` method
+    # (text or binary file objects, sys.stdin, mmap.mmap) which is then consumed chunk by chunk
+    def __init__(self, stream, patterns: dict=None, chunk_size=CHUNK_SIZE):
         self.stream = stream
         self.patterns = patterns
+        self.chunk_size = chunk_size
+        # self.pos indexes the current buffer; self.base is that buffer's offset within the whole script
+        self.pos = 0
+        self.base = 0
+        # the current line number, and the offset within the whole script where it starts
+        self.line = 1
+        self.line_start = 0
 
     def tokens(self, debug=False):
-        def match(tok, string, capture=False):
-            # input(f'matching {string}')
-            if self.stream.startswith(string):
-                # print(f'matched [{string}]')
-                self.stream = self.stream[len(string):]
-                # print(f'<<{self.stream}>> remains')
-                return Token(tok, string) if capture else Token(tok)
-            return False
-
-        self.stream = self.stream.lstrip()
-        while len(self.stream):
-            self.stream = self.stream.lstrip()
+        if isinstance(self.stream, str):
+            yield from self.scan(self.stream, True, debug)
+        else:
+            yield from self.chunks(debug)
+        yield Token(TokenType.EOF, None, self.line, self.base + self.pos - self.line_start + 1)
+
+    def chunks(self, debug=False):
+        read = self.stream.read
+        decoder = None
+        buffer = ''
+        final = False
+        while not final:
+            chunk = read(self.chunk_size)
+            final = not chunk
+            if isinstance(chunk, (bytes, bytearray)):
+                if decoder is None:
+                    decoder = codecs.getincrementaldecoder('utf-8')()
+                chunk = decoder.decode(chunk, final)
+            # keep only the unscanned tail of the previous chunk, so memory stays bounded by the chunk size
+            buffer = buffer[self.pos:] + chunk
+            self.base += self.pos
+            self.pos = 0
+            yield from self.scan(buffer, final, debug)
+
+    def scan(self, stream, final, debug=False):
+        # tokenize stream[self.pos:]; unless this is the final chunk, stop in front of any token
+        # that touches the end of the buffer, since the next chunk could still extend it
+        end = len(stream)
+        skip = WHITESPACE.match
+        match = MASTER.match
+        ops = OPERATORS
+        count = stream.count
+        base = self.base
+        line = self.line
+        line_start = self.line_start
+
+        # newlines only ever occur in the whitespace between tokens; `last` is where the
+        # whitespace not yet searched for them starts
+        last = self.pos
+        pos = skip(stream, last).end()
+        while pos < end:
+            newlines = count('\n', last, pos)
+            if newlines:
+                line += newlines
+                line_start = base + stream.rfind('\n', last, pos) + 1
+            last = pos
+            column = base + pos - line_start + 1
             if debug:
                 input()
-                print('###' + self.stream)
-            if self.stream[0].isdigit():
-                number, rest = re.match(r'(\d+)(.*)', self.stream, re.MULTILINE).groups()
-                # print(f'found number {number}; {{{rest}}} remains!')
-                self.stream = self.stream[len(number):]
-                yield Token(TokenType.NUM, int(number))
-            elif self.stream[0] in "'\"":
-                string, rest = re.match(rf'{self.stream[0]}(.*?){self.stream[0]}(.*)', self.stream, re.MULTILINE).groups()
-                # print(f'found string {string}; {{{rest}}} remains!')
-                self.stream = self.stream[len(string) + 2:]
-                yield Token(TokenType.STR, string)
-            elif self.stream[0].isalpha():
-                ident, rest = re.match(r'([a-z]+)(.*)', self.stream, re.MULTILINE).groups()
-                # print(f'found ID {ident}; {{{rest}}} remains!')
-                self.stream = self.stream[len(ident):]
-                yield Token(TokenType.ID, ident)
+                print('###' + stream[pos:])
+            m = match(stream, pos)
+            if not final:
+                if m is not None and m.end() == end:
+                    break
+                if m is None and (end - pos < LONGEST_OPERATOR or
+                                  (stream[pos] in '\'"' and '\n' not in stream[pos:])):
+                    break
+            if m is None:
+                self.pos = pos
+                self.line, self.line_start = line, line_start
+                raise TokenError(f'Unexpected character {stream[pos]!r} at offset {self.base + pos} '
+                                 f'(line {line}, column {column})')
+            kind = m.lastgroup
+            if kind == 'OP':
+                yield Token(ops[m.group(kind)], None, line, column)
+            elif kind == 'ID':
+                yield Token(TokenType.ID, m.group(kind), line, column)
+            elif kind == 'NUM':
+                yield Token(TokenType.NUM, int(m.group(kind)), line, column)
             else:
-                yield match(TokenType.ASSIGN, ':-') or \
-                      match(TokenType.LBLK, '{{') or \
-                      match(TokenType.RBLK, '}}') or \
-                      match(TokenType.THEN, '=>') or \
-                      match(TokenType.ELSE, '!!') or \
-                      match(TokenType.OR, '||') or \
-                      match(TokenType.AND, '&&') or \
-                      match(TokenType.GE, '>=') or \
-                      match(TokenType.GE, '<=') or \
-                      match(TokenType.LARG, ':{') or \
-                      match(TokenType.NOT, '~') or \
-                      match(TokenType.XOR, '$') or \
-                      match(TokenType.ADD, '+') or\
-                      match(TokenType.SUB, '-') or\
-                      match(TokenType.MUL, '*') or \
-                      match(TokenType.DIV, '/') or \
-                      match(TokenType.LPAR, '(') or \
-                      match(TokenType.RPAR, ')') or \
-                      match(TokenType.EXP, '^') or \
-                      match(TokenType.TERM, '.') or \
-                      match(TokenType.GT, '>') or \
-                      match(TokenType.LT, '<') or \
-                      match(TokenType.EQ, '=') or \
-                      match(TokenType.RARG, '}') or \
-                      match(TokenType.SEPARG, ';')
-            # print('<' + self.stream + '>')
-        yield Token(TokenType.EOF)
+                yield Token(TokenType.STR, m.group(kind), line, column)
+            last = m.end()
+            pos = skip(stream, last).end()
+        newlines = count('\n', last, pos)
+        if newlines:
+            line += newlines
+            line_start = base + stream.rfind('\n', last, pos) + 1
+        self.pos = pos
+        self.line, self.line_start = line, line_start
+
+
+class TokenStream:
+    # list-like view over a token generator that only pulls tokens once the parser indexes them,
+    # so Lexer can start working before the whole script has been read
+    def __init__(self, tokens):
+        self.source = iter(tokens)
+        self.buffer = []
+
+    def __getitem__(self, index):
+        buffer = self.buffer
+        while index >= len(buffer):
+            try:
+                buffer.append(next(self.source))
+            except StopIteration:
+                raise IndexError(index) from None
+        return buffer[index]
+
+    def __iter__(self):
+        index = 0
+        while True:
+            try:
+                yield self[index]
+            except IndexError:
+                return
+            index += 1
 
 
 
@@ -123,6 +228,6 @@ if __name__ == '__main__':
 
     tok = Tokenizer('(x>3) => {{ number :- 4; }} !! {{ number :- 7; }}')
     print(list(tok.tokens()))
-    tok = Tokenizer('print:{"Hello", x}')
+    tok = Tokenizer('print:{"Hello"; x}')
     print(list(tok.tokens()))
 
@@ -0,0 +1,181 @@
+# coding=utf-8
+import ast as py
+from weakref import WeakKeyDictionary
+
+from tokenizer import *
+from asts import *
+
+
+"""
+Python backend: a Sapphire program is lowered to a Python function `program(scope)` and compiled
+with compile(), so CPython's own evaluator runs it.
+
+Every Sapphire line is an expression, so the whole program lowers to Python expressions: blocks
+become tuples (keeping the last element), conditionals become `yes if cond else no`, and an
+assignment both stores the value in the scope and keeps it in a Python local (`x := ...`), which
+later reads use for as long as it is certain to be up to date.
+Every call, `print` and `prompt` included, goes through the scope, so whatever the name is bound to
+there runs (an Interpreter's output sink, say): builtins get the argument ASTs, and user functions
+each argument compiled to its own function.
+"""
+
+ARITHMETIC = {
+    TokenType.ADD: py.Add,
+    TokenType.SUB: py.Sub,
+    TokenType.MUL: py.Mult,
+    TokenType.DIV: py.Div,
+    TokenType.EXP: py.Pow,
+}
+COMPARISON = {
+    TokenType.GT: py.Gt,
+    TokenType.LT: py.Lt,
+    TokenType.GE: py.GtE,
+    TokenType.LE: py.LtE,
+    TokenType.EQ: py.Eq,
+}
+LOGICAL = {
+    TokenType.AND: py.And,
+    TokenType.OR: py.Or,
+}
+
+
+def call(scope, name, args, fns):
+    func = load(scope, name)
+    if type(func) is FunctionAST:
+        return run(func.body, func.bind(fns, scope))
+    return func(args, scope)
+
+
+class Transpiler:
+    def __init__(self):
+        # objects the generated code refers to by name (call arguments)
+        self.constants = dict()
+        # variables whose value is known to be in their Python local at this point
+        self.assigned = set()
+
+    def transpile(self, ast):
+        if type(ast) is BlockAST and ast.lines:
+            body = [py.Expr(self.visit(line)) for line in ast.lines[:-1]]
+            body.append(py.Return(self.visit(ast.lines[-1])))
+        else:
+            body = [py.Return(self.visit(ast))]
+        module = py.parse('def program(scope):\n    pass')
+        module.body[0].body = body
+        return py.fix_missing_locations(module)
+
+    def constant(self, obj):
+        name = f'n{len(self.constants)}'
+        self.constants[name] = obj
+        return py.Name(name, py.Load())
+
+    @staticmethod
+    def local(name):
+        # prefixed so Sapphire names never clash with keywords or the helpers below
+        return f'v_{name}'
+
+    def visit(self, ast):
+        kind = type(ast)
+        if kind is AtomAST:
+            if ast.type is not TokenType.ID:
+                return py.Constant(ast.val)
+            if ast.val in self.assigned:
+                return py.Name(self.local(ast.val), py.Load())
+            return py.Call(py.Name('load', py.Load()), [py.Name('scope', py.Load()), py.Constant(ast.val)], [])
+
+        if kind is ExpressionAST:
+            op = ast.op.type
+            if ast.lhs is None and op in UNARY:
+                rhs = self.visit(ast.rhs)
+                if op is TokenType.SUB:
+                    return py.BinOp(py.Constant(-1), py.Mult(), rhs)
+                if op is TokenType.NOT:
+                    return py.UnaryOp(py.Not(), rhs)
+                return rhs
+            if op in ARITHMETIC:
+                return py.BinOp(self.visit(ast.lhs), ARITHMETIC[op](), self.visit(ast.rhs))
+            if op in COMPARISON:
+                return py.Compare(self.visit(ast.lhs), [COMPARISON[op]()], [self.visit(ast.rhs)])
+            if op in LOGICAL:
+                # Python's own and/or, which skip the right side just the same
+                lhs = self.visit(ast.lhs)
+                before = set(self.assigned)
+                rhs = self.visit(ast.rhs)
+                # the right side may not run: only what is certain either way stays known
+                self.assigned &= before
+                return py.BoolOp(LOGICAL[op](), [lhs, rhs])
+            if op is TokenType.XOR:
+                return py.Call(py.Name('xor', py.Load()), [self.visit(ast.lhs), self.visit(ast.rhs)], [])
+            return py.Constant(None)
+
+        if kind is AssignmentAST:
+            name = ast.dest.value
+            val = py.Call(py.Name('store', py.Load()), [py.Name('scope', py.Load()), py.Constant(name),
+                                                         self.visit(ast.val)], [])
+            self.assigned.add(name)
+            return py.NamedExpr(py.Name(self.local(name), py.Store()), val)
+
+        if kind is BlockAST:
+            if not ast.lines:
+                return py.Constant(None)
+            lines = [self.visit(line) for line in ast.lines]
+            if len(lines) == 1:
+                return lines[0]
+            return py.Subscript(py.Tuple(lines, py.Load()), py.Constant(-1), py.Load())
+
+        if kind is ConditionalAST:
+            cond = self.visit(ast.cond)
+            before = set(self.assigned)
+            yes = self.visit(ast.yes)
+            after_yes, self.assigned = self.assigned, before
+            no = py.Constant(None) if ast.no is None else self.visit(ast.no)
+            # only what both branches assigned is certain afterwards
+            self.assigned &= after_yes
+            return py.IfExp(cond, yes, no)
+
+        if kind is CallAST:
+            name = ast.name.value
+            # the call may read or change the scope behind our back
+            self.assigned.clear()
+            fns = [compiled(arg) for arg in ast.args]
+            return py.Call(py.Name('call', py.Load()),
+                           [py.Name('scope', py.Load()), py.Constant(name), self.constant(ast.args),
+                            self.constant(fns)], [])
+
+        raise TypeError(f'Cannot transpile {kind.__name__}')
+
+
+def transpile(ast):
+    # the Python module for a program, plus the namespace it has to run in
+    transpiler = Transpiler()
+    module = transpiler.transpile(ast)
+    namespace = {'load': load, 'store': store, 'call': call, 'xor': xor}
+    namespace.update(transpiler.constants)
+    return module, namespace
+
+
+def source(ast):
+    return py.unparse(transpile(ast)[0])
+
+
+# compiled program functions, so an AST is only transpiled once
+programs = WeakKeyDictionary()
+
+
+def compiled(ast):
+    func = programs.get(ast)
+    if func is None:
+        module, namespace = transpile(ast)
+        exec(compile(module, '<sapphire>', 'exec'), namespace)
+        func = programs[ast] = namespace['program']
+    return func
+
+
+def run(ast, scope):
+    return compiled(ast)(scope)
+
+
+if __name__ == '__main__':
+    import sys
+    from pratt import PrattLexer
+    with open(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin as f:
+        print(source(PrattLexer(TokenStream(Tokenizer(f).tokens())).line()))
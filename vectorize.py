@@ -0,0 +1,230 @@
+# coding=utf-8
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from tokenizer import *
+from asts import *
+
+
+"""
+Batch evaluation of one formula over every row of a table. Identifiers are bound to NumPy columns,
+and each node is evaluated once for all rows instead of once per row:
+
+- literals stay Python scalars, broadcast by NumPy wherever they meet a column
+- arithmetic and comparisons apply the BINARY/UNARY operators to whole columns
+- && and || evaluate their right side only on the rows the left side does not decide, like a
+  conditional
+- a conditional evaluates its condition, then each branch only on the rows that take it, and the
+  two are merged by the condition (a masked np.where), so a branch that would fail or print is
+  never run for rows that do not take it
+- anything else (assignments, blocks, calls), and any operator NumPy rejects for these operands
+  (strings, negative integer powers), falls back to running per row on the rows that reach it
+
+Results match running the formula once per row, except that output printed by per-row fallbacks is
+grouped by node rather than interleaved row by row. Integer + - * ^ that might not fit in int64
+are computed on Python ints (an object array) instead, as NumPy would wrap around.
+"""
+
+ARITHMETIC = {TokenType.ADD, TokenType.SUB, TokenType.MUL, TokenType.EXP}
+
+
+def array(val):
+    return np is not None and isinstance(val, np.ndarray)
+
+
+class Vectorizer:
+    def __init__(self, columns, scope=None):
+        if np is None:
+            raise ImportError('vectorized evaluation needs numpy')
+        self.scope = dict() if scope is None else scope
+        self.columns = dict()
+        size = None
+        for name, col in columns.items():
+            if not np.isscalar(col):
+                col = np.asarray(col)
+                if size is not None and len(col) != size:
+                    raise ValueError(f'column {name} has {len(col)} rows, expected {size}')
+                size = len(col)
+            self.columns[name] = col
+        if size is None:
+            raise ValueError('at least one column must be an array')
+        self.size = size
+        self.all = np.arange(size)
+        # columns as Python lists, for the per-row fallback
+        self.lists = dict()
+        # nodes that had to fall back to per-row execution, and for how many rows
+        self.fallbacks = list()
+
+    def evaluate(self, ast):
+        val = self.visit(ast, self.all)
+        if array(val):
+            return val
+        return np.full(self.size, val, dtype=object if val is None or type(val) is str else None)
+
+    def visit(self, ast, rows):
+        # the value of ast on each of `rows`: an array aligned with rows, or one scalar for all of them
+        kind = type(ast)
+        if kind is AtomAST:
+            if ast.type is not TokenType.ID:
+                return ast.val
+            name = ast.val
+            if name in self.columns:
+                col = self.columns[name]
+                if not array(col) or rows is self.all:
+                    return col
+                return col[rows]
+            val = self.scope.get(name)
+            if type(val) in (int, float, str, bool):
+                return val
+            return self.rowwise(ast, rows)
+
+        if kind is ExpressionAST:
+            op = ast.op.type
+            if ast.lhs is None and op in UNARY:
+                rhs = self.visit(ast.rhs, rows)
+                if op is TokenType.NOT and array(rhs):
+                    return np.logical_not(self.truth(rhs))
+                if op is TokenType.SUB and self.overflows(TokenType.MUL, -1, rhs):
+                    rhs = self.exact(rhs)
+                return self.apply(UNARY[op], rhs)
+            if op in BINARY:
+                lhs = self.visit(ast.lhs, rows)
+                rhs = self.visit(ast.rhs, rows)
+                if op in ARITHMETIC:
+                    # NumPy adds booleans as a logical or; Python adds them as the ints 0 and 1
+                    lhs, rhs = self.numeric(lhs), self.numeric(rhs)
+                    if self.overflows(op, lhs, rhs):
+                        lhs, rhs = self.exact(lhs), self.exact(rhs)
+                if op is TokenType.DIV and np.any(np.asarray(rhs == 0)):
+                    raise ZeroDivisionError('division by zero')
+                if op is TokenType.XOR and (array(lhs) or array(rhs)):
+                    return np.logical_xor(*[self.truth(val) if array(val) else bool(val) for val in (lhs, rhs)])
+                return self.apply(BINARY[op], lhs, rhs)
+            if op in SHORT_CIRCUIT:
+                lhs = self.visit(ast.lhs, rows)
+                if not array(lhs):
+                    if bool(lhs) is SHORT_CIRCUIT[op]:
+                        return lhs
+                    return self.visit(ast.rhs, rows)
+                # rows whose left side decides keep it; only the others evaluate the right side
+                decided = self.truth(lhs)
+                if not SHORT_CIRCUIT[op]:
+                    decided = ~decided
+                if decided.all():
+                    return lhs
+                return self.merge(decided, lhs[decided], self.visit(ast.rhs, rows[~decided]))
+            return None
+
+        if kind is ConditionalAST:
+            cond = self.visit(ast.cond, rows)
+            if not array(cond):
+                if cond:
+                    return self.visit(ast.yes, rows)
+                return None if ast.no is None else self.visit(ast.no, rows)
+            mask = self.truth(cond)
+            yes = self.visit(ast.yes, rows[mask]) if mask.any() else None
+            no = None
+            if ast.no is not None and not mask.all():
+                no = self.visit(ast.no, rows[~mask])
+            return self.merge(mask, yes, no)
+
+        return self.rowwise(ast, rows)
+
+    @staticmethod
+    def numeric(val):
+        if array(val) and val.dtype == bool:
+            return val.astype(np.int64)
+        return val
+
+    @staticmethod
+    def overflows(op, lhs, rhs):
+        # whether op on integer operands, a column among them, might not fit in int64: NumPy
+        # would wrap around where Python ints just grow. Judged from the largest magnitude on
+        # each side, which costs a min and a max per column rather than a pass per operator
+        if not (array(lhs) or array(rhs)):
+            return False
+        sizes = list()
+        for val in (lhs, rhs):
+            if array(val):
+                if val.dtype.kind not in 'iu':
+                    return False
+                sizes.append(max(-int(val.min()), int(val.max())) if len(val) else 0)
+            elif type(val) is int:
+                sizes.append(abs(val))
+            else:
+                return False
+        lhs, rhs = sizes
+        if op is TokenType.EXP:
+            return lhs > 1 and lhs.bit_length() * rhs > 62
+        if op is TokenType.MUL:
+            return lhs * rhs >= 2 ** 62
+        return lhs + rhs >= 2 ** 62
+
+    @staticmethod
+    def exact(val):
+        # a column as Python ints, which NumPy applies operators to one by one
+        return val.astype(object) if array(val) else val
+
+    @staticmethod
+    def truth(val):
+        if val.dtype.kind in 'biuf':
+            return val.astype(bool)
+        return np.array([bool(v) for v in val.tolist()], dtype=bool)
+
+    @staticmethod
+    def merge(mask, yes, no):
+        # yes holds values for the rows where mask is set, no for the others
+        sides = [val for val, rows in ((yes, mask), (no, ~mask)) if rows.any()]
+        kinds = [val.dtype if array(val) else np.asarray(val).dtype for val in sides]
+        if len({kind.kind for kind in kinds}) == 1:
+            dtype = np.result_type(*kinds)
+        else:
+            # ints from one branch and floats from the other stay what they were, as per row
+            dtype = object
+        out = np.empty(len(mask), dtype=dtype)
+        out[mask] = yes
+        out[~mask] = no
+        return out
+
+    def apply(self, fn, *args):
+        if not any(map(array, args)):
+            return fn(*args)
+        try:
+            return fn(*args)
+        except (TypeError, ValueError):
+            # NumPy has no elementwise version for these operands; apply the operator row by row
+            size = next(len(arg) for arg in args if array(arg))
+            self.fallbacks.append((fn.__name__, size))
+            rows = [arg.tolist() if array(arg) else [arg] * size for arg in args]
+            return np.array([fn(*vals) for vals in zip(*rows)], dtype=object)
+
+    def rowwise(self, ast, rows):
+        # run ast on its own for each row, with that row's values bound in the scope
+        self.fallbacks.append((type(ast).__name__, len(rows)))
+        names = [name for name, col in self.columns.items() if array(col)]
+        for name in names:
+            if name not in self.lists:
+                self.lists[name] = self.columns[name].tolist()
+        base = dict(self.scope)
+        base.update((name, col) for name, col in self.columns.items() if not array(col))
+        results = list()
+        for row in rows.tolist():
+            # a fresh scope per row, as if the formula had been run on that row alone
+            scope = dict(base)
+            for name in names:
+                scope[name] = self.lists[name][row]
+            results.append(evaluate(ast, scope))
+        return np.array(results, dtype=object)
+
+
+def vectorize(ast, columns, scope=None):
+    # ast's value for every row of `columns` (name -> 1-d array, or a scalar shared by all rows)
+    return Vectorizer(columns, scope).evaluate(ast)
+
+
+if __name__ == '__main__':
+    from pratt import PrattLexer
+    ast = PrattLexer(list(Tokenizer('(x > 2) => x * (y + 1) !! -x / 2').tokens())).line()
+    print(vectorize(ast, {'x': np.arange(6), 'y': 10}))
@@ -0,0 +1,186 @@
+# coding=utf-8
+from functools import partial
+from weakref import WeakKeyDictionary
+
+from tokenizer import *
+from asts import *
+
+
+"""
+Bytecode backend: an AST is compiled once into a flat list of opcodes with a parallel list of
+operands, and run by a single loop over a value stack instead of recursing through execute().
+"""
+
+# opcodes
+CONST = 0       # push operand
+LOAD = 1        # push the value of variable `operand`
+BINARY_OP = 2   # pop rhs and lhs, push operand(lhs, rhs)
+UNARY_OP = 3    # replace top of stack with operand(top)
+STORE = 4       # assign the value on top of the stack to variable `operand`, leaving it there
+POP = 5         # discard top of stack
+JUMP = 6        # continue at operand
+JUMP_IF_FALSE = 7   # pop; continue at operand if falsy
+CALL = 8        # operand is (name, argument ASTs, their code); push the call's result
+RETURN = 9      # stop, returning top of stack
+JUMP_IF_FALSE_OR_POP = 10   # continue at operand, leaving top of stack, if it is falsy; else pop it
+JUMP_IF_TRUE_OR_POP = 11    # the same, if it is truthy
+
+OPNAMES = ['CONST', 'LOAD', 'BINARY_OP', 'UNARY_OP', 'STORE', 'POP', 'JUMP', 'JUMP_IF_FALSE', 'CALL', 'RETURN',
+           'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP']
+
+
+class Code:
+    def __init__(self):
+        self.ops = list()
+        self.args = list()
+
+    def emit(self, op, arg=None):
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+
+    def __str__(self):
+        return '\n'.join(f'{pc:>4} {OPNAMES[op]:<14} {getattr(arg, "__name__", arg)}'
+                         for pc, (op, arg) in enumerate(zip(self.ops, self.args)))
+
+
+class Compiler:
+    def __init__(self):
+        self.code = Code()
+
+    def compile(self, ast):
+        self.visit(ast)
+        self.code.emit(RETURN)
+        return self.code
+
+    def visit(self, ast):
+        emit = self.code.emit
+        kind = type(ast)
+        if kind is AtomAST:
+            if ast.type is TokenType.ID:
+                emit(LOAD, ast.val)
+            else:
+                emit(CONST, ast.val)
+        elif kind is ExpressionAST:
+            if ast.lhs is None and ast.op.type in UNARY:
+                self.visit(ast.rhs)
+                emit(UNARY_OP, UNARY[ast.op.type])
+            elif ast.op.type in BINARY:
+                self.visit(ast.lhs)
+                self.visit(ast.rhs)
+                emit(BINARY_OP, BINARY[ast.op.type])
+            elif ast.op.type in SHORT_CIRCUIT:
+                # the right side is skipped when the left one decides, leaving that as the result
+                self.visit(ast.lhs)
+                skip = emit(JUMP_IF_TRUE_OR_POP if SHORT_CIRCUIT[ast.op.type] else JUMP_IF_FALSE_OR_POP)
+                self.visit(ast.rhs)
+                self.code.args[skip] = len(self.code.ops)
+            else:
+                emit(CONST, None)
+        elif kind is AssignmentAST:
+            self.visit(ast.val)
+            emit(STORE, ast.dest.value)
+        elif kind is BlockAST:
+            if not ast.lines:
+                emit(CONST, None)
+            for i, line in enumerate(ast.lines):
+                if i:
+                    emit(POP)
+                self.visit(line)
+        elif kind is ConditionalAST:
+            self.visit(ast.cond)
+            branch = emit(JUMP_IF_FALSE)
+            self.visit(ast.yes)
+            skip = emit(JUMP)
+            self.code.args[branch] = len(self.code.ops)
+            if ast.no is None:
+                emit(CONST, None)
+            else:
+                self.visit(ast.no)
+            self.code.args[skip] = len(self.code.ops)
+        elif kind is CallAST:
+            codes = [partial(run, compile_ast(arg)) for arg in ast.args]
+            emit(CALL, (ast.name.value, ast.args, codes))
+        else:
+            raise TypeError(f'Cannot compile {kind.__name__}')
+
+
+def compile_ast(ast):
+    return Compiler().compile(ast)
+
+
+# bytecode for every AST run so far, so programs and function bodies are compiled only once
+programs = WeakKeyDictionary()
+
+
+def compiled(ast):
+    code = programs.get(ast)
+    if code is None:
+        code = programs[ast] = compile_ast(ast)
+    return code
+
+
+def call(func, args, codes, scope):
+    if type(func) is not FunctionAST:
+        return func(args, scope)
+    # same calling convention as FunctionAST.__call__, but the body and arguments run on the VM
+    return run(compiled(func.body), func.bind(codes, scope))
+
+
+def run(code, scope):
+    ops = code.ops
+    args = code.args
+    stack = list()
+    push = stack.append
+    pop = stack.pop
+    pc = 0
+    while True:
+        op = ops[pc]
+        arg = args[pc]
+        pc += 1
+        if op == LOAD:
+            val = scope[arg]
+            push(val.value() if type(val) is Argument else val)
+        elif op == CONST:
+            push(arg)
+        elif op == BINARY_OP:
+            rhs = pop()
+            stack[-1] = arg(stack[-1], rhs)
+        elif op == UNARY_OP:
+            stack[-1] = arg(stack[-1])
+        elif op == JUMP_IF_FALSE:
+            if not pop():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == POP:
+            pop()
+        elif op == STORE:
+            store(scope, arg, stack[-1])
+        elif op == CALL:
+            name, params, codes = arg
+            push(call(load(scope, name), params, codes, scope))
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[-1]:
+                pop()
+            else:
+                pc = arg
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1]:
+                pc = arg
+            else:
+                pop()
+        else:
+            return pop()
+
+
+def execute(ast, scope):
+    return run(compiled(ast), scope)
+
+
+if __name__ == '__main__':
+    from pratt import PrattLexer
+    ast = PrattLexer(list(Tokenizer('{{ x :- 3. (x > 2) => x * (4 + 1) !! -x. }}').tokens())).line()
+    code = compile_ast(ast)
+    print(code)
+    print(run(code, {}))
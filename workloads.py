@@ -0,0 +1,146 @@
+# coding=utf-8
+from tokenizer import Tokenizer
+from pratt import PrattLexer
+from asts import FunctionAST, evaluate
+import sapphire
+
+
+"""
+Scripts, bindings and data shared by the benchmarks (benchmark.py, scaling.py) and the tests
+(test_sapphire.py), so that what is timed is also what is checked.
+"""
+
+# a representative chunk of script text, repeated to build large inputs
+SNIPPET = '{{ number :- 4 * (x + 12). (x >= 3) => print:{"big"; x} !! print:{\'small\'}. }}\n'
+
+# small scripts covering every construct of the grammar, shared by the engine comparisons
+CORPUS = [
+    '3 + 4',
+    '-3 * 2 + 1',
+    '2 ^ 3 ^ 2',
+    '(x + 1) * (y - 2) / 4',
+    '(x) > 1',
+    '((x + 1)) >= 2 && y < 3 || ~z = 4 $ w > 0',
+    '~(x > 1) && (y < 2)',
+    'x :- 3 * (4 + 5)',
+    'x :- y :- 2',
+    'x > 3 => print:{"big"} !! print:{"small"}',
+    'x => 1 !! 2',
+    '(x > 1) => {{ y :- 2. z :- y * 3. }} !! {{ y :- 0. }}',
+    SNIPPET,
+    'print:{1; 2; 3;}',
+    'f:{g:{x + 1; y}; h:{} }',
+    '{{ a :- 1. b :- a > 0 => a !! -a. c :- (a + b) ^ 2. }}',
+    'x = 1 => y = 2 => 3 !! 4 !! 5',
+    '{{ {{ x :- 1. }}. {{ y :- 2. }}. }}',
+    'a > 1 && b > 2 $ c > 3 || d > 4 && e > 5',
+    '-(x + 1) > 2 => "neg"',
+    'x > 100 && 1 / (x - x) > 0',
+    'x < 100 || 1 / (x - x) > 0',
+    'x > 1 && 1 / (x - x) > 0',
+    '(x > 1 $ y > 1) => "one" !! "both or neither"',
+    'x :- => 3',
+    '3 + => 4',
+    '{{ x :- 1 }}',
+    '{{ r :- 7. k:{1; 55}. }}',
+    '{{ s :- "str". t :- s + 0. }}',
+    '(x > 1) * 1 + 0',
+    '{{ r :- u:{5}. s :- v:{1}. t :- sq:{}. }}',
+    'x > 100 => 9 ^ (9 ^ 9) !! 0',
+    '{{ r :- 2 ^ 20000. r > 5 => 1 !! 0. }}',
+]
+
+# arithmetic-heavy, variable-heavy and call-heavy workloads for comparing backends
+ARITHMETIC = '{{ ' + 'r :- (a * 3 + b) - c ^ 2 * (d + e). s :- r > b => r - b !! b - r. t :- -(s + 1) * 2 + x * y. ' * 50 + '}}'
+LOCALS = '{{ p :- 1. q :- 2. ' + 'p :- (q + 1) * 2 - q. q :- p - q - 1. r :- p * q > 3 => p !! q. ' * 50 + '}}'
+CALLS = '{{ ' + 's :- sq:{2}. t :- f:{s; g:{a; 2} }. u :- sq:{t - s}. ' * 50 + '}}'
+
+# generated-looking code, full of constant subexpressions and decided conditionals
+CONSTANTS = '{{ ' + 'r :- (3 * 4) + x * 1. s :- 2 > 1 => r + 0 !! 0. {{ t :- (1 = 2) => r !! s - (2 ^ 3). }}. ' * 50 + '}}'
+
+ARENA_LINE = '{{ number :- 4 * (x + 12). (x >= 3) => sq:{number} !! f:{x; -number}. }}. '
+
+# a program whose result depends on its bindings through locals, calls and branches
+SHARED = '{{ s :- f:{x; y}. t :- sq:{s - x}. u :- t > 10 => g:{t; s} !! t - s. r :- u * 2 - x. }}'
+
+FIB = 'n < 2 => n !! {{ a :- fib:{n - 1}. b :- fib:{n - 2}. a + b. }}'
+
+# per-row formulas, from plain arithmetic to constructs that need the per-row fallback
+FORMULAS = [
+    'x * 3 + y - 2 ^ 2',
+    '(x > y) => x - y !! y - x',
+    '(x >= 50) => {{ r :- x * 2. r + y. }} !! sq:{y}',
+    '(x + 1) / (y + 6) > 5 => "big" !! z',
+    '~(x > 10) => (x + 1) ^ -1 !! x = y',
+    '(x > 90) => 1 / (x - 90) !! x - y',
+    'x > 0 && 100 / x > 3 || y < 0 => x !! y',
+    '(x > 50 $ y > 2) => 1 !! 0',
+    'z + "!"',
+    # past int64, where NumPy would wrap around
+    'x ^ 20 - y * 3',
+    'x * 100000000000000000000 + 1',
+]
+
+
+def program(source):
+    return PrattLexer(list(Tokenizer(source).tokens())).line()
+
+
+def bindings():
+    # builtins, a few user functions and numeric variables for the corpus scripts to use
+    scope = dict(sapphire.scope)
+    scope.update({
+        'f': FunctionAST(['p', 'q'], program('p + q')),
+        'g': FunctionAST(['p', 'q'], program('p * q')),
+        'h': FunctionAST([], program('7')),
+        'sq': FunctionAST(['n'], program('n * n')),
+        # assigns a local named like a global, for calls that pass it more arguments than it takes
+        'k': FunctionAST(['a'], program('{{ r :- r + 1. r. }}')),
+        # reads names it neither takes nor assigns, so they come from whichever frame calls it
+        'v': FunctionAST(['a'], program('a + y + w')),
+        # calls v and sq (leaving out its parameter) with locals of its own to read
+        'u': FunctionAST(['y'], program('{{ w :- 50. n :- 2. r :- v:{1}. s :- sq:{}. r + s. }}')),
+    })
+    for i, name in enumerate('abcdenwxyz'):
+        scope[name] = i + 1
+    return scope
+
+
+def label(i):
+    # a distinct identifier (lowercase letters only) for every i
+    name = ''
+    while True:
+        name += chr(ord('a') + i % 26)
+        i //= 26
+        if not i:
+            return name
+
+
+def deep(kind, depth):
+    # programs nested `depth` levels deep in one way or another
+    if kind == 'parens':
+        return '(' * depth + 'x' + ' + 1)' * depth
+    if kind == 'unary':
+        return '- ' * depth + 'x'
+    if kind == 'blocks':
+        return '{{ ' * depth + 'x.' + ' }}.' * (depth - 1) + ' }}'
+    return '=> '.join(['x > 0 '] * depth) + '=> x'
+
+
+def rows(size, seed=1):
+    import random
+    generator = random.Random(seed)
+    return {'x': [generator.randrange(100) for _ in range(size)],
+            'y': [generator.randrange(-5, 10) for _ in range(size)],
+            'z': [generator.choice(['a', 'bc', '']) for _ in range(size)]}
+
+
+def scalar_loop(ast, table, scope):
+    # the reference: the formula run on its own for every row
+    names = list(table)
+    results = list()
+    for values in zip(*table.values()):
+        row = dict(scope)
+        row.update(zip(names, values))
+        results.append(evaluate(ast, row))
+    return results